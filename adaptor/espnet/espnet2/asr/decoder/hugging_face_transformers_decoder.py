@@ -56,6 +56,9 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
 
         self.decoder_pretrained_params = copy.deepcopy(self.decoder.state_dict())
 
+        # Not always 2: models pruned by nlu/prune_vocab.py have their own ids
+        self.decoder_start_token_id = model.config.decoder_start_token_id
+
         self.return_hidden = return_hidden
 
         if not self.return_hidden:
@@ -93,7 +96,7 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
         args = {"return_dict": True}
 
         if self.decoder.__class__.__name__ == "MBartDecoder":
-            ys_in_pad[:, 0] = 2
+            ys_in_pad[:, 0] = self.decoder_start_token_id
 
         args["input_ids"] = ys_in_pad
         mask = (~make_pad_mask(ys_in_lens)).to(ys_in_pad.device).float()
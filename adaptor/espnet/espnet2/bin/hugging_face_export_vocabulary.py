@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import argparse
+import json
 import logging
 from pathlib import Path
 import sys
@@ -31,11 +32,20 @@ def export_vocabulary(
         fout = p.open("w", encoding="utf-8")
 
     tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
-    words = ["" for _ in range(tokenizer.vocab_size)]
-    vocab = tokenizer.get_vocab()
+    vocab_map_file = Path(model_name_or_path) / "vocab_map.json"
+    if vocab_map_file.exists():
+        # A model pruned by nlu/prune_vocab.py: token i of the pruned model
+        # is token vocab_map[i] of the tokenizer
+        with vocab_map_file.open(encoding="utf-8") as f:
+            vocab_map = json.load(f)
+        logging.info(f"Exporting the {len(vocab_map)} tokens kept in {vocab_map_file}")
+        words = tokenizer.convert_ids_to_tokens(vocab_map)
+    else:
+        words = ["" for _ in range(tokenizer.vocab_size)]
+        vocab = tokenizer.get_vocab()
 
-    for w in vocab:
-        words[vocab[w]] = w
+        for w in vocab:
+            words[vocab[w]] = w
 
     # Parse the values of --add_symbol
     for symbol_and_id in add_symbol:
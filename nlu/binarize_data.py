@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import argparse
+
+from prune_vocab import load_tokenizer
+from utils import binarize_seq2seq_split
+
+
+def main(args):
+    tokenizer = load_tokenizer(args.tokenizer_name)
+    tokenizer_kwargs = {k: getattr(args, k) for k in ["src_lang", "tgt_lang"] if getattr(args, k)}
+    target_lens = {
+        "train": args.max_target_length,
+        "val": args.val_max_target_length,
+        "test": args.test_max_target_length,
+    }
+    for type_path, max_target_length in target_lens.items():
+        n_obs = binarize_seq2seq_split(
+            tokenizer,
+            args.data_dir,
+            type_path,
+            max_source_length=args.max_source_length,
+            max_target_length=max_target_length,
+            prefix=args.prefix,
+            **tokenizer_kwargs,
+        )
+        print(f"{type_path}: {n_obs} examples")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokenize {split}.source/.target once for --binarized_data")
+    parser.add_argument("--tokenizer_name", type=str, required=True, help="--model_name_or_path of finetune.py")
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--max_source_length", type=int, default=1024)
+    parser.add_argument("--max_target_length", type=int, default=56)
+    parser.add_argument("--val_max_target_length", type=int, default=142)
+    parser.add_argument("--test_max_target_length", type=int, default=142)
+    parser.add_argument("--prefix", type=str, default="", help="model.config.prefix, empty for mBART")
+    parser.add_argument("--src_lang", type=str, default="")
+    parser.add_argument("--tgt_lang", type=str, default="")
+    main(parser.parse_args())
@@ -1,6 +1,9 @@
 # Adopted from https://raw.githubusercontent.com/huggingface/transformers/88e84186e5a0d5dd78b62b1a8e97b2c269426442/examples/research_projects/seq2seq-distillation/callbacks.py
 
+import json
 import logging
+import resource
+import time
 from pathlib import Path
 
 import numpy as np
@@ -10,6 +13,7 @@ from pytorch_lightning.callbacks import EarlyStopping, ModelCheckpoint
 from pytorch_lightning.utilities import rank_zero_only
 
 from utils import save_json
+from zero import memory_report
 
 
 def count_trainable_parameters(model):
@@ -22,9 +26,20 @@ logger = logging.getLogger(__name__)
 
 
 class Seq2SeqLoggingCallback(pl.Callback):
+    """Logs the learning rates every log_every_n_steps batches rather than after every batch, and appends the metrics
+    of each validation check to metrics.jsonl; metrics.json, the whole history, is written at the end of training and
+    testing only."""
+
+    def __init__(self):
+        super().__init__()
+        self.batches = 0
+
     def on_batch_end(self, trainer, pl_module):
+        self.batches += 1
+        if self.batches % getattr(trainer, "log_every_n_steps", 50):
+            return
         lrs = {f"lr_group_{i}": param["lr"] for i, param in enumerate(pl_module.trainer.optimizers[0].param_groups)}
-        pl_module.logger.log_metrics(lrs)
+        pl_module.logger.log_metrics(lrs, step=trainer.global_step)
 
     @rank_zero_only
     def _write_logs(
@@ -79,12 +94,177 @@ class Seq2SeqLoggingCallback(pl.Callback):
         return self._write_logs(trainer, pl_module, "test")
 
     @rank_zero_only
-    def on_validation_end(self, trainer: pl.Trainer, pl_module):
+    def on_train_end(self, trainer: pl.Trainer, pl_module: pl.LightningModule):
         save_json(pl_module.metrics, pl_module.metrics_save_path)
+
+    @rank_zero_only
+    def on_validation_end(self, trainer: pl.Trainer, pl_module):
+        with open(pl_module.metrics_save_path.with_suffix(".jsonl"), "a") as f:
+            f.write(json.dumps(pl_module.metrics["val"][-1]) + "\n")
         # Uncommenting this will save val generations
         # return self._write_logs(trainer, pl_module, "valid")
 
 
+class OptimizerMemoryCallback(pl.Callback):
+    """Logs the optimizer state memory of every rank once the state exists, after the first optimizer step."""
+
+    def __init__(self):
+        self.reported = False
+
+    def on_train_batch_end(self, trainer, pl_module, *args, **kwargs):
+        if self.reported or trainer.global_step < 1:
+            return
+        self.reported = True
+        optimizer = trainer.optimizers[0]
+        report = memory_report(getattr(optimizer, "_optimizer", optimizer), pl_module.device)
+        logger.info(f"memory after the first optimizer step: {report}")
+        save_json(report, Path(pl_module.hparams.output_dir) / f"memory_rank{report['rank']}.json")
+
+
+class StepProfilerCallback(pl.Callback):
+    """Splits every training step into data wait, forward, backward and optimizer time and records tokens/sec,
+    padding and peak memory. Records stay in memory, as tensors where they are on the GPU, and are appended to
+    `profile_rank{r}.jsonl` every `flush_every` steps, when the means are also logged.
+
+    The forward/backward split needs Lightning's on_before_backward (>= 1.5), otherwise `forward_s` is forward and
+    backward. With `cuda_sync` every boundary waits for the GPU, which costs a little but makes the split honest;
+    without it GPU time shows up wherever the next sync happens. `trace_start`/`trace_steps` record a torch.profiler
+    chrome trace of that window of steps.
+    """
+
+    def __init__(self, flush_every=50, cuda_sync=True, trace_start=-1, trace_steps=5):
+        self.flush_every = flush_every
+        self.cuda_sync = cuda_sync
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.records = []
+        self.batch_end = None
+        self.profiler = None
+        self.steps = 0
+
+    def _now(self, pl_module) -> float:
+        if self.cuda_sync and pl_module.device.type == "cuda":
+            torch.cuda.synchronize(pl_module.device)
+        return time.perf_counter()
+
+    @property
+    def path(self) -> Path:
+        return Path(self.output_dir) / f"profile_rank{self.rank}.jsonl"
+
+    def on_train_start(self, trainer, pl_module):
+        self.output_dir = pl_module.hparams.output_dir
+        self.rank = trainer.global_rank
+
+    def on_train_batch_start(self, trainer, pl_module, batch, *args, **kwargs):
+        if self.steps == self.trace_start:
+            self._start_trace()
+        if pl_module.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(pl_module.device)
+        self.batch_start = self._now(pl_module)
+        self.backward_start = self.backward_end = None
+        pad = pl_module.pad
+        self.record = {
+            "step": trainer.global_step,
+            "data_wait_s": self.batch_start - self.batch_end if self.batch_end is not None else 0.0,
+            "src_tokens": batch["input_ids"].ne(pad).sum(),
+            "tgt_tokens": batch["labels"].ne(pad).sum(),
+            "src_slots": batch["input_ids"].numel(),
+            "tgt_slots": batch["labels"].numel(),
+        }
+
+    def on_before_backward(self, trainer, pl_module, loss):
+        self.backward_start = self._now(pl_module)
+
+    def on_after_backward(self, trainer, pl_module):
+        self.backward_end = self._now(pl_module)
+
+    def on_train_batch_end(self, trainer, pl_module, *args, **kwargs):
+        self.batch_end = self._now(pl_module)
+        record = self.record
+        if self.backward_end is None:  # skipped batch, e.g. a NaN loss
+            record["forward_s"] = self.batch_end - self.batch_start
+        else:
+            forward_end = self.backward_start if self.backward_start is not None else self.backward_end
+            record["forward_s"] = forward_end - self.batch_start
+            record["backward_s"] = self.backward_end - forward_end
+            record["optimizer_s"] = self.batch_end - self.backward_end
+        record["step_s"] = self.batch_end - self.batch_start
+        # ru_maxrss is in KB on Linux
+        record["peak_cpu_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+        if pl_module.device.type == "cuda":
+            record["peak_gpu_mb"] = torch.cuda.max_memory_allocated(pl_module.device) / 2 ** 20
+        self.records.append(record)
+        self.steps += 1
+        if self.profiler is not None:
+            self.profiler.step()
+            if self.steps >= self.trace_start + self.trace_steps:
+                self._stop_trace()
+        if len(self.records) >= self.flush_every:
+            self._flush(trainer)
+
+    def on_train_end(self, trainer, pl_module):
+        self._stop_trace()
+        self._flush(trainer)
+
+    def _flush(self, trainer) -> None:
+        if not self.records:
+            return
+        records, self.records = self.records, []
+        for record in records:  # one sync per flush instead of one per step
+            for key in ["src_tokens", "tgt_tokens"]:
+                record[key] = int(record[key])
+            record["src_pad_frac"] = 1 - record["src_tokens"] / record.pop("src_slots")
+            record["tgt_pad_frac"] = 1 - record["tgt_tokens"] / record.pop("tgt_slots")
+            record["src_tokens_per_s"] = record["src_tokens"] / record["step_s"]
+            record["tgt_tokens_per_s"] = record["tgt_tokens"] / record["step_s"]
+        with open(self.path, "a") as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+        if trainer.logger is not None and trainer.is_global_zero:
+            keys = [k for k in records[-1] if k != "step"]
+            means = {f"profile/{k}": np.mean([r[k] for r in records if k in r]) for k in keys}
+            trainer.logger.log_metrics(means, step=records[-1]["step"])
+
+    def _start_trace(self) -> None:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self.profiler.start()
+
+    def _stop_trace(self) -> None:
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        trace_path = Path(self.output_dir) / f"trace_rank{self.rank}_step{self.trace_start}.json"
+        self.profiler.export_chrome_trace(str(trace_path))
+        logger.info(f"wrote a profiler trace of steps {self.trace_start}-{self.steps - 1} to {trace_path}")
+        self.profiler = None
+
+
+class SkipStaleValMetric:
+    """Lets ModelCheckpoint/EarlyStopping ignore validation checks that did not recompute the monitored metric.
+
+    With --val_generate_every > 1 most checks only compute the loss; pl_module.val_metric_updated is False after them,
+    and counting the last bleu/rouge2 again would use up the patience or save checkpoints under a score they never had.
+    """
+
+    def on_validation_end(self, trainer, pl_module, *args, **kwargs):
+        if getattr(pl_module, "val_metric_updated", True):
+            super().on_validation_end(trainer, pl_module, *args, **kwargs)
+
+    def on_train_epoch_end(self, trainer, pl_module, *args, **kwargs):
+        if getattr(pl_module, "val_metric_updated", True):
+            super().on_train_epoch_end(trainer, pl_module, *args, **kwargs)
+
+
+class Seq2SeqModelCheckpoint(SkipStaleValMetric, ModelCheckpoint):
+    pass
+
+
+class Seq2SeqEarlyStopping(SkipStaleValMetric, EarlyStopping):
+    pass
+
+
 def get_checkpoint_callback(output_dir, metric, save_top_k=1, lower_is_better=False):
     """Saves the best model by validation ROUGE2 score."""
     if metric == "rouge2":
@@ -98,7 +278,7 @@ def get_checkpoint_callback(output_dir, metric, save_top_k=1, lower_is_better=Fa
             f"seq2seq callbacks only support rouge2, bleu and loss, got {metric}, You can make your own by adding to this function."
         )
 
-    checkpoint_callback = ModelCheckpoint(
+    checkpoint_callback = Seq2SeqModelCheckpoint(
         dirpath=output_dir,
         filename=exp,
         monitor=f"val_{metric}",
@@ -109,7 +289,7 @@ def get_checkpoint_callback(output_dir, metric, save_top_k=1, lower_is_better=Fa
 
 
 def get_early_stopping_callback(metric, patience):
-    return EarlyStopping(
+    return Seq2SeqEarlyStopping(
         monitor=f"val_{metric}",  # does this need avg?
         mode="min" if "loss" in metric else "max",
         patience=patience,
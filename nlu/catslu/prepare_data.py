@@ -1,46 +1,27 @@
-#!/usr/bin/env python3
-
 # Copyright 2021  Sujay Suresh Kumar
 #           2021  Carnegie Mellon University
 # Apache 2.0
 
 import os
-import sys
 from pathlib import Path
 import json
 import string as string_lib
 
-if len(sys.argv) != 3:
-    print("Usage: python data_prep.py [catslu_root] [output_dir]")
-    sys.exit(1)
-
-catslu_root = sys.argv[1]
-odir = sys.argv[2]
 
 BLACKLIST_IDS = ["map-df61ee397d015314dfde80255365428b_4b3d3b2f332793052a000014-1"]
 
 
-catslu_root_path = Path(catslu_root)
-
-catslu_traindev = Path(os.path.join(catslu_root_path, "catslu_traindev", "data"))
-catslu_traindev_domain_dirs = [
-    f for f in catslu_traindev.iterdir() if f.is_dir()  # and f.name == "map"
-]
-
-catslu_test = Path(os.path.join(catslu_root_path, "catslu_test", "data"))
-catslu_test_domain_dirs = [
-    f for f in catslu_test.iterdir() if f.is_dir()  # and f.name == "map"
-]
-
-
-def _process_data(data):
+def parse_file(path):
     global BLACKLIST_IDS
-    sources = []
-    targets = []
+    domain = Path(path).parent.name
+    with open(path) as fp:
+        data = json.load(fp)
+
+    examples = []
     for dialogue in data:
         for utterance in dialogue["utterances"]:
             utt_id = "{}-{}-{}".format(
-                domain_dir.parts[-1], utterance["wav_id"], utterance["utt_id"]
+                domain, utterance["wav_id"], utterance["utt_id"]
             )
 
             manual_transcript = utterance["manual_transcript"]
@@ -63,54 +44,29 @@ def _process_data(data):
 
             # transcript.append(manual_transcript)
 
-            sources.append(manual_transcript + "\n")
             if len(transcript) > 0:
-                targets.append(" SEP ".join(transcript) + "\n")
+                examples.append((manual_transcript, " SEP ".join(transcript)))
             else:
-                targets.append("SEP\n")
-
-    return sources, targets
-
-
-os.makedirs(odir, exist_ok=True)
-
-with open(
-    os.path.join(odir, "train.source"), "w", encoding="utf-8"
-) as train_source_f, open(
-    os.path.join(odir, "train.target"), "w", encoding="utf-8"
-) as train_target_f, open(
-    os.path.join(odir, "val.source"), "w", encoding="utf-8"
-) as dev_source_f, open(
-    os.path.join(odir, "val.target"), "w", encoding="utf-8"
-) as dev_target_f:
-
-    for domain_dir in catslu_traindev_domain_dirs:
-        with open(os.path.join(domain_dir, "train.json")) as fp:
-            train_data = json.load(fp)
-
-        train_sources, train_targets = _process_data(train_data)
-
-        train_source_f.writelines(train_sources)
-        train_target_f.writelines(train_targets)
+                examples.append((manual_transcript, "SEP"))
 
-        with open(os.path.join(domain_dir, "development.json")) as fp:
-            dev_data = json.load(fp)
+    return examples
 
-        dev_sources, dev_targets = _process_data(dev_data)
 
-        dev_source_f.writelines(dev_sources)
-        dev_target_f.writelines(dev_targets)
+def get_subsets(catslu_root):
+    catslu_root_path = Path(catslu_root)
 
-with open(
-    os.path.join(odir, "test.source"), "w", encoding="utf-8"
-) as test_source_f, open(
-    os.path.join(odir, "test.target"), "w", encoding="utf-8"
-) as test_target_f:
-    for domain_dir in catslu_test_domain_dirs:
-        with open(os.path.join(domain_dir, "test.json")) as fp:
-            test_data = json.load(fp)
+    catslu_traindev = Path(os.path.join(catslu_root_path, "catslu_traindev", "data"))
+    catslu_traindev_domain_dirs = [
+        f for f in catslu_traindev.iterdir() if f.is_dir()  # and f.name == "map"
+    ]
 
-        test_sources, test_targets = _process_data(test_data)
+    catslu_test = Path(os.path.join(catslu_root_path, "catslu_test", "data"))
+    catslu_test_domain_dirs = [
+        f for f in catslu_test.iterdir() if f.is_dir()  # and f.name == "map"
+    ]
 
-        test_source_f.writelines(test_sources)
-        test_target_f.writelines(test_targets)
+    return {
+        "train": [os.path.join(domain_dir, "train.json") for domain_dir in catslu_traindev_domain_dirs],
+        "val": [os.path.join(domain_dir, "development.json") for domain_dir in catslu_traindev_domain_dirs],
+        "test": [os.path.join(domain_dir, "test.json") for domain_dir in catslu_test_domain_dirs],
+    }
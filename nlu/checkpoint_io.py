@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""Trainable-only checkpoints, written on a background thread.
+
+With a frozen encoder and embeddings most of a checkpoint never changes. `save_trainable` writes only the tensors
+that require gradients, as safetensors (loaded through mmap), plus `base_model.json` naming the frozen base model and
+the sha1 of its frozen tensors. AsyncCheckpointWriter does the writing on a background thread with a bounded queue;
+AsyncCheckpointIO routes Lightning's own .ckpt files through it. Running this file rebuilds a full HF model:
+
+    python checkpoint_io.py --checkpoint_dir output/best_tfmr --output_dir output/full --verify
+"""
+
+import argparse
+import hashlib
+import os
+import queue
+import threading
+from pathlib import Path
+from typing import Dict
+
+import torch
+
+from utils import load_json, replace_atomic, save_json
+
+
+try:
+    from safetensors.torch import load_file, save_file
+
+    SAFETENSORS_AVAILABLE = True
+except ImportError:
+    SAFETENSORS_AVAILABLE = False
+
+try:
+    from pytorch_lightning.plugins.io import CheckpointIO
+
+    CHECKPOINT_IO_AVAILABLE = True
+except ImportError:  # Lightning < 1.5 writes its .ckpt files itself
+    CheckpointIO = object
+    CHECKPOINT_IO_AVAILABLE = False
+
+
+TRAINABLE_WEIGHTS_NAME = "trainable.safetensors"
+BASE_REFERENCE_NAME = "base_model.json"
+
+
+def snapshot(obj):
+    """A copy of `obj` with every tensor cloned to the CPU, safe to write while training goes on."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def _remove_if_exists(path) -> None:
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class AsyncCheckpointWriter:
+    """Runs write jobs in order on one background thread. At most `max_pending` jobs wait, `submit` blocks beyond
+    that, so snapshots cannot pile up in memory. A failed job is raised by the next `submit` or `flush`."""
+
+    def __init__(self, max_pending=2):
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                fn, args = job
+                fn(*args)
+            except BaseException as e:  # noqa: B902 - re-raised on the training thread
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _raise(self) -> None:
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing a checkpoint failed") from error
+
+    def submit(self, fn, *args) -> None:
+        self._raise()
+        self.jobs.put((fn, args))
+
+    def flush(self) -> None:
+        """Wait until everything submitted is on disk."""
+        self.jobs.join()
+        self._raise()
+
+    def close(self) -> None:
+        self.flush()
+        self.jobs.put(None)
+        self.thread.join()
+
+
+class AsyncCheckpointIO(CheckpointIO):
+    """Lightning CheckpointIO plugin: snapshots the checkpoint on the training thread, writes it on the writer's."""
+
+    def __init__(self, writer: AsyncCheckpointWriter):
+        self.writer = writer
+
+    def save_checkpoint(self, checkpoint, path, storage_options=None) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        checkpoint = snapshot(checkpoint)
+        self.writer.submit(replace_atomic, lambda p: torch.save(checkpoint, p), path)
+
+    def load_checkpoint(self, path, map_location=None):
+        self.writer.flush()
+        return torch.load(path, map_location=map_location or (lambda storage, loc: storage))
+
+    def remove_checkpoint(self, path) -> None:
+        # queued behind the write of `path`, in case that is still pending
+        self.writer.submit(_remove_if_exists, path)
+
+
+def frozen_sha1(model, keys) -> str:
+    state_dict = model.state_dict()
+    sha = hashlib.sha1()
+    for key in sorted(keys):
+        sha.update(key.encode())
+        sha.update(state_dict[key].detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()
+
+
+def trainable_state_dict(model) -> Dict[str, torch.Tensor]:
+    return {name: p for name, p in model.named_parameters() if p.requires_grad}
+
+
+def _write_base_reference(model, path, base_model_name_or_path, frozen_keys) -> None:
+    if path.exists() and load_json(path)["base_model_name_or_path"] == base_model_name_or_path:
+        return  # the frozen tensors are the same for the whole run, hash them once
+    reference = {
+        "base_model_name_or_path": base_model_name_or_path,
+        "frozen_keys": frozen_keys,
+        "frozen_sha1": frozen_sha1(model, frozen_keys),
+    }
+    replace_atomic(lambda p: save_json(reference, p), path)
+
+
+def save_trainable(model, save_directory, base_model_name_or_path, writer: AsyncCheckpointWriter) -> None:
+    """Write the trainable tensors of `model` and a reference to its frozen base to `save_directory`."""
+    if not SAFETENSORS_AVAILABLE:
+        raise ImportError("trainable-only checkpoints need safetensors: `pip install safetensors`")
+    save_directory = Path(save_directory)
+    save_directory.mkdir(parents=True, exist_ok=True)
+    model.config.save_pretrained(save_directory)
+    trainable = trainable_state_dict(model)
+    frozen_keys = [k for k in model.state_dict() if k not in trainable]
+    tensors = {k: v.contiguous() for k, v in snapshot(trainable).items()}
+    writer.submit(
+        _write_base_reference, model, save_directory / BASE_REFERENCE_NAME, base_model_name_or_path, frozen_keys
+    )
+    writer.submit(replace_atomic, lambda p: save_file(tensors, p), save_directory / TRAINABLE_WEIGHTS_NAME)
+
+
+def load_trainable(save_directory, model=None, verify=False):
+    """The model saved by save_trainable: its base, with the saved trainable tensors loaded on top."""
+    from transformers import AutoModelForSeq2SeqLM
+
+    save_directory = Path(save_directory)
+    reference = load_json(save_directory / BASE_REFERENCE_NAME)
+    if model is None:
+        model = AutoModelForSeq2SeqLM.from_pretrained(reference["base_model_name_or_path"])
+    if verify and frozen_sha1(model, reference["frozen_keys"]) != reference["frozen_sha1"]:
+        raise ValueError(f"the frozen weights of {reference['base_model_name_or_path']} changed since the checkpoint")
+    missing, unexpected = model.load_state_dict(load_file(save_directory / TRAINABLE_WEIGHTS_NAME), strict=False)
+    assert not unexpected, f"unexpected weights: {unexpected}"
+    return model
+
+
+def main(args):
+    from prune_vocab import load_tokenizer
+
+    model = load_trainable(args.checkpoint_dir, verify=args.verify)
+    model.save_pretrained(args.output_dir)
+    load_tokenizer(args.checkpoint_dir).save_pretrained(args.output_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild a full model from a --trainable_checkpoints directory")
+    parser.add_argument("--checkpoint_dir", type=str, required=True, help="best_tfmr of a --trainable_checkpoints run")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--verify", action="store_true", help="Check the base model against the stored hash")
+    main(parser.parse_args())
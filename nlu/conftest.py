@@ -0,0 +1,56 @@
+"""Data, models and options shared by the tests.
+
+Only pytest is imported at module level and the fixtures import what they use, so collecting a test module imports
+no more than the module itself does.
+"""
+
+from pathlib import Path
+
+import pytest
+
+
+MBART_TINY = "sshleifer/tiny-mbart"
+SOURCES = ["turn on the lights", "wake me up at seven", "what is the weather like in paris tomorrow", "play jazz"]
+TARGETS = ["iot_hue_lighton", "alarm_set SEP time FILL seven", "weather_query SEP place_name FILL paris", "play_music"]
+
+
+def pytest_addoption(parser):
+    parser.addoption("--runslow", action="store_true", default=False, help="Also run the tests marked slow")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: wall-clock benchmarks, skipped unless --runslow is given")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--runslow"):
+        return
+    skip_slow = pytest.mark.skip(reason="needs --runslow")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip_slow)
+
+
+def make_data_dir(data_dir: Path, n_copies=3, type_paths=("train", "val")) -> Path:
+    """{type_path}.source/.target of SOURCES and TARGETS repeated `n_copies` times."""
+    data_dir.mkdir(parents=True, exist_ok=True)
+    for type_path in type_paths:
+        data_dir.joinpath(f"{type_path}.source").write_text("".join(x + "\n" for x in SOURCES * n_copies))
+        data_dir.joinpath(f"{type_path}.target").write_text("".join(x + "\n" for x in TARGETS * n_copies))
+    return data_dir
+
+
+@pytest.fixture(scope="session")
+def tokenizer():
+    from prune_vocab import load_tokenizer
+
+    return load_tokenizer(MBART_TINY)
+
+
+@pytest.fixture
+def shared_array_dir(tmp_path, monkeypatch):
+    """Keep the arrays of shared_array out of /dev/shm."""
+    import utils
+
+    monkeypatch.setattr(utils, "SHARED_ARRAY_DIR", tmp_path / "shm")
+    return tmp_path / "shm"
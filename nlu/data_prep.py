@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Shared driver of the */prepare_data.py scripts: `../data_prep.py prepare_data.py /path/to/corpus data`.
+
+A corpus script defines `parse_file(path)`, returning the (source, target) examples of one input file, and
+`get_subsets(idir)`, mapping each subset to its input files under the corpus directory.
+"""
+
+import argparse
+import hashlib
+import importlib
+import json
+import sys
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+from utils import file_sha1, replace_atomic
+
+
+Example = Tuple[str, str]  # (source, target)
+
+
+def write_lines(path, lines: List[str]) -> None:
+    def write(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(line + "\n" for line in lines)
+
+    replace_atomic(write, path)
+
+
+def _parse_to_cache(args) -> None:
+    parse_file, path, cache_file = args
+    examples = parse_file(path)
+
+    def write(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(examples, f, ensure_ascii=False)
+
+    replace_atomic(write, cache_file)
+
+
+def prepare_data(
+    subsets: Dict[str, List[str]],
+    parse_file: Callable[[str], List[Example]],
+    odir,
+    num_workers=None,
+    cache_dir=None,
+) -> None:
+    """Write {subset}.source and {subset}.target to `odir` from the examples `parse_file` returns for each input file.
+
+    Input files are parsed across `num_workers` processes, `parse_file` must be a module-level function. The examples
+    of each input file are cached in `cache_dir` (default: odir/.cache) under a hash of the file and of the script
+    defining `parse_file`, so only inputs that changed since the last run are parsed again. Cached files of the same
+    script for keys this run did not use, left by older versions of the inputs or of the script, are deleted; the
+    file names start with a hash of the script path, so corpora may share a cache_dir.
+    """
+    odir = Path(odir)
+    odir.mkdir(parents=True, exist_ok=True)
+    cache_dir = Path(cache_dir) if cache_dir is not None else odir / ".cache"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    script = Path(sys.modules[parse_file.__module__].__file__).resolve()
+    script_key = hashlib.sha1(str(script).encode()).hexdigest()
+    script_sha = file_sha1(script)
+
+    cache_files = {}
+    for path in sorted(set(path for paths in subsets.values() for path in paths)):
+        key = hashlib.sha1((script_sha + file_sha1(path)).encode()).hexdigest()
+        cache_files[path] = cache_dir / f"{script_key}.{key}.json"
+    todo = [(parse_file, path, cache_file) for path, cache_file in cache_files.items() if not cache_file.exists()]
+    if todo:
+        with Pool(num_workers) as pool:
+            pool.map(_parse_to_cache, todo, chunksize=1)
+    print(f"parsed {len(todo)} of {len(cache_files)} input files, the others were unchanged")
+    for stale in set(cache_dir.glob(f"{script_key}.*.json")) - set(cache_files.values()):
+        stale.unlink()
+
+    for subset, paths in subsets.items():
+        examples = []
+        for path in paths:
+            with open(cache_files[path], encoding="utf-8") as f:
+                examples += json.load(f)
+        write_lines(odir / f"{subset}.source", [source for source, _ in examples])
+        write_lines(odir / f"{subset}.target", [target for _, target in examples])
+
+
+def load_corpus_script(path):
+    """Import a */prepare_data.py script as a module of its own name, so Pool workers can unpickle its parse_file."""
+    path = Path(path).resolve()
+    sys.path.insert(0, str(path.parent))
+    return importlib.import_module(path.stem)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("script", type=str, help="like slurp/prepare_data.py")
+    parser.add_argument("idir", type=str, help="where the corpus was downloaded")
+    parser.add_argument("odir", type=str, help="where to write {subset}.source and {subset}.target")
+    parser.add_argument("--num_workers", type=int, default=None, help="parsing processes, default: all CPUs")
+    args = parser.parse_args()
+    corpus = load_corpus_script(args.script)
+    prepare_data(corpus.get_subsets(args.idir), corpus.parse_file, args.odir, num_workers=args.num_workers)
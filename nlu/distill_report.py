@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""Speed/accuracy trade-off of distilled students against their teacher.
+
+Every model generates for the same source file with run_eval.generate, timed after a warm-up batch, and the
+predictions are scored by the corpus' own evaluate.py, whose output is reported as is:
+
+    python distill_report.py --corpus_dir slurp --models akreal/mbart-large-50-finetuned-slurp \
+        slurp/distilled-d3/best_tfmr slurp/distilled-d1/best_tfmr --src_lang en_XX --tgt_lang en_XX \
+        --output_dir slurp/distill_report
+
+The first model is the reference for the speedups. Results go to output_dir/report.json and are printed as a table.
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import torch
+
+from fast_load import load_seq2seq_model
+from prune_vocab import load_tokenizer
+from run_eval import generate
+from utils import save_json
+
+
+def evaluate(corpus_dir: Path, ref_path: Path, hyp_path: Path, *extra_args: str) -> str:
+    command = [sys.executable, "evaluate.py", str(ref_path.resolve()), str(hyp_path.resolve()), *extra_args]
+    return subprocess.run(command, cwd=corpus_dir, check=True, capture_output=True, text=True).stdout.strip()
+
+
+def time_generate(model, tokenizer, lines: List[str], args) -> Tuple[float, List[str]]:
+    """Seconds per example and the predictions."""
+    generate(model, tokenizer, lines[: args.bs], args)  # warm-up
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    t0 = time.perf_counter()
+    preds = generate(model, tokenizer, lines, args)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t0) / len(lines), preds
+
+
+def report_model(name_or_path: str, lines: List[str], args) -> Dict:
+    tokenizer = load_tokenizer(name_or_path)
+    model = load_seq2seq_model(name_or_path, device=args.device)
+    seconds, preds = time_generate(model, tokenizer, lines, args)
+    hyp_path = Path(args.output_dir) / f"{name_or_path.strip('/').replace('/', '_')}.{args.type_path}_generations.txt"
+    hyp_path.write_text("\n".join(preds) + "\n")
+    result = {
+        "model": name_or_path,
+        "encoder_layers": model.config.encoder_layers,
+        "decoder_layers": model.config.decoder_layers,
+        "params_m": sum(p.numel() for p in model.parameters()) / 1e6,
+        "ms_per_example": 1000 * seconds,
+        "generations": str(hyp_path),
+        "evaluate": evaluate(Path(args.corpus_dir), Path(args.ref_path), hyp_path),
+    }
+    del model
+    if args.device.startswith("cuda"):
+        torch.cuda.empty_cache()
+    return result
+
+
+def main(args):
+    data_dir = Path(args.corpus_dir) / "data"
+    args.ref_path = args.ref_path or str(data_dir / f"{args.type_path}.target")
+    with open(args.src_path or data_dir / f"{args.type_path}.source") as f:
+        lines = [x.rstrip("\n") for x in f][: args.n_obs]
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+
+    results = [report_model(name_or_path, lines, args) for name_or_path in args.models]
+    for result in results:
+        result["speedup"] = results[0]["ms_per_example"] / result["ms_per_example"]
+    save_json(results, Path(args.output_dir) / "report.json")
+
+    print("| model | enc/dec layers | params (M) | ms/example | speedup | evaluate.py |")
+    print("|--|--|--|--|--|--|")
+    for r in results:
+        scores = r["evaluate"].replace("\n", "<br>")
+        print(
+            f"| {r['model']} | {r['encoder_layers']}/{r['decoder_layers']} | {r['params_m']:.0f} "
+            f"| {r['ms_per_example']:.1f} | {r['speedup']:.2f}x | {scores} |"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the speed and accuracy of a teacher and its students")
+    parser.add_argument("--corpus_dir", type=str, required=True, help="e.g. slurp, with data/ and evaluate.py")
+    parser.add_argument("--models", type=str, nargs="+", required=True, help="Teacher first, then the students")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--type_path", type=str, default="test")
+    parser.add_argument("--src_path", type=str, default=None, help="Default: corpus_dir/data/{type_path}.source")
+    parser.add_argument("--ref_path", type=str, default=None, help="Default: corpus_dir/data/{type_path}.target")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--bs", type=int, default=32, help="Batch size")
+    parser.add_argument("--src_lang", type=str, default="")
+    parser.add_argument("--tgt_lang", type=str, default="")
+    parser.add_argument("--max_source_length", type=int, default=128)
+    parser.add_argument("--max_length", type=int, default=128, help="Maximum length of the generated sequences")
+    parser.add_argument("--num_beams", type=int, default=None)
+    parser.add_argument("--n_obs", type=int, default=None, help="Only use the first n examples")
+    main(parser.parse_args())
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+# Adopted from https://github.com/huggingface/transformers/blob/88e84186e5a0d5dd78b62b1a8e97b2c269426442/examples/research_projects/seq2seq-distillation/distillation.py
+
+import argparse
+import gc
+import os
+from pathlib import Path
+from typing import List, Tuple
+
+import pytorch_lightning as pl
+import torch
+from torch import nn
+
+from finetune import SummarizationModule, TranslationModule
+from finetune import main as ft_main
+from make_student import create_student_by_copying_alternating_layers, get_layers_to_supervise
+from transformers import AutoModelForSeq2SeqLM, MBartTokenizer
+from transformers.models.bart.modeling_bart import shift_tokens_right
+from utils import calculate_bleu, check_output_dir, freeze_params, label_smoothed_nll_loss, use_task_specific_params
+
+
+class SummarizationDistiller(SummarizationModule):
+    """Trains a student made of alternating layers of a BART-family teacher (make_student.py) on the teacher's logits,
+    the labels and, with --alpha_hid, the hidden states of the teacher layers matched to its layers."""
+
+    loss_names = ["loss", "ce_loss", "mlm_loss", "hid_loss_enc", "hid_loss_dec"]
+
+    def __init__(self, hparams):
+        assert Path(hparams.data_dir).exists()
+        for flag in ["pack_sequences", "cache_encoder_outputs", "trainable_checkpoints"]:
+            if getattr(hparams, flag):
+                raise ValueError(f"--{flag} is not supported by distillation.py")
+        if hparams.loss_chunk_size > 0 or hparams.lora_rank > 0:
+            raise ValueError("--loss_chunk_size and --lora_rank are not supported by distillation.py")
+        self.output_dir = Path(hparams.output_dir)
+        self.output_dir.mkdir(exist_ok=True)
+        save_dir = self.output_dir.joinpath("student")
+
+        hparams.model_name_or_path = str(save_dir)  # Tell lightning we are training the student
+        teacher = AutoModelForSeq2SeqLM.from_pretrained(hparams.teacher).eval()
+        use_task_specific_params(teacher, hparams.task)  # We copy good generation parameters to student by default
+        student, e_layer_ids, d_layer_ids = create_student_by_copying_alternating_layers(
+            teacher, save_dir, e=hparams.student_encoder_layers, d=hparams.student_decoder_layers
+        )
+        if hparams.length_penalty != -1:
+            student.config.length_penalty = hparams.length_penalty
+        hparams.tokenizer_name = hparams.teacher  # Use teacher's tokenizer
+        super().__init__(hparams, model=student, config=student.config)
+
+        teacher_encoder_layers, teacher_decoder_layers = teacher.config.encoder_layers, teacher.config.decoder_layers
+        self.do_calc_hidden_loss = hparams.alpha_hid > 0
+        # with the teacher's encoder layers the student's encoder outputs stand in for the teacher's, exactly so
+        # with --freeze_encoder
+        self.different_encoder = len(e_layer_ids) != teacher_encoder_layers
+        self.teacher = teacher
+        freeze_params(self.teacher)
+        if not self.different_encoder:  # To save RAM, delete teacher encoder
+            del self.teacher.model.encoder
+
+        self.e_layer_ids, self.d_layer_ids = e_layer_ids, d_layer_ids
+        if hparams.supervise_forward:
+            self.e_matches = get_layers_to_supervise(n_student=len(e_layer_ids), n_teacher=teacher_encoder_layers)
+            self.d_matches = get_layers_to_supervise(n_student=len(d_layer_ids), n_teacher=teacher_decoder_layers)
+        else:  # student layer should emulate hidden states of the teacher layer it was copied from
+            self.e_matches = self.e_layer_ids
+            self.d_matches = self.d_layer_ids
+
+        self.ce_loss_fct = nn.KLDivLoss(reduction="batchmean")
+        self.temperature = hparams.temperature
+        self.alpha_mlm = hparams.alpha_mlm
+        self.alpha_ce = hparams.alpha_ce
+        self.alpha_hid = hparams.alpha_hid
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def train(self, mode: bool = True):
+        super().train(mode)
+        self.teacher.eval()  # Lightning switches every submodule to train mode each epoch
+        return self
+
+    def on_save_checkpoint(self, checkpoint) -> None:
+        super().on_save_checkpoint(checkpoint)
+        # the teacher is hparams.teacher, unchanged
+        checkpoint["state_dict"] = {k: v for k, v in checkpoint["state_dict"].items() if not k.startswith("teacher.")}
+
+    def on_load_checkpoint(self, checkpoint) -> None:
+        teacher_state = {k: v for k, v in self.state_dict().items() if k.startswith("teacher.")}
+        checkpoint["state_dict"] = {**teacher_state, **checkpoint["state_dict"]}
+        super().on_load_checkpoint(checkpoint)
+
+    def calc_ce_loss(self, mask, s_logits, t_logits):
+        """Copy pasted from distillbert (transformers/examples/distillation/)"""
+        # mask has False at padding_idx
+        s_logits_slct = s_logits[mask].float()  # (bs * seq_length, voc_size) modulo the 1s in mask
+        t_logits_slct = t_logits[mask].float()
+        assert t_logits_slct.size() == s_logits_slct.size()
+        loss_ce = (
+            self.ce_loss_fct(
+                nn.functional.log_softmax(s_logits_slct / self.temperature, dim=-1),
+                nn.functional.softmax(t_logits_slct / self.temperature, dim=-1),
+            )
+            * (self.temperature) ** 2
+        )
+        return loss_ce
+
+    @staticmethod
+    def add_model_specific_args(parser, root_dir):
+        SummarizationModule.add_model_specific_args(parser, root_dir)
+        add_distill_args(parser)
+        return parser
+
+    def _step(self, batch: dict, encoder_outputs=None) -> Tuple:
+        """Compute the loss for a batch"""
+        pad_token_id = self.tokenizer.pad_token_id
+        input_ids, src_mask, labels = batch["input_ids"], batch["attention_mask"], batch["labels"]
+        decoder_input_ids = shift_tokens_right(labels, pad_token_id, self.model.config.decoder_start_token_id)
+        if not self.already_saved_batch:
+            batch["decoder_input_ids"] = decoder_input_ids
+            self.save_readable_batch(batch)
+
+        # noinspection PyCallingNonCallable
+        student_outputs = self(
+            input_ids,
+            attention_mask=src_mask,
+            decoder_input_ids=decoder_input_ids,
+            encoder_outputs=encoder_outputs,
+            output_hidden_states=self.do_calc_hidden_loss,
+            output_attentions=False,
+            use_cache=False,
+        )
+        lm_logits = student_outputs["logits"]
+
+        # Same cross entropy vs. label smoothing logic as finetune.py
+        assert lm_logits.shape[-1] == self.model.config.vocab_size
+        if self.hparams.label_smoothing == 0:
+            # Same behavior as modeling_bart.py, besides ignoring pad_token_id
+            loss_fct = nn.CrossEntropyLoss(ignore_index=pad_token_id)
+            student_lm_loss = loss_fct(lm_logits.view(-1, lm_logits.shape[-1]), labels.view(-1))
+        else:
+            lprobs = nn.functional.log_softmax(lm_logits, dim=-1)
+            student_lm_loss, _ = label_smoothed_nll_loss(
+                lprobs, labels, self.hparams.label_smoothing, ignore_index=pad_token_id
+            )
+
+        def zero_tensor():
+            return torch.tensor(0.0).type_as(student_lm_loss)
+
+        hid_loss_enc, hid_loss_dec = zero_tensor(), zero_tensor()
+        with torch.no_grad():
+            teacher_enc_outputs = student_outputs["encoder_last_hidden_state"].detach()
+            if self.different_encoder:  # compute encoder outputs
+                all_teacher_encoder_outputs = self.teacher.get_encoder()(
+                    input_ids,
+                    attention_mask=src_mask,
+                    output_hidden_states=self.do_calc_hidden_loss,
+                )
+                teacher_enc_outputs = all_teacher_encoder_outputs["last_hidden_state"]
+            teacher_outputs = self.teacher(
+                input_ids,
+                attention_mask=src_mask,
+                encoder_outputs=(teacher_enc_outputs,),
+                decoder_input_ids=decoder_input_ids,
+                output_hidden_states=self.do_calc_hidden_loss,
+                use_cache=False,  # since we are not passing labels, never let this default to True
+            )
+        # student encoder states are missing when validation passes in encoder outputs it computed for generate
+        if self.different_encoder and self.do_calc_hidden_loss and student_outputs["encoder_hidden_states"]:
+            hid_loss_enc = self.calc_hidden_loss(
+                src_mask,
+                student_outputs["encoder_hidden_states"],
+                all_teacher_encoder_outputs["hidden_states"],
+                self.e_matches,
+                normalize_hidden=self.hparams.normalize_hidden,
+            )
+
+        loss_ce = self.calc_ce_loss(labels.ne(pad_token_id), lm_logits, teacher_outputs["logits"])
+        if self.do_calc_hidden_loss:  # Intermediate supervision of decoder hidden states
+            hid_loss_dec = self.calc_hidden_loss(
+                decoder_input_ids.ne(pad_token_id),
+                student_outputs["decoder_hidden_states"],
+                teacher_outputs["decoder_hidden_states"],
+                self.d_matches,
+                normalize_hidden=self.hparams.normalize_hidden,
+            )
+
+        blended_loss = (
+            self.alpha_ce * loss_ce + self.alpha_mlm * student_lm_loss + self.alpha_hid * (hid_loss_enc + hid_loss_dec)
+        )
+        return blended_loss, loss_ce, student_lm_loss, hid_loss_enc, hid_loss_dec
+
+    @staticmethod
+    def calc_hidden_loss(attention_mask, hidden_states, hidden_states_T, matches: List[int], normalize_hidden):
+        """MSE(student_hid, teacher_hid[matches]). Called "Intermediate supervision" in paper. Inspired by TinyBERT.
+
+        hidden_states[0] is the embedding output, so layer i's output is hidden_states[i + 1].
+        """
+        msg = "expected list or tuple for hidden_states, got tensor of shape: "
+        assert not isinstance(hidden_states, torch.Tensor), f"{msg}{hidden_states.shape}"
+        assert not isinstance(hidden_states_T, torch.Tensor), f"{msg}{hidden_states_T.shape}"
+        mask = attention_mask.to(hidden_states[0])
+        valid_count = mask.sum() * hidden_states[0].size(-1)
+        student_states = torch.stack([hidden_states[i + 1] for i in range(len(matches))]).float()
+        teacher_states = torch.stack([hidden_states_T[j + 1] for j in matches]).float()
+        assert student_states.shape == teacher_states.shape, f"{student_states.shape} != {teacher_states.shape}"
+        if normalize_hidden:
+            student_states = nn.functional.layer_norm(student_states, student_states.shape[-1:])
+            teacher_states = nn.functional.layer_norm(teacher_states, teacher_states.shape[-1:])
+        mse = nn.functional.mse_loss(student_states, teacher_states, reduction="none")
+        masked_mse = (mse * mask.unsqueeze(0).unsqueeze(-1)).sum() / valid_count
+        return masked_mse
+
+
+def add_distill_args(parser):
+    parser.add_argument("--teacher", type=str, required=True, help="e.g. akreal/mbart-large-50-finetuned-slurp")
+    parser.add_argument("--alpha_ce", default=0.8, type=float, help="Weight of the KL divergence to the teacher")
+    parser.add_argument("--alpha_mlm", default=0.2, type=float, help="Weight of the cross entropy with the labels")
+    parser.add_argument("--alpha_hid", default=3.0, type=float, help="Weight of the hidden state MSE, 0 turns it off")
+    parser.add_argument("--temperature", default=2.0, type=float)
+    parser.add_argument("--student_decoder_layers", default=3, type=int, required=False)
+    parser.add_argument(
+        "--student_encoder_layers", default=None, type=int, required=False, help="Default: the teacher's"
+    )
+    parser.add_argument("--length_penalty", type=float, default=-1)
+    parser.add_argument(
+        "--supervise_forward",
+        action="store_true",
+        default=False,
+        help="Match student layers to evenly spaced teacher layers instead of the ones they were copied from",
+    )
+    parser.add_argument("--normalize_hidden", action="store_true", default=False)
+
+
+class TranslationDistiller(SummarizationDistiller):
+    """Supports mBART and other models that inherit from Bart."""
+
+    mode = "translation"
+    metric_names = ["bleu"]
+    default_val_metric = "bleu"
+
+    def __init__(self, hparams, **kwargs):
+        super().__init__(hparams, **kwargs)
+        assert hparams.src_lang is not None
+        assert hparams.tgt_lang is not None
+        self.dataset_kwargs["src_lang"] = hparams.src_lang
+        self.dataset_kwargs["tgt_lang"] = hparams.tgt_lang
+        if self.model.config.decoder_start_token_id is None and isinstance(self.tokenizer, MBartTokenizer):
+            self.decoder_start_token_id = self.tokenizer.lang_code_to_id[hparams.tgt_lang]
+
+    def calc_generative_metrics(self, preds, target) -> dict:
+        return calculate_bleu(preds, target)
+
+    @staticmethod
+    def add_model_specific_args(parser, root_dir):
+        TranslationModule.add_model_specific_args(parser, root_dir)
+        add_distill_args(parser)
+        return parser
+
+
+def distill_main(args):
+    Path(args.output_dir).mkdir(exist_ok=True)
+    check_output_dir(args, expected_items=3)
+
+    module_cls = TranslationDistiller if "translation" in args.task else SummarizationDistiller
+    model = module_cls(args)
+    return ft_main(args, model=model)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser = pl.Trainer.add_argparse_args(parser)
+    parser = SummarizationDistiller.add_model_specific_args(parser, os.getcwd())
+    args = parser.parse_args()
+
+    distill_main(args)
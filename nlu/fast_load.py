@@ -0,0 +1,78 @@
+"""Fast loading of seq2seq models for evaluation and inference.
+
+`load_seq2seq_model` builds the model on the meta device, so no fp32 weights are allocated and initialized only to
+be overwritten, and assigns the tensors of `model.safetensors`, read through mmap, directly to it. Directories
+saved by save_pretrained of transformers <= 4.19 only have pytorch_model.bin; `write_safetensors` adds the file
+(`python run_eval.py --write_safetensors MODEL_DIR`). Without it, loading falls back to from_pretrained with
+low_cpu_mem_usage.
+"""
+
+import inspect
+import itertools
+from pathlib import Path
+from typing import Optional
+
+import torch
+
+
+try:
+    from safetensors.torch import load_file, save_file
+
+    SAFETENSORS_AVAILABLE = True
+except ImportError:
+    SAFETENSORS_AVAILABLE = False
+
+
+SAFETENSORS_WEIGHTS_NAME = "model.safetensors"
+# `with torch.device("meta")` needs torch >= 2.0, load_state_dict(..., assign=True) torch >= 2.1
+META_DEVICE_AVAILABLE = "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+
+
+def safetensors_path(model_name_or_path) -> Optional[Path]:
+    """model.safetensors of a local model directory, if it has one and it can be used."""
+    path = Path(model_name_or_path) / SAFETENSORS_WEIGHTS_NAME
+    return path if SAFETENSORS_AVAILABLE and META_DEVICE_AVAILABLE and path.is_file() else None
+
+
+def load_seq2seq_model(model_name_or_path, config=None, device="cpu", dtype: Optional[torch.dtype] = None, **kwargs):
+    """AutoModelForSeq2SeqLM.from_pretrained(model_name_or_path), in eval mode on `device`, in `dtype` if given."""
+    from transformers import AutoConfig, AutoModelForSeq2SeqLM
+
+    path = safetensors_path(model_name_or_path)
+    if path is None:
+        model = AutoModelForSeq2SeqLM.from_pretrained(
+            model_name_or_path, config=config, low_cpu_mem_usage=True, torch_dtype=dtype, **kwargs
+        )
+        return model.to(device).eval()
+
+    if config is None:
+        config = AutoConfig.from_pretrained(model_name_or_path, **kwargs)
+    with torch.device("meta"):
+        model = AutoModelForSeq2SeqLM.from_config(config)
+    state_dict = load_file(path, device=str(device))
+    if dtype is not None:
+        state_dict = {k: v.to(dtype) if v.is_floating_point() else v for k, v in state_dict.items()}
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()  # write_safetensors keeps one name of each shared tensor
+    on_meta = [name for name, t in itertools.chain(model.named_parameters(), model.named_buffers()) if t.is_meta]
+    if on_meta:
+        raise ValueError(f"{path} has no weights for {on_meta}")
+    return model.eval()
+
+
+def write_safetensors(model_dir) -> Path:
+    """Add model.safetensors, with the weights of the model saved in `model_dir`, to that directory."""
+    from transformers import AutoModelForSeq2SeqLM
+
+    if not SAFETENSORS_AVAILABLE:
+        raise ImportError("fast loading needs safetensors: `pip install safetensors`")
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_dir)
+    # safetensors refuses tensors sharing memory, tied embeddings are stored once and tied again on loading
+    state_dict, seen = {}, set()
+    for name, tensor in model.state_dict().items():
+        if tensor.data_ptr() not in seen:
+            seen.add(tensor.data_ptr())
+            state_dict[name] = tensor.contiguous()
+    path = Path(model_dir) / SAFETENSORS_WEIGHTS_NAME
+    save_file(state_dict, path, metadata={"format": "pt"})
+    return path
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""Batch sizes that fit a memory budget, from the corpus' own length distribution.
+
+Lightning's --auto_scale_batch_size doubles the number of examples until a batch of whatever lengths it happens to
+draw runs out of memory, it misses the rare long utterances and the memory of beam search. This runs synthetic
+training steps (forward, backward, AdamW step) at quantiles of the token lengths of the training data for growing
+batch sizes, fits the peak memory as
+
+    peak = c0 + c_src * batch * src_len + c_tgt * batch * tgt_len + c_batch * batch
+
+and does the same for `generate` with beam search at the longest source length. From the fits it recommends
+--max_tokens_per_batch (every length quantile fits), --train_batch_size (a batch of the longest examples fits) and
+--eval_batch_size. Peak memory is the CUDA allocator's on GPU and the peak RSS on CPU (Linux only):
+
+    python find_batch_size.py --model_name_or_path facebook/mbart-large-50-many-to-many-mmt --data_dir slurp/data \
+        --freeze_encoder --freeze_embeds --memory_budget_mb 30000
+
+The token lengths are those of make_len_file.py (computed here if train.len is missing or stale).
+"""
+
+import argparse
+import json
+import math
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import torch
+
+from precision import autocast, check_amp_dtype
+from prune_vocab import load_tokenizer
+from transformers import AutoModelForSeq2SeqLM
+from utils import build_len_file, freeze_embeds, freeze_params
+
+
+def _read_proc_kb(path: str, key: str) -> int:
+    with open(path) as f:
+        for line in f:
+            if line.startswith(key + ":"):
+                return int(line.split()[1])
+    raise KeyError(f"{key} not in {path}")
+
+
+def reset_peak_memory(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")  # resets VmHWM, the peak RSS
+
+
+def peak_memory_mb(device: torch.device) -> float:
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return _read_proc_kb("/proc/self/status", "VmHWM") / 2 ** 10
+
+
+def default_budget_mb(device: torch.device) -> float:
+    """90% of the GPU's memory, or of what this process has plus what is still available on the machine."""
+    if device.type == "cuda":
+        return 0.9 * torch.cuda.get_device_properties(device).total_memory / 2 ** 20
+    available = _read_proc_kb("/proc/meminfo", "MemAvailable") + _read_proc_kb("/proc/self/status", "VmRSS")
+    return 0.9 * available / 2 ** 10
+
+
+def is_oom(e: RuntimeError) -> bool:
+    return "out of memory" in str(e)
+
+
+def measure(fn: Callable[[], None], device: torch.device) -> float:
+    """Peak memory of `fn()` in MB, or inf if it ran out of memory."""
+    reset_peak_memory(device)
+    try:
+        fn()
+    except RuntimeError as e:
+        if not is_oom(e):
+            raise
+        return math.inf
+    finally:
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+    return peak_memory_mb(device)
+
+
+def length_quantiles(lens: np.ndarray, quantiles: List[float], max_lens: Tuple[int, int]) -> List[Tuple[int, int]]:
+    """(src_len, tgt_len) at each quantile, each clipped to its maximum length, without duplicates."""
+    pairs = np.ceil(np.quantile(lens, quantiles, axis=1)).astype(int)  # (Q, 2)
+    pairs = np.minimum(pairs, max_lens)
+    return sorted({(int(s), int(t)) for s, t in pairs})
+
+
+def fit(features: List[List[float]], peaks: List[float]) -> np.ndarray:
+    coefficients, *_ = np.linalg.lstsq(np.array(features, dtype=float), np.array(peaks), rcond=None)
+    return np.maximum(coefficients, 0)
+
+
+def max_batch(coefficients: np.ndarray, per_example: List[float], budget: float) -> int:
+    """Largest batch size whose predicted peak, c0 + batch * (per_example . c[1:]), fits the budget."""
+    slope = float(np.dot(coefficients[1:], per_example))
+    if slope <= 0:
+        raise ValueError("memory does not grow with the batch size, measure larger batches (--max_batch_size)")
+    return max(0, int((budget - coefficients[0]) // slope))
+
+
+def find_batch_sizes(args) -> Dict:
+    device = torch.device(args.device)
+    check_amp_dtype(args.amp_dtype, on_gpu=device.type == "cuda")
+    budget = args.memory_budget_mb or default_budget_mb(device)
+    tokenizer = load_tokenizer(args.model_name_or_path)
+    lens = build_len_file(tokenizer, args.data_dir, args.type_path)
+    pairs = length_quantiles(lens, args.quantiles, (args.max_source_length, args.max_target_length))
+
+    model = AutoModelForSeq2SeqLM.from_pretrained(args.model_name_or_path).to(device)
+    if args.freeze_embeds:
+        freeze_embeds(model)
+    if args.freeze_encoder:
+        freeze_params(model.get_encoder())
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=0.0)
+    low, high = 4, model.config.vocab_size  # no special tokens
+
+    def train_step(batch_size: int, src_len: int, tgt_len: int) -> None:
+        input_ids = torch.randint(low, high, (batch_size, src_len), device=device)
+        labels = torch.randint(low, high, (batch_size, tgt_len), device=device)
+        model.train()
+        with autocast(args.amp_dtype, device):
+            loss = model(input_ids, attention_mask=torch.ones_like(input_ids), labels=labels).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+    def generate(batch_size: int, src_len: int) -> None:
+        input_ids = torch.randint(low, high, (batch_size, src_len), device=device)
+        model.eval()
+        with torch.no_grad(), autocast(args.amp_dtype, device):
+            # min_length keeps every beam going for max_length steps, the worst case
+            model.generate(
+                input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                num_beams=args.num_beams,
+                max_length=args.eval_max_length,
+                min_length=args.eval_max_length,
+            )
+
+    train_step(1, *pairs[0])  # creates the optimizer state, part of c0
+    train_features, train_peaks, probes = [], [], []
+    for src_len, tgt_len in pairs:
+        batch_size = 1
+        while batch_size <= args.max_batch_size:
+            peak = measure(lambda: train_step(batch_size, src_len, tgt_len), device)
+            probe = {"kind": "train", "batch_size": batch_size, "src_len": src_len, "tgt_len": tgt_len}
+            probes.append({**probe, "peak_mb": peak})
+            if peak > budget:
+                optimizer.zero_grad(set_to_none=True)  # left over if backward ran out of memory
+                break
+            train_features.append([1, batch_size * src_len, batch_size * tgt_len, batch_size])
+            train_peaks.append(peak)
+            batch_size *= 2
+        print(f"src_len {src_len}, tgt_len {tgt_len}: measured up to batch size {batch_size}")
+
+    eval_features, eval_peaks = [], []
+    longest_src = max(src_len for src_len, _ in pairs)
+    batch_size = 1
+    while batch_size <= args.max_batch_size:
+        peak = measure(lambda: generate(batch_size, longest_src), device)
+        probes.append({"kind": "generate", "batch_size": batch_size, "src_len": longest_src, "peak_mb": peak})
+        if peak > budget:
+            break
+        eval_features.append([1, batch_size])
+        eval_peaks.append(peak)
+        batch_size *= 2
+    if len(train_peaks) < 4 or len(eval_peaks) < 2:
+        raise ValueError(f"too few measurements fit {budget:.0f} MB to fit the memory model, see {probes}")
+
+    train_fit = fit(train_features, train_peaks)
+    eval_fit = fit(eval_features, eval_peaks)
+    # TokenBudgetBatchSampler charges (longest source + longest target) * batch size
+    max_tokens = min(
+        max_batch(train_fit, [src_len, tgt_len, 1], budget) * (src_len + tgt_len) for src_len, tgt_len in pairs
+    )
+    longest = max(pairs, key=lambda pair: train_fit[1] * pair[0] + train_fit[2] * pair[1])
+    return {
+        "memory_budget_mb": budget,
+        "length_quantiles": dict(zip(map(str, args.quantiles), map(list, pairs))),
+        "train_fit_mb": dict(zip(["c0", "c_src", "c_tgt", "c_batch"], train_fit.tolist())),
+        "eval_fit_mb": dict(zip(["c0", "c_batch"], eval_fit.tolist())),
+        "max_tokens_per_batch": max_tokens,
+        "train_batch_size": max_batch(train_fit, [longest[0], longest[1], 1], budget),
+        "eval_batch_size": max_batch(eval_fit, [1], budget),
+        "probes": probes,
+    }
+
+
+def main(args):
+    result = find_batch_sizes(args)
+    if args.save_path is not None:
+        with open(args.save_path, "w") as f:
+            json.dump(result, f, indent=4)
+    print(f"memory model (MB): train {result['train_fit_mb']}, generate {result['eval_fit_mb']}")
+    print(
+        f"--max_tokens_per_batch={result['max_tokens_per_batch']} --train_batch_size={result['train_batch_size']} "
+        f"--eval_batch_size={result['eval_batch_size']}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recommend batch sizes for a memory budget")
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--type_path", type=str, default="train")
+    parser.add_argument("--max_source_length", type=int, default=128)
+    parser.add_argument("--max_target_length", type=int, default=128)
+    parser.add_argument("--eval_max_length", type=int, default=128, help="Generation length of the beam search")
+    parser.add_argument("--num_beams", type=int, default=4)
+    parser.add_argument("--freeze_encoder", action="store_true")
+    parser.add_argument("--freeze_embeds", action="store_true")
+    parser.add_argument("--amp_dtype", type=str, default="fp32", choices=["fp32", "fp16", "bf16"])
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--memory_budget_mb", type=float, default=None, help="Default: 90%% of the device's memory")
+    parser.add_argument("--quantiles", type=float, nargs="+", default=[0.5, 0.9, 0.99, 1.0])
+    parser.add_argument("--max_batch_size", type=int, default=512, help="Stop doubling the batch size here")
+    parser.add_argument("--save_path", type=str, default=None, help="Write all measurements as json")
+    main(parser.parse_args())
@@ -16,19 +16,37 @@ import numpy as np
 import pytorch_lightning as pl
 import torch
 from torch import nn
-from torch.utils.data import DataLoader
-
-from callbacks import Seq2SeqLoggingCallback, get_checkpoint_callback, get_early_stopping_callback
+from torch.utils.data import DataLoader, DistributedSampler
+
+from callbacks import (
+    OptimizerMemoryCallback,
+    Seq2SeqLoggingCallback,
+    StepProfilerCallback,
+    get_checkpoint_callback,
+    get_early_stopping_callback,
+)
+from checkpoint_io import AsyncCheckpointIO, AsyncCheckpointWriter, CHECKPOINT_IO_AVAILABLE, save_trainable
+from lora import DEFAULT_TARGET_MODULES, inject_lora, save_lora
+from packing import PackedSeq2SeqCollator, packed_forward, packed_hidden_states, supports_packing
+from precision import loss_parity
 from transformers import MBartTokenizer, T5ForConditionalGeneration
+from transformers.modeling_outputs import BaseModelOutput
 from transformers.models.bart.modeling_bart import shift_tokens_right
 from utils import (
     ROUGE_KEYS,
+    BinarizedSeq2SeqDataset,
+    EncoderOutputCache,
+    EncoderOutputCollator,
     LegacySeq2SeqDataset,
+    MixtureSeq2SeqDataset,
     Seq2SeqDataset,
+    StreamingSeq2SeqDataset,
     assert_all_frozen,
     calculate_bleu,
     calculate_rouge,
     check_output_dir,
+    chunked_label_smoothed_nll_loss,
+    file_sha1,
     flatten_list,
     freeze_embeds,
     freeze_params,
@@ -38,6 +56,8 @@ from utils import (
     pickle_save,
     save_git_info,
     save_json,
+    state_dict_sha1,
+    stratified_subsample,
     use_task_specific_params,
 )
 
@@ -55,15 +75,27 @@ class SummarizationModule(BaseTransformer):
     loss_names = ["loss"]
     metric_names = ROUGE_KEYS
     default_val_metric = "rouge2"
+    token_keys = ["input_ids", "labels", "decoder_input_ids"]
 
     def __init__(self, hparams, **kwargs):
-        if hparams.sortish_sampler and hparams.gpus > 1:
+        if hparams.sortish_sampler and hparams.max_tokens_per_batch is not None:
+            raise ValueError("--sortish_sampler and --max_tokens_per_batch may not be used simultaneously")
+        if hparams.gpus > 1:  # get_dataloader gives every loader a distributed sampler, val/test a sortish one
             hparams.replace_sampler_ddp = False
-        elif hparams.max_tokens_per_batch is not None:
-            if hparams.gpus > 1:
-                raise NotImplementedError("Dynamic Batch size does not work for multi-gpu training")
-            if hparams.sortish_sampler:
-                raise ValueError("--sortish_sampler and --max_tokens_per_batch may not be used simultaneously")
+        if hparams.streaming:
+            if hparams.sortish_sampler or hparams.max_tokens_per_batch is not None or hparams.cache_encoder_outputs:
+                raise ValueError("--streaming batches by length itself and has no example ids")
+            if hparams.streaming_num_examples is None:
+                raise ValueError("--streaming needs --streaming_num_examples for the learning rate schedule")
+            if hparams.mixture:
+                raise ValueError("--streaming and --mixture may not be used simultaneously")
+        if hparams.mixture and (hparams.sortish_sampler or hparams.max_tokens_per_batch is not None):
+            raise ValueError(
+                "--mixture samples corpora by temperature and may not be used with --sortish_sampler or "
+                "--max_tokens_per_batch"
+            )
+        if hparams.pack_sequences and hparams.cache_encoder_outputs:
+            raise ValueError("--pack_sequences and --cache_encoder_outputs may not be used simultaneously")
 
         super().__init__(hparams, num_labels=None, mode=self.mode, **kwargs)
         use_task_specific_params(self.model, "summarization")
@@ -81,6 +113,12 @@ class SummarizationModule(BaseTransformer):
             max_source_length=self.hparams.max_source_length,
             prefix=self.model.config.prefix or "",
         )
+        if self.hparams.mixture:
+            self.dataset_kwargs = dict(
+                corpora=self.parse_mixture(self.hparams.mixture),
+                max_source_length=self.hparams.max_source_length,
+                prefix=self.model.config.prefix or "",
+            )
         n_observations_per_split = {
             "train": self.hparams.n_train,
             "val": self.hparams.n_val,
@@ -100,16 +138,57 @@ class SummarizationModule(BaseTransformer):
         if self.hparams.freeze_encoder:
             freeze_params(self.model.get_encoder())
             assert_all_frozen(self.model.get_encoder())
+        self.encoder_cache = None
+        if self.hparams.cache_encoder_outputs:
+            if not (self.hparams.freeze_encoder and self.hparams.freeze_embeds):
+                raise ValueError("--cache_encoder_outputs requires --freeze_encoder and --freeze_embeds")
+            if self.hparams.mixture:
+                raise ValueError("--cache_encoder_outputs does not support --mixture")
+            cache_dir = self.hparams.encoder_cache_dir or self.output_dir / "encoder_cache"
+            self.encoder_cache = EncoderOutputCache(cache_dir, "train", self.model.config.d_model)
+        if self.hparams.lora_rank > 0:
+            self.lora_config = dict(
+                base_model_name_or_path=self.hparams.model_name_or_path,
+                r=self.hparams.lora_rank,
+                alpha=self.hparams.lora_alpha,
+                target_modules=self.hparams.lora_target_modules,
+            )
+            n_layers = inject_lora(
+                self.model,
+                self.hparams.lora_rank,
+                self.hparams.lora_alpha,
+                self.hparams.lora_dropout,
+                self.hparams.lora_target_modules,
+            )
+            n_params = sum(p.numel() for p in self.model.parameters() if p.requires_grad)
+            logger.info(f"LoRA: training {n_params} adapter parameters in {n_layers} decoder layers")
+        self.checkpoint_writer = self.checkpoint_io = None
+        if self.hparams.trainable_checkpoints:
+            self.checkpoint_writer = AsyncCheckpointWriter(self.hparams.checkpoint_queue_size)
+            if CHECKPOINT_IO_AVAILABLE:  # otherwise Lightning writes the (trimmed) .ckpt files synchronously
+                self.checkpoint_io = AsyncCheckpointIO(self.checkpoint_writer)
+        if self.hparams.pack_sequences and not supports_packing(self.model):
+            raise ValueError(f"--pack_sequences is only implemented for BART-family models, not {self.model_type}")
+        if self.hparams.loss_chunk_size > 0 and not hasattr(self.model, "final_logits_bias"):
+            raise ValueError(f"--loss_chunk_size is only implemented for BART-family models, not {self.model_type}")
 
         self.hparams.git_sha = get_git_info()["repo_sha"]
         self.num_workers = hparams.num_workers
         self.decoder_start_token_id = None  # default to config
+        if self.hparams.mixture and self.model.config.decoder_start_token_id is None:
+            # there is no single --tgt_lang to start with, _generate prompts with the start token and the language
+            raise ValueError(f"--mixture needs a decoder_start_token_id in the config of {hparams.model_name_or_path}")
         if self.model.config.decoder_start_token_id is None and isinstance(self.tokenizer, MBartTokenizer):
             self.decoder_start_token_id = self.tokenizer.lang_code_to_id[hparams.tgt_lang]
             self.model.config.decoder_start_token_id = self.decoder_start_token_id
-        self.dataset_class = (
-            Seq2SeqDataset if hasattr(self.tokenizer, "prepare_seq2seq_batch") else LegacySeq2SeqDataset
-        )
+        if self.hparams.mixture:
+            self.dataset_class = MixtureSeq2SeqDataset
+        elif self.hparams.binarized_data:
+            self.dataset_class = BinarizedSeq2SeqDataset
+        else:
+            self.dataset_class = (
+                Seq2SeqDataset if hasattr(self.tokenizer, "prepare_seq2seq_batch") else LegacySeq2SeqDataset
+            )
         self.already_saved_batch = False
         self.eval_beams = self.model.config.num_beams if self.hparams.eval_beams is None else self.hparams.eval_beams
         if self.hparams.eval_max_gen_length is not None:
@@ -117,11 +196,27 @@ class SummarizationModule(BaseTransformer):
         else:
             self.eval_max_length = self.model.config.max_length
         self.val_metric = self.default_val_metric if self.hparams.val_metric is None else self.hparams.val_metric
+        self.val_checks = 0
+        self.generate_this_check = True
+        self.val_metric_updated = True  # False after checks that did not generate, see callbacks.SkipStaleValMetric
+        self.val_generate_ids = None  # the subsample of --val_generate_subsample, set by get_dataloader
+        self.datasets = {}  # type_path -> dataset, built once per process by get_dataset
+        self.last_generative_metrics = {}
+
+    @staticmethod
+    def parse_mixture(mixture: List[str]) -> List[Dict[str, str]]:
+        """Parse data_dir:src_lang[:tgt_lang] specs, tgt_lang defaults to src_lang."""
+        corpora = []
+        for spec in mixture:
+            data_dir, src_lang, *tgt_lang = spec.split(":")
+            corpora.append({"data_dir": data_dir, "src_lang": src_lang, "tgt_lang": (tgt_lang or [src_lang])[0]})
+        return corpora
 
     def save_readable_batch(self, batch: Dict[str, torch.Tensor]) -> Dict[str, List[str]]:
         """A debugging utility"""
+        batch = {k: v for k, v in batch.items() if not v.is_floating_point()}
         readable_batch = {
-            k: self.tokenizer.batch_decode(v.tolist()) if "mask" not in k else v.shape for k, v in batch.items()
+            k: self.tokenizer.batch_decode(v.tolist()) if k in self.token_keys else v.shape for k, v in batch.items()
         }
         save_json(readable_batch, Path(self.output_dir) / "text_batch.json")
         save_json({k: v.tolist() for k, v in batch.items()}, Path(self.output_dir) / "tok_batch.json")
@@ -138,11 +233,13 @@ class SummarizationModule(BaseTransformer):
         )
         return lmap(str.strip, gen_text)
 
-    def _step(self, batch: dict) -> Tuple:
+    def _step(self, batch: dict, encoder_outputs=None) -> Tuple:
         pad_token_id = self.tokenizer.pad_token_id
         src_ids, src_mask = batch["input_ids"], batch["attention_mask"]
         tgt_ids = batch["labels"]
-        if isinstance(self.model, T5ForConditionalGeneration):
+        if "decoder_input_ids" in batch:  # packed rows are shifted per example by the collator
+            decoder_input_ids = batch["decoder_input_ids"]
+        elif isinstance(self.model, T5ForConditionalGeneration):
             decoder_input_ids = self.model._shift_right(tgt_ids)
         else:
             decoder_input_ids = shift_tokens_right(tgt_ids, pad_token_id, self.model.config.decoder_start_token_id)
@@ -150,7 +247,23 @@ class SummarizationModule(BaseTransformer):
             batch["decoder_input_ids"] = decoder_input_ids
             self.save_readable_batch(batch)
 
-        outputs = self(src_ids, attention_mask=src_mask, decoder_input_ids=decoder_input_ids, use_cache=False)
+        if encoder_outputs is None and "encoder_hidden_states" in batch:
+            hidden_states = batch["encoder_hidden_states"].to(self.model.dtype)
+            p = self.hparams.encoder_cache_dropout
+            encoder_outputs = (nn.functional.dropout(hidden_states, p=p, training=self.training),)
+
+        if self.hparams.loss_chunk_size > 0:
+            return (self._chunked_loss(batch, decoder_input_ids, encoder_outputs),)
+        if "src_segment_ids" in batch:
+            outputs = packed_forward(self.model, batch)
+        else:
+            outputs = self(
+                src_ids,
+                attention_mask=src_mask,
+                decoder_input_ids=decoder_input_ids,
+                encoder_outputs=encoder_outputs,
+                use_cache=False,
+            )
         lm_logits = outputs["logits"]
         if self.hparams.label_smoothing == 0:
             # Same behavior as modeling_bart.py, besides ignoring pad_token_id
@@ -165,12 +278,39 @@ class SummarizationModule(BaseTransformer):
             )
         return (loss,)
 
+    def _chunked_loss(self, batch: dict, decoder_input_ids, encoder_outputs) -> torch.Tensor:
+        """_step's loss, projecting decoder states to the vocabulary a chunk of non-pad positions at a time."""
+        if "src_segment_ids" in batch:
+            hidden_states = packed_hidden_states(self.model, batch)[0]
+        else:
+            hidden_states = self.model.model(
+                batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                decoder_input_ids=decoder_input_ids,
+                encoder_outputs=encoder_outputs,
+                use_cache=False,
+            )[0]
+        tgt_ids = batch["labels"]
+        loss, nll_loss = chunked_label_smoothed_nll_loss(
+            hidden_states,
+            self.model.lm_head.weight,
+            self.model.final_logits_bias,
+            tgt_ids,
+            self.hparams.label_smoothing,
+            ignore_index=self.pad,
+            chunk_size=self.hparams.loss_chunk_size,
+        )
+        if self.hparams.label_smoothing == 0:  # mean like CrossEntropyLoss
+            return nll_loss / tgt_ids.ne(self.pad).sum()
+        return loss
+
     @property
     def pad(self) -> int:
         return self.tokenizer.pad_token_id
 
     def training_step(self, batch, batch_idx) -> Dict:
-        loss_tensors = self._step(batch)
+        with self.autocast():
+            loss_tensors = self._step(batch)
 
         logs = {name: loss for name, loss in zip(self.loss_names, loss_tensors)}
         # tokens per batch
@@ -178,19 +318,56 @@ class SummarizationModule(BaseTransformer):
         logs["bs"] = batch["input_ids"].shape[0]
         logs["src_pad_tok"] = batch["input_ids"].eq(self.pad).sum()
         logs["src_pad_frac"] = batch["input_ids"].eq(self.pad).float().mean()
+        if "src_segment_ids" in batch:
+            logs["packed_examples"] = batch["src_segment_ids"].max(dim=1).values.sum()
         # TODO(SS): make a wandb summary metric for this
         return {"loss": loss_tensors[0], "log": logs}
 
+    @property
+    def sanity_checking(self) -> bool:
+        return getattr(self.trainer, "sanity_checking", getattr(self.trainer, "running_sanity_check", False))
+
+    def on_validation_epoch_start(self) -> None:
+        # the sanity check generates too, to catch errors in generation before the first epoch
+        self.generate_this_check = self.sanity_checking or self.val_checks % self.hparams.val_generate_every == 0
+
     def validation_step(self, batch, batch_idx) -> Dict:
-        return self._generative_step(batch)
+        if not self.generate_this_check:
+            return self._loss_step(batch)
+        if self.val_generate_ids is None:
+            return self._generative_step(batch)
+        # loss on the whole batch, generation only for the examples of the subsample
+        encoder_hidden_states = self._encode(batch)
+        outputs = self._loss_step(batch, encoder_hidden_states)
+        keep = torch.tensor([i in self.val_generate_ids for i in batch["ids"].tolist()], device=batch["ids"].device)
+        if keep.any():
+            batch = {k: v[keep] for k, v in batch.items()}
+            columns = batch["attention_mask"].any(dim=0)  # drop the columns that are padding in every kept row
+            batch.update(input_ids=batch["input_ids"][:, columns], attention_mask=batch["attention_mask"][:, columns])
+            outputs.update(self._generate(batch, encoder_hidden_states[keep][:, columns]))
+        return outputs
 
     def validation_epoch_end(self, outputs, prefix="val") -> Dict:
         self.step_count += 1
         losses = {k: torch.stack([x[k] for x in outputs]).mean() for k in self.loss_names}
         loss = losses["loss"]
-        generative_metrics = {
-            k: np.array([x[k] for x in outputs]).mean() for k in self.metric_names + ["gen_time", "gen_len"]
-        }
+        generated = [x for x in outputs if "preds" in x]
+        if generated:
+            generative_metrics = {
+                k: np.array([x[k] for x in generated]).mean() for k in self.metric_names + ["gen_time", "gen_len"]
+            }
+            generative_metrics["generated_step_count"] = self.step_count
+            self.last_generative_metrics[prefix] = generative_metrics
+        else:
+            # keep the keys of metrics.json stable: repeat the last generative results, generated_step_count says when
+            nan_metrics = {k: float("nan") for k in self.metric_names + ["gen_time", "gen_len"]}
+            generative_metrics = dict(self.last_generative_metrics.get(prefix, nan_metrics))
+            generative_metrics.setdefault("generated_step_count", 0)
+        if prefix == "val" and not self.sanity_checking:
+            self.val_checks += 1
+        metric_updated = self.val_metric in losses or bool(generated)
+        if prefix == "val":
+            self.val_metric_updated = metric_updated
         metric_val = (
             generative_metrics[self.val_metric] if self.val_metric in generative_metrics else losses[self.val_metric]
         )
@@ -199,38 +376,80 @@ class SummarizationModule(BaseTransformer):
         losses.update(generative_metrics)
         all_metrics = {f"{prefix}_avg_{k}": x for k, x in losses.items()}
         all_metrics["step_count"] = self.step_count
-        self.metrics[prefix].append(all_metrics)  # callback writes this to self.metrics_save_path
-        preds = flatten_list([x["preds"] for x in outputs])
-        return {
-            "log": all_metrics,
-            "preds": preds,
-            f"{prefix}_loss": loss,
-            f"{prefix}_{self.val_metric}": metric_tensor,
-        }
+        self.metrics[prefix].append(all_metrics)  # callback writes this to metrics.jsonl and self.metrics_save_path
+        preds = self.gather_preds(generated)
+        result = {"log": all_metrics, "preds": preds, f"{prefix}_loss": loss}
+        if metric_updated:  # a repeated bleu/rouge2 is not a new result for the callbacks
+            result[f"{prefix}_{self.val_metric}"] = metric_tensor
+        return result
+
+    def gather_preds(self, generated: List[dict]) -> List[str]:
+        """The predictions of all ranks in the order of the data files.
+
+        Batches are sorted by length, and under DDP every rank only generates for its own shard of the data, so the
+        (id, prediction) pairs of all ranks are gathered and sorted by id. Every rank must call this.
+        """
+        ids = flatten_list([x["ids"] for x in generated])
+        preds = flatten_list([x["preds"] for x in generated])
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            shards = [None] * torch.distributed.get_world_size()
+            torch.distributed.all_gather_object(shards, (ids, preds))
+            ids = flatten_list([shard_ids for shard_ids, _ in shards])
+            preds = flatten_list([shard_preds for _, shard_preds in shards])
+        return [pred for _, pred in sorted(zip(ids, preds))]
 
     def calc_generative_metrics(self, preds, target) -> Dict:
         return calculate_rouge(preds, target)
 
+    def _encode(self, batch: dict) -> torch.Tensor:
+        """Last encoder hidden states, computed once for both generate and the teacher-forced loss."""
+        with self.autocast():
+            return self.model.get_encoder()(batch["input_ids"], attention_mask=batch["attention_mask"])[0]
+
+    def _loss_step(self, batch: dict, encoder_hidden_states=None) -> dict:
+        """Teacher-forced losses only, the cheap part of _generative_step."""
+        # a fresh BaseModelOutput per call: generate expands the one it gets for beam search in place
+        encoder_outputs = None
+        if encoder_hidden_states is not None:
+            encoder_outputs = BaseModelOutput(last_hidden_state=encoder_hidden_states)
+        with self.autocast():
+            loss_tensors = self._step(batch, encoder_outputs=encoder_outputs)
+        return {name: loss for name, loss in zip(self.loss_names, loss_tensors)}
+
     def _generative_step(self, batch: dict) -> dict:
+        encoder_hidden_states = self._encode(batch)
+        base_metrics = self._loss_step(batch, encoder_hidden_states)
+        base_metrics.update(self._generate(batch, encoder_hidden_states))
+        return base_metrics
+
+    def _generate(self, batch: dict, encoder_hidden_states=None) -> dict:
         t0 = time.time()
 
         # parser.add_argument('--eval_max_gen_length', type=int, default=None, help='never generate more than n tokens')
-        generated_ids = self.model.generate(
-            batch["input_ids"],
-            attention_mask=batch["attention_mask"],
-            use_cache=True,
-            decoder_start_token_id=self.decoder_start_token_id,
-            num_beams=self.eval_beams,
-            max_length=self.eval_max_length,
-        )
+        generate_kwargs = {}
+        if encoder_hidden_states is not None:
+            generate_kwargs["encoder_outputs"] = BaseModelOutput(last_hidden_state=encoder_hidden_states)
+        if "tgt_lang_ids" in batch:
+            # mixed target languages: prompt the decoder with each example's language code
+            start_ids = torch.full_like(batch["tgt_lang_ids"], self.model.config.decoder_start_token_id)
+            generate_kwargs["decoder_input_ids"] = torch.stack([start_ids, batch["tgt_lang_ids"]], dim=1)
+        with self.autocast():
+            generated_ids = self.model.generate(
+                batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                use_cache=True,
+                decoder_start_token_id=self.decoder_start_token_id,
+                num_beams=self.eval_beams,
+                max_length=self.eval_max_length,
+                **generate_kwargs,
+            )
         gen_time = (time.time() - t0) / batch["input_ids"].shape[0]
         preds: List[str] = self.ids_to_clean_text(generated_ids)
         target: List[str] = self.ids_to_clean_text(batch["labels"])
-        loss_tensors = self._step(batch)
-        base_metrics = {name: loss for name, loss in zip(self.loss_names, loss_tensors)}
         rouge: Dict = self.calc_generative_metrics(preds, target)
         summ_len = np.mean(lmap(len, generated_ids))
-        base_metrics.update(gen_time=gen_time, gen_len=summ_len, preds=preds, target=target, **rouge)
+        base_metrics = dict(gen_time=gen_time, gen_len=summ_len, preds=preds, target=target, **rouge)
+        base_metrics["ids"] = batch["ids"].tolist()
         return base_metrics
 
     def test_step(self, batch, batch_idx):
@@ -240,26 +459,79 @@ class SummarizationModule(BaseTransformer):
         return self.validation_epoch_end(outputs, prefix="test")
 
     def get_dataset(self, type_path) -> Seq2SeqDataset:
-        n_obs = self.n_obs[type_path]
-        max_target_length = self.target_lens[type_path]
-        dataset = self.dataset_class(
+        """The dataset of `type_path`, built on the first call only: Lightning asks for the val and test dataloaders
+        more than once, and the length arrays the dataset reads are shared between processes (utils.shared_array)."""
+        if type_path not in self.datasets:
+            self.datasets[type_path] = self.dataset_class(
+                self.tokenizer,
+                type_path=type_path,
+                n_obs=self.n_obs[type_path],
+                max_target_length=self.target_lens[type_path],
+                **self.dataset_kwargs,
+            )
+        return self.datasets[type_path]
+
+    def get_streaming_dataloader(self, type_path: str, batch_size: int) -> DataLoader:
+        distributed = self.hparams.gpus > 1
+        dataset = StreamingSeq2SeqDataset(
             self.tokenizer,
             type_path=type_path,
-            n_obs=n_obs,
-            max_target_length=max_target_length,
+            max_target_length=self.target_lens[type_path],
+            batch_size=batch_size,
+            shuffle_buffer_size=self.hparams.shuffle_buffer_size,
+            num_replicas=torch.distributed.get_world_size() if distributed else 1,
+            rank=torch.distributed.get_rank() if distributed else 0,
+            seed=self.hparams.seed,
+            num_examples=self.hparams.streaming_num_examples,
             **self.dataset_kwargs,
         )
-        return dataset
+        collate_fn = self.packed_collate_fn(dataset) if self.hparams.pack_sequences else dataset.collate_fn
+        return DataLoader(dataset, batch_size=None, collate_fn=collate_fn, num_workers=self.num_workers)
+
+    def packed_collate_fn(self, dataset) -> PackedSeq2SeqCollator:
+        return PackedSeq2SeqCollator(
+            dataset.collate_fn,
+            self.pad,
+            self.model.config.decoder_start_token_id,
+            self.hparams.max_source_length,
+            self.target_lens["train"],
+        )
 
     def get_dataloader(self, type_path: str, batch_size: int, shuffle: bool = False) -> DataLoader:
+        if self.hparams.streaming and type_path == "train":
+            return self.get_streaming_dataloader(type_path, batch_size)
         dataset = self.get_dataset(type_path)
+        collate_fn = dataset.collate_fn
+        if type_path == "val" and self.hparams.val_generate_subsample is not None:
+            self.val_generate_ids = set(
+                stratified_subsample(dataset.src_lens, self.hparams.val_generate_subsample, self.hparams.seed)
+            )
+        if self.encoder_cache is not None and type_path == "train":
+            collate_fn = EncoderOutputCollator(dataset.collate_fn, self.encoder_cache)
+        if self.hparams.pack_sequences and type_path == "train":
+            collate_fn = self.packed_collate_fn(dataset)
 
         if self.hparams.sortish_sampler and type_path != "test" and type_path != "val":
-            sampler = dataset.make_sortish_sampler(batch_size, distributed=self.hparams.gpus > 1)
+            sampler = dataset.make_sortish_sampler(
+                batch_size, distributed=self.hparams.gpus > 1, seed=self.hparams.seed
+            )
             return DataLoader(
                 dataset,
                 batch_size=batch_size,
-                collate_fn=dataset.collate_fn,
+                collate_fn=collate_fn,
+                shuffle=False,
+                num_workers=self.num_workers,
+                sampler=sampler,
+            )
+
+        elif self.hparams.mixture and type_path != "test" and type_path != "val":
+            sampler = dataset.make_temperature_sampler(
+                self.hparams.mixture_temperature, distributed=self.hparams.gpus > 1, seed=self.hparams.seed
+            )
+            return DataLoader(
+                dataset,
+                batch_size=batch_size,
+                collate_fn=collate_fn,
                 shuffle=False,
                 num_workers=self.num_workers,
                 sampler=sampler,
@@ -267,29 +539,133 @@ class SummarizationModule(BaseTransformer):
 
         elif self.hparams.max_tokens_per_batch is not None and type_path != "test" and type_path != "val":
             batch_sampler = dataset.make_dynamic_sampler(
-                self.hparams.max_tokens_per_batch, distributed=self.hparams.gpus > 1
+                self.hparams.max_tokens_per_batch, distributed=self.hparams.gpus > 1, seed=self.hparams.seed
             )
             return DataLoader(
                 dataset,
                 batch_sampler=batch_sampler,
-                collate_fn=dataset.collate_fn,
+                collate_fn=collate_fn,
                 # shuffle=False,
                 num_workers=self.num_workers,
                 # batch_size=None,
             )
+        elif type_path == "test" or type_path == "val":
+            # length-sorted batches spend less of beam search on padding, validation_epoch_end restores the order
+            if self.hparams.gpus > 1:
+                sampler = dataset.make_sortish_sampler(
+                    batch_size, distributed=True, shuffle=False, add_extra_examples=False
+                )
+            else:
+                sampler = dataset.make_sortish_sampler(batch_size, shuffle=False)
+            return DataLoader(
+                dataset,
+                batch_size=batch_size,
+                collate_fn=collate_fn,
+                shuffle=False,
+                num_workers=self.num_workers,
+                sampler=sampler,
+            )
         else:
+            sampler = None
+            if self.hparams.gpus > 1:
+                sampler = DistributedSampler(dataset, shuffle=shuffle, seed=self.hparams.seed)
             return DataLoader(
                 dataset,
                 batch_size=batch_size,
-                collate_fn=dataset.collate_fn,
-                shuffle=shuffle,
+                collate_fn=collate_fn,
+                shuffle=shuffle and sampler is None,
                 num_workers=self.num_workers,
-                sampler=None,
+                sampler=sampler,
             )
 
+    def save_pretrained_model(self, save_path: Path) -> None:
+        if self.hparams.lora_rank > 0:  # lora.py merges them into the base model
+            save_lora(self.model, save_path, self.lora_config)
+        elif self.hparams.trainable_checkpoints:  # checkpoint_io.py rebuilds the full model
+            save_trainable(self.model, save_path, self.hparams.model_name_or_path, self.checkpoint_writer)
+        else:
+            super().save_pretrained_model(save_path)
+
+    @property
+    def trainable_only_checkpoints(self) -> bool:
+        return self.hparams.lora_rank > 0 or self.hparams.trainable_checkpoints
+
+    def on_save_checkpoint(self, checkpoint) -> None:
+        super().on_save_checkpoint(checkpoint)
+        if self.trainable_only_checkpoints:  # the frozen base model is hparams.model_name_or_path
+            trainable = {f"model.{n}" for n, p in self.model.named_parameters() if p.requires_grad}
+            checkpoint["state_dict"] = {k: v for k, v in checkpoint["state_dict"].items() if k in trainable}
+
+    def on_load_checkpoint(self, checkpoint) -> None:
+        if self.trainable_only_checkpoints:
+            state_dict = self.state_dict()
+            state_dict.update(checkpoint["state_dict"])
+            checkpoint["state_dict"] = state_dict
+        super().on_load_checkpoint(checkpoint)
+
+    def on_train_end(self) -> None:
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.flush()
+
+    def on_train_start(self) -> None:
+        if self.encoder_cache is not None:
+            self.build_encoder_cache()
+        if self.hparams.amp_parity_tol is not None and self.hparams.amp_dtype != "fp32":
+            self.check_amp_parity()
+
+    def check_amp_parity(self) -> None:
+        """Compare the loss of the first training batch under autocast with fp32, dropout off."""
+        batch = next(iter(self.train_loader))
+        batch = {k: v.to(self.device) if isinstance(v, torch.Tensor) else v for k, v in batch.items()}
+        self.model.eval()
+        fp32_loss, amp_loss = loss_parity(lambda: self._step(dict(batch))[0], self.hparams.amp_dtype, self.device)
+        self.model.train()
+        diff = abs(amp_loss - fp32_loss) / max(abs(fp32_loss), 1e-8)
+        amp_dtype = self.hparams.amp_dtype
+        logger.info(f"{amp_dtype} loss {amp_loss:.6f}, fp32 loss {fp32_loss:.6f}, relative diff {diff:.2e}")
+        if diff > self.hparams.amp_parity_tol:
+            raise ValueError(f"{amp_dtype} loss differs from fp32 by {diff:.2e} > {self.hparams.amp_parity_tol}")
+
+    def build_encoder_cache(self) -> None:
+        """Run the frozen encoder once over the training set, training then only runs the decoder."""
+        dataset = self.train_loader.dataset
+        encoder = self.model.get_encoder()
+        # everything that changes the encoder inputs or outputs; the weights, since a model directory can be rewritten
+        params = [state_dict_sha1(encoder), self.hparams.max_source_length, len(dataset), dataset.prefix]
+        params += [dataset.dataset_kwargs.get(k, "") for k in ["src_lang", "tgt_lang"]]
+        key = "-".join(map(str, params + [file_sha1(dataset.src_file)]))
+        dataloader = DataLoader(
+            dataset,
+            batch_size=self.hparams.eval_batch_size,
+            collate_fn=dataset.collate_fn,
+            shuffle=False,
+            num_workers=self.num_workers,
+        )
+        encoder.eval()
+        self.encoder_cache.build(encoder, dataloader, key, device=self.device)
+        encoder.train()
+
+    def on_train_epoch_start(self) -> None:
+        # not every Lightning version reseeds `sampler`, and none reseeds `batch_sampler` or streaming datasets
+        for sampler in [self.train_loader.sampler, self.train_loader.batch_sampler, self.train_loader.dataset]:
+            if hasattr(sampler, "set_epoch"):
+                sampler.set_epoch(self.current_epoch)
+
+    @property
+    def batch_size(self) -> int:
+        """The attribute --auto_scale_batch_size tunes, hparams.train_batch_size."""
+        return self.hparams.train_batch_size
+
+    @batch_size.setter
+    def batch_size(self, batch_size: int) -> None:
+        self.hparams.train_batch_size = batch_size
+
     def train_dataloader(self) -> DataLoader:
-        dataloader = self.get_dataloader("train", batch_size=self.hparams.train_batch_size, shuffle=True)
-        return dataloader
+        # built by setup, and again whenever --auto_scale_batch_size tried another batch size
+        if self.train_loader_batch_size != self.hparams.train_batch_size:
+            self.train_loader = self.get_dataloader("train", self.hparams.train_batch_size, shuffle=True)
+            self.train_loader_batch_size = self.hparams.train_batch_size
+        return self.train_loader
 
     def val_dataloader(self) -> DataLoader:
         return self.get_dataloader("val", batch_size=self.hparams.eval_batch_size)
@@ -331,9 +707,92 @@ class SummarizationModule(BaseTransformer):
         )
         parser.add_argument("--freeze_encoder", action="store_true")
         parser.add_argument("--freeze_embeds", action="store_true")
+        parser.add_argument(
+            "--cache_encoder_outputs",
+            action="store_true",
+            default=False,
+            help="Run the frozen encoder once and train only the decoder on its cached fp16 outputs.",
+        )
+        parser.add_argument(
+            "--encoder_cache_dir", type=str, default=None, help="Defaults to output_dir/encoder_cache"
+        )
+        parser.add_argument(
+            "--encoder_cache_dropout",
+            type=float,
+            default=0.0,
+            help="Dropout on the cached encoder outputs, in place of the encoder dropout that is lost.",
+        )
+        parser.add_argument(
+            "--lora_rank",
+            type=int,
+            default=0,
+            help="Train only rank-r adapters in the decoder and save only them. 0 fine-tunes the model itself.",
+        )
+        parser.add_argument("--lora_alpha", type=float, default=16.0, help="Adapter outputs are scaled by alpha / r")
+        parser.add_argument("--lora_dropout", type=float, default=0.05)
+        parser.add_argument(
+            "--lora_target_modules",
+            type=str,
+            nargs="+",
+            default=DEFAULT_TARGET_MODULES,
+            help="Names of the decoder linear layers that get adapters",
+        )
+        parser.add_argument(
+            "--trainable_checkpoints",
+            action="store_true",
+            default=False,
+            help="Checkpoint only the trainable tensors (safetensors) and a reference to the frozen base model, "
+            "written on a background thread.",
+        )
+        parser.add_argument(
+            "--checkpoint_queue_size", type=int, default=2, help="Checkpoint writes that may wait before saving blocks"
+        )
         parser.add_argument("--sortish_sampler", action="store_true", default=False)
         parser.add_argument("--overwrite_output_dir", action="store_true", default=False)
-        parser.add_argument("--max_tokens_per_batch", type=int, default=None)
+        parser.add_argument(
+            "--max_tokens_per_batch",
+            type=int,
+            default=None,
+            help="Dynamic batch size: (longest source + longest target) * batch size. Requires make_len_file.py.",
+        )
+        parser.add_argument(
+            "--binarized_data",
+            action="store_true",
+            default=False,
+            help="Read the token ids written by binarize_data.py instead of tokenizing in collate_fn.",
+        )
+        parser.add_argument(
+            "--streaming",
+            action="store_true",
+            default=False,
+            help="Stream train.source/.target or the shards train.*.source/.target instead of indexing them.",
+        )
+        parser.add_argument(
+            "--streaming_num_examples",
+            type=int,
+            default=None,
+            help="Number of training examples, for the lr schedule. Each rank yields exactly its share of batches.",
+        )
+        parser.add_argument(
+            "--mixture",
+            type=str,
+            nargs="+",
+            default=None,
+            help="Train on several corpora at once, given as data_dir:src_lang[:tgt_lang], e.g. slurp/data:en_XX",
+        )
+        parser.add_argument(
+            "--mixture_temperature",
+            type=float,
+            default=1.0,
+            help="Corpora are sampled proportionally to size ** (1 / T), T > 1 upsamples the small ones.",
+        )
+        parser.add_argument(
+            "--pack_sequences",
+            action="store_true",
+            default=False,
+            help="Pack several training examples per row, kept apart by attention masks. See packing.py.",
+        )
+        parser.add_argument("--shuffle_buffer_size", type=int, default=100000, help="Examples in the shuffle buffer")
         parser.add_argument("--logger_name", type=str, choices=["default", "wandb", "wandb_shared"], default="default")
         parser.add_argument("--n_train", type=int, default=-1, required=False, help="# examples. -1 means use all.")
         parser.add_argument("--n_val", type=int, default=500, required=False, help="# examples. -1 means use all.")
@@ -342,6 +801,13 @@ class SummarizationModule(BaseTransformer):
             "--task", type=str, default="summarization", required=False, help="# examples. -1 means use all."
         )
         parser.add_argument("--label_smoothing", type=float, default=0.0, required=False)
+        parser.add_argument(
+            "--loss_chunk_size",
+            type=int,
+            default=0,
+            help="Compute the loss this many target tokens at a time, never materializing the full B x T x vocab "
+            "log-probs. 0 computes it in one go.",
+        )
         parser.add_argument("--src_lang", type=str, default="", required=False)
         parser.add_argument("--tgt_lang", type=str, default="", required=False)
         parser.add_argument("--eval_beams", type=int, default=None, required=False)
@@ -349,6 +815,34 @@ class SummarizationModule(BaseTransformer):
             "--val_metric", type=str, default=None, required=False, choices=["bleu", "rouge2", "loss", None]
         )
         parser.add_argument("--eval_max_gen_length", type=int, default=None, help="never generate more than n tokens")
+        parser.add_argument(
+            "--val_generate_every",
+            type=int,
+            default=1,
+            help="Generate and score only every n-th validation check, the others only compute the loss.",
+        )
+        parser.add_argument(
+            "--val_generate_subsample",
+            type=int,
+            default=None,
+            help="Generate only for this many validation examples, a fixed sample stratified by source length.",
+        )
+        parser.add_argument(
+            "--profile_every_n_steps",
+            type=int,
+            default=0,
+            help="Time the parts of every training step, appended to profile_rank*.jsonl every n steps (0: off).",
+        )
+        parser.add_argument(
+            "--profile_trace_start", type=int, default=-1, help="Record a torch.profiler trace from this step on"
+        )
+        parser.add_argument("--profile_trace_steps", type=int, default=5, help="Length of the profiler trace")
+        parser.add_argument(
+            "--profile_no_cuda_sync",
+            action="store_true",
+            default=False,
+            help="Do not wait for the GPU at step boundaries; cheaper, but the timings are less exact.",
+        )
         parser.add_argument("--save_top_k", type=int, default=1, required=False, help="How many checkpoints to save")
         parser.add_argument(
             "--early_stopping_patience",
@@ -409,6 +903,18 @@ def main(args, model=None) -> SummarizationModule:
         es_callback = False
 
     lower_is_better = args.val_metric == "loss"
+    extra_callbacks = []
+    if args.zero_stage > 0:  # memory_rank*.json shows what the sharding saves
+        extra_callbacks.append(OptimizerMemoryCallback())
+    if args.profile_every_n_steps > 0 or args.profile_trace_start >= 0:
+        extra_callbacks.append(
+            StepProfilerCallback(
+                flush_every=args.profile_every_n_steps or 50,
+                cuda_sync=not args.profile_no_cuda_sync,
+                trace_start=args.profile_trace_start,
+                trace_steps=args.profile_trace_steps,
+            )
+        )
     trainer: pl.Trainer = generic_train(
         model,
         args,
@@ -418,6 +924,7 @@ def main(args, model=None) -> SummarizationModule:
         ),
         early_stopping_callback=es_callback,
         logger=logger,
+        extra_callbacks=extra_callbacks,
     )
     pickle_save(model.hparams, model.output_dir / "hparams.pkl")
     if not args.do_predict:
@@ -3,12 +3,19 @@
 import argparse
 import logging
 import os
+import warnings
 from pathlib import Path
 from typing import Any, Dict
 
 import pytorch_lightning as pl
+import torch
+import torch.distributed as dist
 from pytorch_lightning.utilities import rank_zero_info
 
+from fast_load import load_seq2seq_model, safetensors_path
+from precision import AMP_DTYPES, autocast, check_amp_dtype, make_grad_scaler
+from prune_vocab import load_tokenizer
+from zero import make_zero_optimizer
 from transformers import (
     AdamW,
     AutoConfig,
@@ -19,7 +26,6 @@ from transformers import (
     AutoModelForSequenceClassification,
     AutoModelForTokenClassification,
     AutoModelWithLMHead,
-    AutoTokenizer,
     PretrainedConfig,
     PreTrainedTokenizer,
 )
@@ -35,7 +41,8 @@ from transformers.utils.versions import require_version
 
 logger = logging.getLogger(__name__)
 
-require_version("pytorch_lightning>=1.0.4")
+# BaseTransformer.backward and optimizer_step override the hooks with the signatures of Lightning 1.x
+require_version("pytorch_lightning>=1.0.4,<2.0")
 
 MODEL_MODES = {
     "base": AutoModel,
@@ -100,14 +107,19 @@ class BaseTransformer(pl.LightningModule):
                 setattr(self.config, p, getattr(self.hparams, p))
 
         if tokenizer is None:
-            self.tokenizer = AutoTokenizer.from_pretrained(
+            # a model pruned by prune_vocab.py comes with the map from its ids to the tokenizer's
+            self.tokenizer = load_tokenizer(
                 self.hparams.tokenizer_name if self.hparams.tokenizer_name else self.hparams.model_name_or_path,
+                model_name_or_path=self.hparams.model_name_or_path,
                 cache_dir=cache_dir,
             )
         else:
             self.tokenizer: PreTrainedTokenizer = tokenizer
         self.model_type = MODEL_MODES[mode]
-        if model is None:
+        fast_load = self.model_type is AutoModelForSeq2SeqLM and safetensors_path(self.hparams.model_name_or_path)
+        if model is None and fast_load:  # meta-device construction and mmap-ed weights, see fast_load.py
+            self.model = load_seq2seq_model(self.hparams.model_name_or_path, config=self.config, cache_dir=cache_dir)
+        elif model is None:
             self.model = self.model_type.from_pretrained(
                 self.hparams.model_name_or_path,
                 from_tf=bool(".ckpt" in self.hparams.model_name_or_path),
@@ -116,6 +128,33 @@ class BaseTransformer(pl.LightningModule):
             )
         else:
             self.model = model
+        check_amp_dtype(self.hparams.amp_dtype, on_gpu=self.hparams.gpus > 0)
+        self.grad_scaler = make_grad_scaler(self.hparams.amp_dtype)
+
+    def autocast(self):
+        """Wrap forward passes, including generate, in this to run them in --amp_dtype."""
+        return autocast(self.hparams.amp_dtype, self.device)
+
+    def backward(self, loss, optimizer, optimizer_idx, *args, **kwargs) -> None:
+        if self.grad_scaler is not None:
+            loss = self.grad_scaler.scale(loss)
+        loss.backward(*args, **kwargs)
+
+    def optimizer_step(
+        self, epoch=None, batch_idx=None, optimizer=None, optimizer_idx=None, optimizer_closure=None, **kwargs
+    ) -> None:
+        if self.grad_scaler is None:
+            return super().optimizer_step(epoch, batch_idx, optimizer, optimizer_idx, optimizer_closure, **kwargs)
+        # as Lightning's own native amp plugin does: GradScaler.step takes no closure, so the closure runs first and
+        # the scaler steps the optimizer the LightningOptimizer wraps
+        optimizer_closure()  # training_step and backward of the scaled loss
+        optimizer = getattr(optimizer, "_optimizer", optimizer)
+        self.grad_scaler.unscale_(optimizer)
+        # generic_train turns off Lightning's clipping, it would clip the scaled gradients
+        if self.hparams.gradient_clip_val > 0:
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.hparams.gradient_clip_val)
+        self.grad_scaler.step(optimizer)  # skipped if the gradients overflowed
+        self.grad_scaler.update()
 
     def load_hf_checkpoint(self, *args, **kwargs):
         self.model = self.model_type.from_pretrained(*args, **kwargs)
@@ -132,25 +171,31 @@ class BaseTransformer(pl.LightningModule):
         """Prepare optimizer and schedule (linear warmup and decay)"""
         model = self.model
         no_decay = ["bias", "LayerNorm.weight"]
+        # frozen parameters get no optimizer state
+        named_parameters = [(n, p) for n, p in model.named_parameters() if p.requires_grad]
         optimizer_grouped_parameters = [
             {
-                "params": [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
+                "params": [p for n, p in named_parameters if not any(nd in n for nd in no_decay)],
                 "weight_decay": self.hparams.weight_decay,
             },
             {
-                "params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)],
+                "params": [p for n, p in named_parameters if any(nd in n for nd in no_decay)],
                 "weight_decay": 0.0,
             },
         ]
         if self.hparams.adafactor:
-            optimizer = Adafactor(
-                optimizer_grouped_parameters, lr=self.hparams.learning_rate, scale_parameter=False, relative_step=False
-            )
-
+            optimizer_class = Adafactor
+            defaults = dict(lr=self.hparams.learning_rate, scale_parameter=False, relative_step=False)
         else:
-            optimizer = AdamW(
-                optimizer_grouped_parameters, lr=self.hparams.learning_rate, eps=self.hparams.adam_epsilon
-            )
+            optimizer_class = AdamW
+            defaults = dict(lr=self.hparams.learning_rate, eps=self.hparams.adam_epsilon)
+        # stage 2 shards through the ddp_sharded plugin, which wraps the optimizer itself
+        if self.hparams.zero_stage == 1:
+            if not (dist.is_available() and dist.is_initialized()):
+                raise ValueError("--zero_stage 1 shards the optimizer state over DDP ranks, use it with --gpus > 1")
+            optimizer = make_zero_optimizer(optimizer_grouped_parameters, optimizer_class, **defaults)
+        else:
+            optimizer = optimizer_class(optimizer_grouped_parameters, **defaults)
         self.opt = optimizer
 
         scheduler = self.get_lr_scheduler()
@@ -174,7 +219,10 @@ class BaseTransformer(pl.LightningModule):
             self.dataset_size = len(self.test_dataloader().dataset)
         else:
             self.train_loader = self.get_dataloader("train", self.hparams.train_batch_size, shuffle=True)
-            self.dataset_size = len(self.train_dataloader().dataset)
+            self.train_loader_batch_size = self.hparams.train_batch_size
+            # streaming datasets have no length, only an expected number of examples
+            dataset = self.train_dataloader().dataset
+            self.dataset_size = dataset.num_examples if hasattr(dataset, "num_examples") else len(dataset)
 
     def get_dataloader(self, type_path: str, batch_size: int, shuffle: bool = False):
         raise NotImplementedError("You must implement this for your task")
@@ -202,8 +250,17 @@ class BaseTransformer(pl.LightningModule):
     def on_save_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
         save_path = self.output_dir.joinpath("best_tfmr")
         self.model.config.save_step = self.step_count
-        self.model.save_pretrained(save_path)
+        self.save_pretrained_model(save_path)
         self.tokenizer.save_pretrained(save_path)
+        if self.grad_scaler is not None:
+            checkpoint["grad_scaler"] = self.grad_scaler.state_dict()
+
+    def save_pretrained_model(self, save_path: Path) -> None:
+        self.model.save_pretrained(save_path)
+
+    def on_load_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        if self.grad_scaler is not None and "grad_scaler" in checkpoint:
+            self.grad_scaler.load_state_dict(checkpoint["grad_scaler"])
 
     @staticmethod
     def add_model_specific_args(parser, root_dir):
@@ -305,17 +362,33 @@ def add_generic_args(parser, root_dir) -> None:
         help="The output directory where the model predictions and checkpoints will be written.",
     )
     parser.add_argument(
-        "--fp16",
-        action="store_true",
-        help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
+        "--amp_dtype",
+        type=str,
+        default="fp32",
+        choices=AMP_DTYPES,
+        help="Run training steps and generate under torch autocast: fp16 (GPU, loss scaled) or bf16 (GPU or CPU)",
+    )
+    parser.add_argument(
+        "--fp16", dest="amp_dtype", action="store_const", const="fp16", help="Same as --amp_dtype fp16"
     )
-
     parser.add_argument(
         "--fp16_opt_level",
         type=str,
-        default="O2",
-        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
-        "See details at https://nvidia.github.io/apex/amp.html",
+        default=None,
+        help="Deprecated and ignored: Apex AMP was replaced by torch autocast, see --amp_dtype.",
+    )
+    parser.add_argument(
+        "--amp_parity_tol",
+        type=float,
+        default=None,
+        help="Before training, fail if the autocast loss on the first batch differs from fp32 by more than this.",
+    )
+    parser.add_argument(
+        "--zero_stage",
+        type=int,
+        default=0,
+        choices=[0, 1, 2],
+        help="With several GPUs, shard the optimizer state (1) or also the gradients (2, needs fairscale) over ranks.",
     )
     parser.add_argument("--n_tpu_cores", dest="tpu_cores", type=int)
     parser.add_argument("--max_grad_norm", dest="gradient_clip_val", default=1.0, type=float, help="Max gradient norm")
@@ -366,13 +439,21 @@ def generic_train(
 
     train_params = {}
 
-    # TODO: remove with PyTorch 1.6 since pl uses native amp
-    if args.fp16:
-        train_params["precision"] = 16
-        train_params["amp_level"] = args.fp16_opt_level
+    # autocast and loss scaling are done by BaseTransformer, Lightning's precision stays 32
+    if args.fp16_opt_level is not None:
+        warnings.warn("--fp16_opt_level is deprecated and ignored, fp16 uses torch autocast: see --amp_dtype")
+    if args.amp_dtype == "fp16":
+        train_params["gradient_clip_val"] = 0  # clipped after unscaling in BaseTransformer.optimizer_step
 
+    plugins = []
     if args.gpus > 1:
         train_params["distributed_backend"] = "ddp"
+        if args.zero_stage == 2:
+            plugins.append("ddp_sharded")  # optimizer state and gradients sharded by fairscale
+    if getattr(model, "checkpoint_io", None) is not None:
+        plugins.append(model.checkpoint_io)
+    if plugins:
+        train_params["plugins"] = plugins
 
     train_params["accumulate_grad_batches"] = args.accumulate_grad_batches
     train_params["accelerator"] = extra_train_kwargs.get("accelerator", None)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Low-rank adapters (LoRA) for the decoder of a seq2seq model.
+
+`inject_lora` freezes the whole model and wraps the chosen linear layers of the decoder in LoRALinear, so only the
+low-rank A and B matrices are trained. `save_lora`/`load_lora` write and read just those, a few MB per corpus.
+Running this file merges an adapter into its base model for evaluation or export:
+
+    python lora.py --adapter_dir slurp/output/best_tfmr --output_dir slurp/output/merged
+"""
+
+import argparse
+import math
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+from torch import nn
+
+from utils import freeze_params, load_json, save_json
+
+
+LORA_CONFIG_NAME = "lora_config.json"
+LORA_WEIGHTS_NAME = "lora_model.bin"
+DEFAULT_TARGET_MODULES = ["q_proj", "k_proj", "v_proj", "out_proj", "fc1", "fc2"]
+
+
+class LoRALinear(nn.Module):
+    """`base(x) + dropout(x) @ A.T @ B.T * alpha / r` with `base` frozen. B starts at zero, so training starts from
+    the unchanged model."""
+
+    def __init__(self, base: nn.Linear, r: int, alpha: float, dropout: float = 0.0):
+        super().__init__()
+        self.base = base
+        self.lora_A = nn.Parameter(torch.empty(r, base.in_features, dtype=base.weight.dtype))
+        self.lora_B = nn.Parameter(torch.zeros(base.out_features, r, dtype=base.weight.dtype))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.scaling = alpha / r
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.base(x) + (self.dropout(x) @ self.lora_A.t() @ self.lora_B.t()) * self.scaling
+
+    def merged(self) -> nn.Linear:
+        """The base layer with the adapter added to its weight."""
+        self.base.weight.data += (self.lora_B @ self.lora_A).to(self.base.weight.dtype) * self.scaling
+        return self.base
+
+
+def _lora_parents(module: nn.Module, target_modules: List[str]):
+    for parent in list(module.modules()):
+        for name, child in list(parent.named_children()):
+            if name in target_modules and isinstance(child, nn.Linear):
+                yield parent, name, child
+
+
+def inject_lora(model, r: int, alpha: float, dropout: float = 0.0, target_modules=DEFAULT_TARGET_MODULES) -> int:
+    """Freeze `model` and add trainable adapters to the `target_modules` linear layers of its decoder.
+
+    Returns the number of wrapped layers.
+    """
+    freeze_params(model)
+    n = 0
+    for parent, name, child in _lora_parents(model.get_decoder(), target_modules):
+        setattr(parent, name, LoRALinear(child, r, alpha, dropout))
+        n += 1
+    if n == 0:
+        raise ValueError(f"no decoder linear layers named {target_modules} in {model.__class__.__name__}")
+    return n
+
+
+def merge_lora(model) -> None:
+    """Fold every adapter into its base layer, leaving a plain model that save_pretrained writes as usual."""
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, LoRALinear):
+                setattr(parent, name, child.merged())
+
+
+def lora_state_dict(model) -> Dict[str, torch.Tensor]:
+    return {k: v for k, v in model.state_dict().items() if k.rsplit(".", 1)[-1] in ["lora_A", "lora_B"]}
+
+
+def save_lora(model, save_directory, lora_config: dict) -> None:
+    """Write the adapters of `model` and what load_lora needs to rebuild them on top of the base model."""
+    save_directory = Path(save_directory)
+    save_directory.mkdir(parents=True, exist_ok=True)
+    torch.save(lora_state_dict(model), save_directory / LORA_WEIGHTS_NAME)
+    save_json(lora_config, save_directory / LORA_CONFIG_NAME)
+
+
+def load_lora(model, save_directory) -> None:
+    """Add the adapters saved in `save_directory` to `model`, its base model."""
+    lora_config = load_json(Path(save_directory) / LORA_CONFIG_NAME)
+    inject_lora(model, lora_config["r"], lora_config["alpha"], target_modules=lora_config["target_modules"])
+    state_dict = torch.load(Path(save_directory) / LORA_WEIGHTS_NAME, map_location="cpu")
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    assert not unexpected, f"unexpected adapter weights: {unexpected}"
+
+
+def main(args):
+    from prune_vocab import load_tokenizer
+    from transformers import AutoModelForSeq2SeqLM
+
+    lora_config = load_json(Path(args.adapter_dir) / LORA_CONFIG_NAME)
+    model = AutoModelForSeq2SeqLM.from_pretrained(lora_config["base_model_name_or_path"])
+    load_lora(model, args.adapter_dir)
+    merge_lora(model)
+    model.save_pretrained(args.output_dir)
+    load_tokenizer(args.adapter_dir).save_pretrained(args.output_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge LoRA adapters into their base model")
+    parser.add_argument("--adapter_dir", type=str, required=True, help="best_tfmr of a --lora_rank run")
+    parser.add_argument("--output_dir", type=str, required=True)
+    main(parser.parse_args())
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+import argparse
+from pathlib import Path
+
+from prune_vocab import load_tokenizer
+from utils import build_len_file
+
+
+def main(args):
+    tokenizer = load_tokenizer(args.tokenizer_name)
+    for type_path in args.type_path:
+        if not Path(args.data_dir).joinpath(type_path + ".source").exists():
+            continue
+        lens = build_len_file(tokenizer, args.data_dir, type_path, num_workers=args.num_workers, force=args.force)
+        print(f"{type_path}: {lens.shape[1]} examples, max source/target length {lens[0].max()}/{lens[1].max()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write token lengths to {split}.len for sortish and dynamic batching")
+    parser.add_argument("--tokenizer_name", type=str, required=True, help="--model_name_or_path of finetune.py")
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--type_path", type=str, nargs="+", default=["train", "val", "test"])
+    parser.add_argument("--num_workers", type=int, default=None, help="Defaults to the number of CPUs")
+    parser.add_argument("--force", action="store_true", help="Recompute even if the cached lengths are up to date")
+    main(parser.parse_args())
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# Adopted from https://github.com/huggingface/transformers/blob/88e84186e5a0d5dd78b62b1a8e97b2c269426442/examples/research_projects/seq2seq-distillation/make_student.py
+
+import argparse
+import warnings
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+from torch import nn
+
+from prune_vocab import load_tokenizer
+from transformers import AutoModelForSeq2SeqLM, PreTrainedModel
+
+
+# teacher layers -> student layers -> the teacher layers copied into the student, first and last always included
+LAYERS_TO_COPY = {
+    12: {
+        1: [0],
+        2: [0, 11],
+        3: [0, 5, 11],
+        4: [0, 3, 7, 11],
+        6: [0, 2, 4, 7, 9, 11],
+        9: [0, 1, 2, 4, 5, 7, 9, 10, 11],
+        12: list(range(12)),
+    },
+}
+# teacher layers -> student layers -> the teacher layers each student layer learns from with --supervise_forward
+LAYERS_TO_SUPERVISE = {
+    12: {1: [11], 2: [5, 11], 3: [3, 7, 11], 4: [2, 5, 8, 11], 6: [1, 3, 5, 8, 10, 11]},
+}
+
+
+def _evenly_spaced(n_student: int, n_teacher: int) -> List[int]:
+    return np.linspace(0, n_teacher - 1, n_student).round().astype(int).tolist()
+
+
+def pick_layers_to_copy(n_student: int, n_teacher: int) -> List[int]:
+    try:
+        return LAYERS_TO_COPY[n_teacher][n_student]
+    except KeyError:
+        if n_student != n_teacher:
+            warnings.warn(f"no hardcoded layers to copy for {n_teacher} -> {n_student}, copying evenly spaced layers")
+        return _evenly_spaced(n_student, n_teacher)
+
+
+def get_layers_to_supervise(n_student: int, n_teacher: int) -> List[int]:
+    """Used with --supervise_forward: student layer i learns the hidden states of teacher layer matches[i]."""
+    if n_student > n_teacher:
+        raise ValueError(f"cannot supervise {n_student} student layers with {n_teacher} teacher layers")
+    if n_student == n_teacher:
+        return list(range(n_teacher))
+    if n_student in LAYERS_TO_SUPERVISE.get(n_teacher, {}):
+        return LAYERS_TO_SUPERVISE[n_teacher][n_student]
+    return [round((i + 1) * n_teacher / n_student) - 1 for i in range(n_student)]
+
+
+def copy_layers(src_layers: nn.ModuleList, dest_layers: nn.ModuleList, layers_to_copy: List[int]) -> None:
+    layers_to_copy = nn.ModuleList([src_layers[i] for i in layers_to_copy])
+    assert len(dest_layers) == len(layers_to_copy), f"{len(dest_layers)} != {len(layers_to_copy)}"
+    dest_layers.load_state_dict(layers_to_copy.state_dict())
+
+
+def create_student_by_copying_alternating_layers(
+    teacher: Union[str, PreTrainedModel],
+    save_path: Union[str, Path] = "student",
+    e: Optional[int] = None,
+    d: Optional[int] = None,
+    **extra_config_kwargs
+) -> Tuple[PreTrainedModel, List[int], List[int]]:
+    """Make a BART-family student with `e` encoder and `d` decoder layers (default: the teacher's) and save it.
+
+    Everything but the layers is the teacher's; the layers are teacher layers spread over its depth, first and last
+    included (pick_layers_to_copy). Returns the student and the teacher layers its encoder and decoder layers are
+    copied from, in the order they appear in the student.
+    """
+    if isinstance(teacher, str):
+        tokenizer_source = teacher  # the student uses the teacher's tokenizer
+        teacher = AutoModelForSeq2SeqLM.from_pretrained(teacher).eval()
+    else:
+        tokenizer_source = teacher.config._name_or_path
+    teacher_e, teacher_d = teacher.config.encoder_layers, teacher.config.decoder_layers
+    e = teacher_e if e is None else e
+    d = teacher_d if d is None else d
+
+    init_kwargs = {**teacher.config.to_diff_dict(), "encoder_layers": e, "decoder_layers": d, **extra_config_kwargs}
+    student = AutoModelForSeq2SeqLM.from_config(teacher.config.__class__(**init_kwargs))
+    # everything except the layers, which then come from the teacher layers picked below
+    info = student.load_state_dict(teacher.state_dict(), strict=False)
+    assert not info.missing_keys, f"student weights missing from the teacher: {info.missing_keys}"
+
+    e_layers_to_copy = pick_layers_to_copy(e, teacher_e)
+    d_layers_to_copy = pick_layers_to_copy(d, teacher_d)
+    copy_layers(teacher.model.encoder.layers, student.model.encoder.layers, e_layers_to_copy)
+    copy_layers(teacher.model.decoder.layers, student.model.decoder.layers, d_layers_to_copy)
+    student.config.init_metadata = {
+        "teacher_type": teacher.config.model_type,
+        "copied_encoder_layers": e_layers_to_copy,
+        "copied_decoder_layers": d_layers_to_copy,
+    }
+    student.save_pretrained(save_path)
+    load_tokenizer(tokenizer_source).save_pretrained(save_path)
+    return student, e_layers_to_copy, d_layers_to_copy
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make a student by copying alternating layers of a teacher")
+    parser.add_argument("--teacher", type=str, required=True, help="e.g. akreal/mbart-large-50-finetuned-slurp")
+    parser.add_argument("--save_path", type=str, required=True)
+    parser.add_argument("--e", type=int, default=None, help="Encoder layers, default: the teacher's")
+    parser.add_argument("--d", type=int, default=None, help="Decoder layers, default: the teacher's")
+    args = parser.parse_args()
+    student, e_layers, d_layers = create_student_by_copying_alternating_layers(
+        args.teacher, args.save_path, e=args.e, d=args.d
+    )
+    print(f"copied encoder layers {e_layers} and decoder layers {d_layers} to {args.save_path}")
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""Sequence packing: several short source/target pairs per row, kept apart by block-diagonal attention masks.
+
+The collator turns a padded batch into packed rows with segment ids (0 marks padding) and position ids that restart
+at every example. `packed_forward` runs a BART-family model (BART, mBART) on such rows: encoder self-attention,
+decoder causal self-attention and cross-attention are restricted to the example a token belongs to, so every token
+sees exactly the context it would see unpacked and the token-level loss is unchanged.
+
+Running this file compares training throughput of packed and unpacked batches:
+
+    python packing.py --model_name_or_path facebook/mbart-large-50 --data_dir slurp/data --src_lang en_XX \
+        --tgt_lang en_XX --max_source_length 128 --max_target_length 128 --batch_size 64 --steps 20
+"""
+
+import argparse
+import random
+import time
+from typing import Dict, List, Tuple
+
+import torch
+from torch import nn
+
+from transformers.modeling_outputs import Seq2SeqLMOutput
+
+
+class PackedSeq2SeqCollator:
+    """Wraps a dataset's collate_fn and packs its unpadded examples into as few rows as fit the length limits.
+
+    Adds `decoder_input_ids`, shifted right within each example, and `src/tgt_segment_ids`, `src/tgt_position_ids`.
+    """
+
+    def __init__(self, collate_fn, pad_token_id, decoder_start_token_id, max_source_length, max_target_length):
+        self.collate_fn = collate_fn
+        self.pad_token_id = pad_token_id
+        self.decoder_start_token_id = decoder_start_token_id
+        self.max_source_length = max_source_length
+        self.max_target_length = max_target_length
+
+    def pack(self, src_lens: List[int], tgt_lens: List[int]) -> List[List[int]]:
+        """First-fit decreasing: longest sources first, each into the first row with room for source and target."""
+        rows, row_src, row_tgt = [], [], []
+        for i in sorted(range(len(src_lens)), key=lambda i: -src_lens[i]):
+            for r in range(len(rows)):
+                fits_src = row_src[r] + src_lens[i] <= self.max_source_length
+                if fits_src and row_tgt[r] + tgt_lens[i] <= self.max_target_length:
+                    rows[r].append(i)
+                    row_src[r] += src_lens[i]
+                    row_tgt[r] += tgt_lens[i]
+                    break
+            else:
+                rows.append([i])
+                row_src.append(src_lens[i])
+                row_tgt.append(tgt_lens[i])
+        return rows
+
+    def __call__(self, batch) -> Dict[str, torch.Tensor]:
+        batch = self.collate_fn(batch)
+        sources = [ids[mask.bool()] for ids, mask in zip(batch["input_ids"], batch["attention_mask"])]
+        targets = [ids[ids.ne(self.pad_token_id)] for ids in batch["labels"]]
+        rows = self.pack([len(s) for s in sources], [len(t) for t in targets])
+
+        src_len = max(sum(len(sources[i]) for i in row) for row in rows)
+        tgt_len = max(sum(len(targets[i]) for i in row) for row in rows)
+        input_ids = torch.full((len(rows), src_len), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(rows), tgt_len), self.pad_token_id, dtype=torch.long)
+        decoder_input_ids = torch.full((len(rows), tgt_len), self.pad_token_id, dtype=torch.long)
+        src_segment_ids = torch.zeros((len(rows), src_len), dtype=torch.long)
+        tgt_segment_ids = torch.zeros((len(rows), tgt_len), dtype=torch.long)
+        src_position_ids = torch.zeros((len(rows), src_len), dtype=torch.long)
+        tgt_position_ids = torch.zeros((len(rows), tgt_len), dtype=torch.long)
+        for r, row in enumerate(rows):
+            s = t = 0
+            for segment, i in enumerate(row, start=1):
+                src, tgt = sources[i], targets[i]
+                input_ids[r, s : s + len(src)] = src
+                src_segment_ids[r, s : s + len(src)] = segment
+                src_position_ids[r, s : s + len(src)] = torch.arange(len(src))
+                labels[r, t : t + len(tgt)] = tgt
+                decoder_input_ids[r, t] = self.decoder_start_token_id
+                decoder_input_ids[r, t + 1 : t + len(tgt)] = tgt[:-1]
+                tgt_segment_ids[r, t : t + len(tgt)] = segment
+                tgt_position_ids[r, t : t + len(tgt)] = torch.arange(len(tgt))
+                s += len(src)
+                t += len(tgt)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": src_segment_ids.ne(0).long(),
+            "labels": labels,
+            "decoder_input_ids": decoder_input_ids,
+            "src_segment_ids": src_segment_ids,
+            "tgt_segment_ids": tgt_segment_ids,
+            "src_position_ids": src_position_ids,
+            "tgt_position_ids": tgt_position_ids,
+        }
+
+
+def segment_attention_mask(query_segments, key_segments, dtype, causal=False) -> torch.Tensor:
+    """Additive (bsz, 1, q_len, k_len) mask letting a query attend only to the non-pad keys of its own segment."""
+    allowed = query_segments[:, :, None].eq(key_segments[:, None, :]) & key_segments[:, None, :].ne(0)
+    if causal:
+        q_len, k_len = allowed.shape[1:]
+        allowed = allowed & torch.ones(q_len, k_len, dtype=torch.bool, device=allowed.device).tril()
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=allowed.device)
+    return mask.masked_fill(~allowed, torch.finfo(dtype).min)[:, None]
+
+
+def _embed_positions(embed_positions: nn.Embedding, position_ids: torch.Tensor) -> torch.Tensor:
+    # BART's learned positional embeddings are offset by 2, their forward only knows contiguous positions
+    return nn.functional.embedding(position_ids + embed_positions.offset, embed_positions.weight)
+
+
+def _run_layers(stack: nn.Module, hidden_states: torch.Tensor, **layer_kwargs) -> torch.Tensor:
+    for layer in stack.layers:
+        if stack.training and random.uniform(0, 1) < stack.layerdrop:  # same LayerDrop as the unpacked forward
+            continue
+        hidden_states = layer(hidden_states, **layer_kwargs)[0]
+    return hidden_states
+
+
+def packed_hidden_states(model, batch: Dict[str, torch.Tensor]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Last decoder and encoder hidden states of a BART-family model over a batch from PackedSeq2SeqCollator."""
+    encoder, decoder = model.get_encoder(), model.get_decoder()
+    dtype = encoder.embed_tokens.weight.dtype
+    src_segments, tgt_segments = batch["src_segment_ids"], batch["tgt_segment_ids"]
+
+    hidden_states = encoder.embed_tokens(batch["input_ids"]) * encoder.embed_scale
+    hidden_states = hidden_states + _embed_positions(encoder.embed_positions, batch["src_position_ids"])
+    hidden_states = encoder.layernorm_embedding(hidden_states)
+    hidden_states = nn.functional.dropout(hidden_states, p=encoder.dropout, training=encoder.training)
+    mask = segment_attention_mask(src_segments, src_segments, dtype)
+    hidden_states = _run_layers(encoder, hidden_states, attention_mask=mask, layer_head_mask=None)
+    if getattr(encoder, "layer_norm", None) is not None:  # mBART has a final layer norm, BART does not
+        hidden_states = encoder.layer_norm(hidden_states)
+    encoder_hidden_states = hidden_states
+
+    hidden_states = decoder.embed_tokens(batch["decoder_input_ids"]) * decoder.embed_scale
+    hidden_states = hidden_states + _embed_positions(decoder.embed_positions, batch["tgt_position_ids"])
+    hidden_states = decoder.layernorm_embedding(hidden_states)
+    hidden_states = nn.functional.dropout(hidden_states, p=decoder.dropout, training=decoder.training)
+    hidden_states = _run_layers(
+        decoder,
+        hidden_states,
+        attention_mask=segment_attention_mask(tgt_segments, tgt_segments, dtype, causal=True),
+        encoder_hidden_states=encoder_hidden_states,
+        encoder_attention_mask=segment_attention_mask(tgt_segments, src_segments, dtype),
+        use_cache=False,
+    )
+    if getattr(decoder, "layer_norm", None) is not None:
+        hidden_states = decoder.layer_norm(hidden_states)
+
+    return hidden_states, encoder_hidden_states
+
+
+def packed_forward(model, batch: Dict[str, torch.Tensor]) -> Seq2SeqLMOutput:
+    """Forward pass of a BART-family `...ForConditionalGeneration` over a batch from PackedSeq2SeqCollator."""
+    hidden_states, encoder_hidden_states = packed_hidden_states(model, batch)
+    logits = model.lm_head(hidden_states) + model.final_logits_bias
+    return Seq2SeqLMOutput(logits=logits, encoder_last_hidden_state=encoder_hidden_states)
+
+
+def supports_packing(model) -> bool:
+    stacks = [model.get_encoder(), model.get_decoder()]
+    return hasattr(model, "final_logits_bias") and all(hasattr(s, "embed_positions") for s in stacks)
+
+
+def benchmark(args) -> None:
+    """Train-step tokens/sec of the same batches, packed and unpacked, after checking both give the same loss."""
+    from prune_vocab import load_tokenizer
+    from transformers import AutoModelForSeq2SeqLM
+    from transformers.models.bart.modeling_bart import shift_tokens_right
+    from utils import Seq2SeqDataset
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer = load_tokenizer(args.model_name_or_path)
+    model = AutoModelForSeq2SeqLM.from_pretrained(args.model_name_or_path).to(device)
+    if not supports_packing(model):
+        raise ValueError(f"{model.__class__.__name__} is not a BART-family model, packing is not supported")
+    dataset = Seq2SeqDataset(
+        tokenizer,
+        args.data_dir,
+        args.max_source_length,
+        args.max_target_length,
+        type_path="train",
+        src_lang=args.src_lang,
+        tgt_lang=args.tgt_lang,
+    )
+    start_id = model.config.decoder_start_token_id
+    collator = PackedSeq2SeqCollator(
+        dataset.collate_fn, tokenizer.pad_token_id, start_id, args.max_source_length, args.max_target_length
+    )
+    sampler = dataset.make_sortish_sampler(args.batch_size)
+    indices = list(sampler)[: args.batch_size * args.steps]
+    starts = range(0, len(indices), args.batch_size)
+    examples = [[dataset[i] for i in indices[k : k + args.batch_size]] for k in starts]
+    unpacked = [dataset.collate_fn(b) for b in examples]
+    packed = [collator(b) for b in examples]
+    loss_fct = nn.CrossEntropyLoss(ignore_index=tokenizer.pad_token_id)
+
+    def loss_of(batch):
+        batch = {k: v.to(device) for k, v in batch.items() if isinstance(v, torch.Tensor)}
+        if "src_segment_ids" in batch:
+            logits = packed_forward(model, batch)["logits"]
+        else:
+            decoder_input_ids = shift_tokens_right(batch["labels"], tokenizer.pad_token_id, start_id)
+            logits = model(
+                batch["input_ids"], attention_mask=batch["attention_mask"], decoder_input_ids=decoder_input_ids
+            )["logits"]
+        return loss_fct(logits.view(-1, logits.shape[-1]), batch["labels"].view(-1))
+
+    model.eval()
+    with torch.no_grad():
+        diff = (loss_of(unpacked[0]) - loss_of(packed[0])).abs().item()
+    print(f"loss difference packed vs unpacked (dropout off): {diff:.2e}")
+
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.0)
+    for name, batches in [("unpacked", unpacked), ("packed", packed)]:
+        tokens = sum(int(b["attention_mask"].sum() + b["labels"].ne(tokenizer.pad_token_id).sum()) for b in batches)
+        rows = sum(len(b["input_ids"]) for b in batches)
+        pad_frac = 1 - sum(int(b["attention_mask"].sum()) for b in batches) / sum(
+            b["input_ids"].numel() for b in batches
+        )
+        loss_of(batches[0]).backward()  # warm up
+        optimizer.zero_grad()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        t0 = time.time()
+        for batch in batches:
+            loss_of(batch).backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.time() - t0
+        print(f"{name}: {rows} rows, src_pad_frac {pad_frac:.3f}, {tokens / elapsed:.0f} tokens/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--src_lang", type=str, default="")
+    parser.add_argument("--tgt_lang", type=str, default="")
+    parser.add_argument("--max_source_length", type=int, default=128)
+    parser.add_argument("--max_target_length", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=20)
+    benchmark(parser.parse_args())
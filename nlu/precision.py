@@ -0,0 +1,47 @@
+"""Mixed precision with native torch autocast: fp16 with a dynamic loss scaler, or bf16 on GPU and CPU.
+
+Weights and optimizer state stay fp32, only the forward pass (training step and `generate`) runs under autocast.
+"""
+
+import contextlib
+from typing import Callable, Optional, Tuple
+
+import torch
+
+
+AMP_DTYPES = ["fp32", "fp16", "bf16"]
+AUTOCAST_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def check_amp_dtype(amp_dtype: str, on_gpu: bool) -> None:
+    if amp_dtype not in AMP_DTYPES:
+        raise ValueError(f"--amp_dtype must be one of {AMP_DTYPES}, got {amp_dtype}")
+    if amp_dtype == "fp16" and not on_gpu:
+        raise ValueError("fp16 autocast needs a GPU, use --amp_dtype bf16 on CPU")
+    if amp_dtype == "bf16" and on_gpu and not torch.cuda.is_bf16_supported():
+        raise ValueError("this GPU does not support bf16, use --amp_dtype fp16")
+
+
+def autocast(amp_dtype: str, device: torch.device):
+    """Autocast context for `device`, a no-op for fp32."""
+    if amp_dtype == "fp32":
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=AUTOCAST_DTYPES[amp_dtype])
+
+
+def make_grad_scaler(amp_dtype: str) -> Optional["torch.amp.GradScaler"]:
+    """fp16 gradients underflow without loss scaling, bf16 has the exponent range of fp32 and needs none."""
+    if amp_dtype != "fp16":
+        return None
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda")
+    return torch.cuda.amp.GradScaler()  # torch < 2.3
+
+
+def loss_parity(loss_fn: Callable[[], torch.Tensor], amp_dtype: str, device: torch.device) -> Tuple[float, float]:
+    """The loss `loss_fn` computes on a fixed batch in fp32 and under autocast, without gradients."""
+    with torch.no_grad():
+        fp32_loss = loss_fn().item()
+        with autocast(amp_dtype, device):
+            amp_loss = loss_fn().item()
+    return fp32_loss, amp_loss
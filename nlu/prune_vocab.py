@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""Shrink the embeddings and lm_head of an mBART-style model to the token ids a task actually uses.
+
+The ids found in the prepared data, plus the special tokens and language codes, are kept in their original order,
+so the special tokens keep their ids. The pruned model is saved with the unchanged tokenizer and `vocab_map.json`,
+the original id of every pruned id. `load_tokenizer` wraps the tokenizer of such a directory in
+PrunedVocabTokenizer, which maps ids in both directions, so datasets, training and decoding work unchanged:
+
+    python prune_vocab.py --model_name_or_path facebook/mbart-large-50-many-to-many-mmt --data_dir slurp/data \
+        --output_dir slurp/mbart-large-50-pruned
+
+and then `--model_name_or_path slurp/mbart-large-50-pruned` in finetune.sh. ESPnet's hugging_face_export_vocabulary
+exports the pruned token list of such a directory, so HuggingFaceTransformersDecoder loads it as is.
+"""
+
+import argparse
+from pathlib import Path
+from typing import Iterable, List
+
+import numpy as np
+import torch
+from torch import nn
+
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+from utils import load_json, save_json
+
+
+VOCAB_MAP_NAME = "vocab_map.json"
+
+
+class PrunedVocabTokenizer:
+    """A tokenizer whose ids are those of the pruned model: token ids from the wrapped tokenizer are mapped to their
+    pruned id (unknown if pruned away) and mapped back before decoding. Everything else is the wrapped tokenizer's."""
+
+    def __init__(self, tokenizer, vocab_map: List[int]):
+        self.tokenizer = tokenizer
+        self.vocab_map = np.asarray(vocab_map, dtype=np.int64)
+        self.old_to_new = np.full(max(len(tokenizer), self.vocab_map.max() + 1), -1, dtype=np.int64)
+        self.old_to_new[self.vocab_map] = np.arange(len(self.vocab_map))
+        self.old_to_new[self.old_to_new < 0] = self.old_to_new[tokenizer.unk_token_id]
+
+    def __getattr__(self, name):
+        if name == "tokenizer" or name.startswith("__"):  # not set yet, e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(self.tokenizer, name)
+
+    def __len__(self):
+        return len(self.vocab_map)
+
+    def _map(self, table: np.ndarray, ids):
+        if ids is None:
+            return None
+        if isinstance(ids, torch.Tensor):
+            return torch.from_numpy(table[ids.cpu().numpy()]).to(ids.device)
+        if isinstance(ids, np.ndarray):
+            return table[ids]
+        if isinstance(ids, (list, tuple)):
+            return [self._map(table, x) for x in ids]
+        return int(table[ids])
+
+    def to_pruned(self, ids):
+        return self._map(self.old_to_new, ids)
+
+    def from_pruned(self, ids):
+        return self._map(self.vocab_map, ids)
+
+    def _map_encoding(self, encoding):
+        for key in ["input_ids", "labels"]:
+            if key in encoding:
+                encoding[key] = self.to_pruned(encoding[key])
+        return encoding
+
+    def __call__(self, *args, **kwargs):
+        return self._map_encoding(self.tokenizer(*args, **kwargs))
+
+    def prepare_seq2seq_batch(self, *args, **kwargs):
+        return self._map_encoding(self.tokenizer.prepare_seq2seq_batch(*args, **kwargs))
+
+    def decode(self, token_ids, **kwargs) -> str:
+        return self.tokenizer.decode(self.from_pruned(token_ids), **kwargs)
+
+    def batch_decode(self, sequences, **kwargs) -> List[str]:
+        return self.tokenizer.batch_decode(self.from_pruned(sequences), **kwargs)
+
+    def convert_tokens_to_ids(self, tokens):
+        return self.to_pruned(self.tokenizer.convert_tokens_to_ids(tokens))
+
+    def convert_ids_to_tokens(self, ids, **kwargs):
+        return self.tokenizer.convert_ids_to_tokens(self.from_pruned(ids), **kwargs)
+
+    def get_vocab(self):
+        tokens = self.tokenizer.convert_ids_to_tokens(self.vocab_map.tolist())
+        return {token: i for i, token in enumerate(tokens)}
+
+    @property
+    def vocab_size(self) -> int:
+        return len(self.vocab_map)
+
+    @property
+    def all_special_ids(self) -> List[int]:
+        return self.to_pruned(self.tokenizer.all_special_ids)
+
+    @property
+    def lang_code_to_id(self):
+        return {code: self.to_pruned(i) for code, i in self.tokenizer.lang_code_to_id.items()}
+
+    def save_pretrained(self, save_directory, **kwargs):
+        files = self.tokenizer.save_pretrained(save_directory, **kwargs)
+        save_json(self.vocab_map.tolist(), Path(save_directory) / VOCAB_MAP_NAME, indent=None)
+        return files
+
+
+for _name in ["pad", "eos", "bos", "unk", "sep", "cls", "mask"]:
+    setattr(
+        PrunedVocabTokenizer,
+        f"{_name}_token_id",
+        property(lambda self, _name=_name: self.to_pruned(getattr(self.tokenizer, f"{_name}_token_id"))),
+    )
+
+
+def load_tokenizer(name_or_path, model_name_or_path=None, **kwargs):
+    """AutoTokenizer.from_pretrained, wrapped in PrunedVocabTokenizer if either directory has a vocab map."""
+    tokenizer = AutoTokenizer.from_pretrained(name_or_path, **kwargs)
+    for path in [name_or_path, model_name_or_path]:
+        if path is not None and (Path(path) / VOCAB_MAP_NAME).exists():
+            return PrunedVocabTokenizer(tokenizer, load_json(Path(path) / VOCAB_MAP_NAME))
+    return tokenizer
+
+
+def used_token_ids(tokenizer, paths: Iterable[Path], chunk_size=10000) -> np.ndarray:
+    """Sorted ids of the tokens in `paths`, of the special tokens and of the language codes."""
+    used = np.zeros(len(tokenizer), dtype=bool)
+    used[tokenizer.all_special_ids] = True
+    used[list(getattr(tokenizer, "lang_code_to_id", {}).values())] = True
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            lines = [line.rstrip("\n") for line in f]
+        for start in range(0, len(lines), chunk_size):
+            input_ids = tokenizer(lines[start : start + chunk_size], add_special_tokens=False)["input_ids"]
+            for ids in input_ids:
+                used[ids] = True
+    return np.flatnonzero(used)
+
+
+def prune_model(model, vocab_map: np.ndarray) -> None:
+    """Keep the rows `vocab_map` of the (shared) embeddings, lm_head and final_logits_bias and remap the config ids."""
+    index = torch.from_numpy(vocab_map)
+    old_embeddings = model.get_input_embeddings()
+    old_to_new = {old: new for new, old in enumerate(vocab_map.tolist())}
+    pad_token_id = old_to_new.get(model.config.pad_token_id)
+    embeddings = nn.Embedding(len(vocab_map), old_embeddings.embedding_dim, padding_idx=pad_token_id)
+    embeddings.weight.data = old_embeddings.weight.data[index].clone()
+    model.set_input_embeddings(embeddings)
+
+    old_lm_head = model.get_output_embeddings()
+    lm_head = nn.Linear(old_lm_head.in_features, len(vocab_map), bias=old_lm_head.bias is not None)
+    lm_head.weight.data = old_lm_head.weight.data[index].clone()
+    if old_lm_head.bias is not None:
+        lm_head.bias.data = old_lm_head.bias.data[index].clone()
+    model.set_output_embeddings(lm_head)
+    if hasattr(model, "final_logits_bias"):
+        model.register_buffer("final_logits_bias", model.final_logits_bias[:, index].clone())
+
+    model.config.vocab_size = len(vocab_map)
+    for key in ["pad_token_id", "bos_token_id", "eos_token_id", "decoder_start_token_id", "forced_bos_token_id"]:
+        if getattr(model.config, key, None) is not None:
+            setattr(model.config, key, old_to_new[getattr(model.config, key)])
+    model.tie_weights()
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name or args.model_name_or_path)
+    model = AutoModelForSeq2SeqLM.from_pretrained(args.model_name_or_path)
+    files = [f"{split}.{ext}" for split in args.splits for ext in ["source", "target"]]
+    paths = [Path(data_dir) / name for data_dir in args.data_dir for name in files]
+    vocab_map = used_token_ids(tokenizer, paths)
+    print(f"keeping {len(vocab_map)} of {len(tokenizer)} token ids")
+
+    prune_model(model, vocab_map)
+    model.save_pretrained(args.output_dir)
+    PrunedVocabTokenizer(tokenizer, vocab_map).save_pretrained(args.output_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--tokenizer_name", type=str, default=None)
+    parser.add_argument("--data_dir", type=str, nargs="+", required=True, help="One or more prepared data dirs")
+    parser.add_argument("--splits", type=str, nargs="+", default=["train"], help="Tokens only in others map to unk")
+    parser.add_argument("--output_dir", type=str, required=True)
+    main(parser.parse_args())
@@ -0,0 +1,40 @@
+"""Dynamic int8 quantization for CPU inference.
+
+Every nn.Linear of the encoder and decoder gets int8 weights, quantized once, and activations quantized on the fly
+per batch; embeddings, layer norms and the attention arithmetic stay fp32. The lm_head is quantized only on request:
+it is the largest matrix and the most sensitive one, and with the tied embeddings of mBART the fp32 copy stays for
+the input embeddings anyway. To shrink those, prune the vocabulary first (prune_vocab.py).
+"""
+
+import io
+
+import torch
+from torch import nn
+
+
+def set_quantized_engine() -> str:
+    """fbgemm on x86, qnnpack on ARM."""
+    for engine in ["fbgemm", "qnnpack"]:
+        if engine in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError("this torch build has no quantized CPU engine")
+
+
+def quantize_dynamic_int8(model: nn.Module, quantize_lm_head: bool = False) -> nn.Module:
+    """Replace the nn.Linear layers of `model` (a CPU model in eval mode), in place, by dynamically quantized ones."""
+    set_quantized_engine()
+    qconfig_spec = {
+        name: torch.quantization.default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and (quantize_lm_head or name != "lm_head")
+    }
+    # in place: a copy would hold the fp32 and the int8 weights at the same time
+    return torch.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+def state_dict_mb(model: nn.Module) -> float:
+    """Serialized size of the weights, quantized ones included (they are not parameters)."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
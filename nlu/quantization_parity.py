@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Accuracy, speed and size of a model quantized by quantization.py, against the same model in fp32, on CPU.
+
+Both versions generate for the first `--n_obs` examples of a split (the calibration set, val by default). Both
+outputs are scored by the corpus' evaluate.py against the references of those examples. The script exits with an
+error if any of the corpus' headline metrics is more than `--tolerance` points worse with int8:
+
+    python quantization_parity.py --model_name_or_path akreal/mbart-large-50-finetuned-slurp --corpus_dir slurp \
+        --src_lang en_XX --tgt_lang en_XX --output_dir slurp/quantization_parity --tolerance 0.5
+
+Metrics are in percent. Error rates (cer, cver of MEDIA and PortMEDIA) must not rise, the others must not drop.
+"""
+
+import argparse
+import re
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+
+from distill_report import evaluate, time_generate
+from fast_load import load_seq2seq_model
+from prune_vocab import load_tokenizer
+from quantization import quantize_dynamic_int8, state_dict_mb
+from utils import save_json
+
+
+LOWER_IS_BETTER = {"cer", "cver"}
+
+
+def parse_slurp(output: str) -> Dict[str, float]:
+    """The overall F-measure of each table evaluate.py prints with --table-layout tsv."""
+    metrics, f_column = {}, None
+    for line in output.splitlines():
+        cells = [cell.strip() for cell in line.split("\t")]
+        if "F-Measure" in cells:
+            label, f_column = cells[0].lower().replace(" ", "_"), cells.index("F-Measure")
+        elif f_column is not None and cells[0] == "overall":
+            metrics[label] = 100 * float(cells[f_column])
+            f_column = None
+    return metrics
+
+
+def parse_slue(output: str) -> Dict[str, float]:
+    f1, label_f1 = re.search(r"F1: ([\d.]+); label-F1: ([\d.]+)", output).groups()
+    return {"f1": 100 * float(f1), "label_f1": 100 * float(label_f1)}
+
+
+def parse_catslu(output: str) -> Dict[str, float]:
+    return {k.lower(): float(v) for k, v in re.findall(r"^(\w+): ([\d.]+)$", output, flags=re.M)}
+
+
+def parse_media(output: str) -> Dict[str, float]:
+    cer, cver = output.strip().splitlines()[-1].split(";")
+    return {"cer": 100 * float(cer), "cver": 100 * float(cver)}
+
+
+# corpus directory -> (extra evaluate.py arguments, parser of its output, metrics checked by default)
+CORPORA: Dict[str, tuple] = {
+    "slurp": (["--table-layout", "tsv"], parse_slurp, ["intent", "slu_f1"]),
+    "slue": ([], parse_slue, ["f1", "label_f1"]),
+    "catslu": ([], parse_catslu, ["f1", "accuracy"]),
+    "media": ([], parse_media, ["cer", "cver"]),
+    "portmedia_dom": ([], parse_media, ["cer", "cver"]),
+    "portmedia_lang": ([], parse_media, ["cer", "cver"]),
+}
+
+
+def score(corpus_dir: Path, ref_path: Path, hyp_path: Path) -> Dict[str, float]:
+    extra_args, parse, _ = CORPORA[corpus_dir.resolve().name]
+    output = evaluate(corpus_dir, ref_path, hyp_path, *extra_args)
+    try:
+        return parse(output)
+    except (AttributeError, ValueError) as e:
+        raise ValueError(f"cannot parse the output of {corpus_dir}/evaluate.py:\n{output}") from e
+
+
+def run(model, tokenizer, lines: List[str], args, name: str) -> Dict:
+    seconds, preds = time_generate(model, tokenizer, lines, args)
+    hyp_path = Path(args.output_dir) / f"{name}.{args.type_path}_generations.txt"
+    hyp_path.write_text("\n".join(preds) + "\n")
+    return {
+        "examples_per_s": 1 / seconds,
+        "state_dict_mb": state_dict_mb(model),
+        "metrics": score(Path(args.corpus_dir), Path(args.output_dir) / "ref.target", hyp_path),
+        "preds": preds,
+    }
+
+
+def main(args):
+    corpus_dir = Path(args.corpus_dir)
+    if corpus_dir.resolve().name not in CORPORA:
+        raise ValueError(f"no evaluate.py output parser for {corpus_dir}, known corpora: {list(CORPORA)}")
+    metric_names = args.metrics or CORPORA[corpus_dir.resolve().name][2]
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    data_dir = corpus_dir / "data"
+    with open(data_dir / f"{args.type_path}.source") as f:
+        lines = [x.rstrip("\n") for x in f][: args.n_obs]
+    with open(data_dir / f"{args.type_path}.target") as f:
+        refs = [x.rstrip("\n") for x in f][: len(lines)]
+    Path(args.output_dir).mkdir(parents=True, exist_ok=True)
+    (Path(args.output_dir) / "ref.target").write_text("\n".join(refs) + "\n")
+
+    tokenizer = load_tokenizer(args.model_name_or_path)
+    fp32 = run(load_seq2seq_model(args.model_name_or_path, device="cpu"), tokenizer, lines, args, "fp32")
+    # a model of its own: quantize_dynamic_int8 replaces the Linear layers in place
+    model = quantize_dynamic_int8(
+        load_seq2seq_model(args.model_name_or_path, device="cpu"), quantize_lm_head=args.quantize_lm_head
+    )
+    int8 = run(model, tokenizer, lines, args, "int8")
+
+    failures = []
+    for name in metric_names:
+        drop = fp32["metrics"][name] - int8["metrics"][name]
+        if name in LOWER_IS_BETTER:
+            drop = -drop
+        if drop > args.tolerance:
+            failures.append(f"{name}: {fp32['metrics'][name]:.2f} -> {int8['metrics'][name]:.2f}")
+    report = {
+        "fp32": {k: v for k, v in fp32.items() if k != "preds"},
+        "int8": {k: v for k, v in int8.items() if k != "preds"},
+        "same_output": 100 * sum(a == b for a, b in zip(fp32["preds"], int8["preds"])) / len(lines),
+        "speedup": int8["examples_per_s"] / fp32["examples_per_s"],
+        "size_ratio": fp32["state_dict_mb"] / int8["state_dict_mb"],
+        "checked_metrics": metric_names,
+        "tolerance": args.tolerance,
+        "failures": failures,
+    }
+    save_json(report, Path(args.output_dir) / "parity.json")
+    for version in ["fp32", "int8"]:
+        result = report[version]
+        metrics = ", ".join(f"{k} {v:.2f}" for k, v in result["metrics"].items())
+        print(f"{version}: {result['examples_per_s']:.1f} examples/s, {result['state_dict_mb']:.0f} MB, {metrics}")
+    print(
+        f"int8 vs fp32: {report['speedup']:.2f}x faster, {report['size_ratio']:.2f}x smaller, "
+        f"{report['same_output']:.1f}% identical outputs"
+    )
+    if failures:
+        sys.exit(f"int8 is more than {args.tolerance} points worse: {'; '.join(failures)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check dynamic int8 quantization against fp32 on CPU")
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--corpus_dir", type=str, required=True, help="e.g. slurp, with data/ and evaluate.py")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--type_path", type=str, default="val", help="Split the examples are taken from")
+    parser.add_argument("--n_obs", type=int, default=500, help="Number of examples, the first of the split")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Largest allowed loss, in points")
+    parser.add_argument("--metrics", type=str, nargs="+", default=None, help="Default: the corpus' headline metrics")
+    parser.add_argument("--quantize_lm_head", action="store_true")
+    parser.add_argument("--num_threads", type=int, default=None, help="torch threads, default: torch's choice")
+    parser.add_argument("--bs", type=int, default=32, help="Batch size")
+    parser.add_argument("--src_lang", type=str, default="")
+    parser.add_argument("--tgt_lang", type=str, default="")
+    parser.add_argument("--max_source_length", type=int, default=128)
+    parser.add_argument("--max_length", type=int, default=128, help="Maximum length of the generated sequences")
+    parser.add_argument("--num_beams", type=int, default=None)
+    args = parser.parse_args()
+    args.device = "cpu"  # for run_eval.generate
+    main(args)
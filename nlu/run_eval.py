@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""Generate predictions for a source file with a fine-tuned model, starting up fast.
+
+Unlike `finetune.py --do_predict` this imports neither pytorch_lightning nor the metric packages, and loads the
+model through fast_load: built on the meta device, weights memory-mapped from model.safetensors. Add that file to
+a model directory once with
+
+    python run_eval.py --write_safetensors output/best_tfmr
+
+and then
+
+    python run_eval.py output/best_tfmr data/test.source output/test_generations.txt --src_lang en_XX --tgt_lang en_XX
+
+The predictions go through the corpus' evaluate.py as usual. `--quantize` runs the Linear layers in dynamic int8 on
+CPU (quantization.py); quantization_parity.py checks what that costs in accuracy. `--benchmark_startup` starts the
+script `--repeats` times without generating anything and exits with an error if the median wall time of those
+processes, from launch until they exit with the model loaded, exceeds `--startup_budget` seconds.
+"""
+
+import time
+
+
+PROCESS_START = time.perf_counter()  # before the heavy imports below
+
+import argparse  # noqa: E402
+import json  # noqa: E402
+import statistics  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+from typing import Dict, List  # noqa: E402
+
+import torch  # noqa: E402
+
+from fast_load import load_seq2seq_model, write_safetensors  # noqa: E402
+from precision import AUTOCAST_DTYPES  # noqa: E402
+from prune_vocab import load_tokenizer  # noqa: E402
+from quantization import quantize_dynamic_int8  # noqa: E402
+
+
+IMPORTED = time.perf_counter()
+
+
+def chunks(lines: List[str], n: int):
+    for start in range(0, len(lines), n):
+        yield lines[start : start + n]
+
+
+def generate(model, tokenizer, lines: List[str], args) -> List[str]:
+    lang_kwargs = {k: getattr(args, k) for k in ["src_lang", "tgt_lang"] if getattr(args, k)}
+    decoder_start_token_id = None  # default to config, as in finetune.py
+    if model.config.decoder_start_token_id is None and args.tgt_lang:
+        decoder_start_token_id = tokenizer.lang_code_to_id[args.tgt_lang]
+    preds = []
+    for batch in chunks(lines, args.bs):
+        batch = tokenizer.prepare_seq2seq_batch(
+            batch, max_length=args.max_source_length, return_tensors="pt", **lang_kwargs
+        ).to(args.device)
+        with torch.no_grad():
+            generated_ids = model.generate(
+                batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                use_cache=True,
+                decoder_start_token_id=decoder_start_token_id,
+                num_beams=args.num_beams,
+                max_length=args.max_length,
+            )
+        decoded = tokenizer.batch_decode(generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        preds.extend(x.strip() for x in decoded)
+    return preds
+
+
+def run(args) -> Dict[str, float]:
+    tokenizer = load_tokenizer(args.model_name_or_path)
+    tokenizer_ready = time.perf_counter()
+    dtype = AUTOCAST_DTYPES.get(args.amp_dtype)
+    model = load_seq2seq_model(args.model_name_or_path, device=args.device, dtype=dtype)
+    if args.quantize:
+        model = quantize_dynamic_int8(model, quantize_lm_head=args.quantize_lm_head)
+    model_ready = time.perf_counter()
+    timings = {
+        "import_s": IMPORTED - PROCESS_START,
+        "tokenizer_s": tokenizer_ready - IMPORTED,
+        "model_s": model_ready - tokenizer_ready,
+        "startup_s": model_ready - PROCESS_START,
+    }
+    if args.startup_only:
+        return timings
+
+    with open(args.input_path) as f:
+        lines = [x.rstrip("\n") for x in f][: args.n_obs]
+    preds = generate(model, tokenizer, lines, args)
+    with open(args.save_path, "w") as f:
+        f.write("\n".join(preds) + "\n")
+    timings["generate_s"] = time.perf_counter() - model_ready
+    timings["n_obs"] = len(lines)
+    return timings
+
+
+def benchmark_startup(args) -> Dict[str, float]:
+    """Median timings of fresh processes that load the model and exit.
+
+    startup_s is timed here, around the whole process: PROCESS_START is only taken once the interpreter is up, so
+    the startup_s a process reports itself leaves out the interpreter startup (interpreter_s).
+    """
+    command = [sys.executable, __file__, args.model_name_or_path, "--startup_only", "--device", args.device]
+    command += ["--amp_dtype", args.amp_dtype]
+    command += ["--quantize"] * args.quantize + ["--quantize_lm_head"] * args.quantize_lm_head
+    runs = []
+    for _ in range(args.repeats):
+        start = time.perf_counter()
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        run = json.loads(output.strip().splitlines()[-1])
+        process_s = time.perf_counter() - start
+        run["interpreter_s"] = process_s - run["startup_s"]
+        run["startup_s"] = process_s
+        runs.append(run)
+    return {k: statistics.median(run[k] for run in runs) for k in runs[0]}
+
+
+def main(args):
+    if args.write_safetensors:
+        print(f"wrote {write_safetensors(args.model_name_or_path)}")
+        return
+    if args.benchmark_startup:
+        timings = benchmark_startup(args)
+        print(json.dumps(timings))
+        if args.startup_budget is not None and timings["startup_s"] > args.startup_budget:
+            sys.exit(f"median startup {timings['startup_s']:.2f}s exceeds the budget of {args.startup_budget:.2f}s")
+        return
+    if args.quantize and (args.device != "cpu" or args.amp_dtype != "fp32"):
+        sys.exit("--quantize is for fp32 models on CPU")
+    if not args.startup_only and (args.input_path is None or args.save_path is None):
+        sys.exit("input_path and save_path are required")
+    print(json.dumps(run(args)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fast-start generation with a fine-tuned seq2seq model")
+    parser.add_argument("model_name_or_path", type=str, help="e.g. output/best_tfmr")
+    parser.add_argument("input_path", type=str, nargs="?", help="e.g. data/test.source")
+    parser.add_argument("save_path", type=str, nargs="?", help="where to save the predictions, one per line")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--amp_dtype", type=str, default="fp32", choices=["fp32", "fp16", "bf16"])
+    parser.add_argument("--bs", type=int, default=32, help="Batch size")
+    parser.add_argument("--src_lang", type=str, default="")
+    parser.add_argument("--tgt_lang", type=str, default="")
+    parser.add_argument("--max_source_length", type=int, default=128)
+    parser.add_argument("--max_length", type=int, default=128, help="Maximum length of the generated sequences")
+    parser.add_argument("--num_beams", type=int, default=None)
+    parser.add_argument("--n_obs", type=int, default=None, help="Only generate for the first n lines")
+    parser.add_argument("--quantize", action="store_true", help="Dynamic int8 Linear layers, CPU only")
+    parser.add_argument("--quantize_lm_head", action="store_true", help="With --quantize, the lm_head too")
+    parser.add_argument("--write_safetensors", action="store_true", help="Add model.safetensors to the model dir")
+    parser.add_argument("--startup_only", action="store_true", help="Load the model, print the timings and exit")
+    parser.add_argument("--benchmark_startup", action="store_true")
+    parser.add_argument("--repeats", type=int, default=3, help="Processes started by --benchmark_startup")
+    parser.add_argument("--startup_budget", type=float, default=None, help="Seconds, checked by --benchmark_startup")
+    main(parser.parse_args())
@@ -12,13 +12,22 @@ try:
 except (ImportError, ModuleNotFoundError):
     NLTK_AVAILABLE = False
 
-if NLTK_AVAILABLE:
-    with FileLock(".lock") as lock:
-        nltk.download("punkt", quiet=True)
+
+def _download_punkt() -> None:
+    # on first use rather than at import, it may go to the network
+    global _PUNKT_DOWNLOADED
+    if not _PUNKT_DOWNLOADED:
+        with FileLock(".lock"):
+            nltk.download("punkt", quiet=True)
+        _PUNKT_DOWNLOADED = True
+
+
+_PUNKT_DOWNLOADED = False
 
 
 def add_newline_to_end_of_each_sentence(x: str) -> str:
     """This was added to get rougeLsum scores matching published rougeL scores for BART and PEGASUS."""
     re.sub("<n>", "", x)  # remove pegasus newline char
     assert NLTK_AVAILABLE, "nltk must be installed to separate newlines between sentences. (pip install nltk)"
+    _download_punkt()
     return "\n".join(nltk.sent_tokenize(x))
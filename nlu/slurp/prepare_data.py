@@ -1,21 +1,11 @@
-#!/usr/bin/env python3
-
 import json
 import os
-import sys
 import re
 
-idir = sys.argv[1]
-odir = sys.argv[2]
-
-for subset in ["train", "devel", "test"]:
-    os.makedirs(odir, exist_ok=True)
 
-    with open(os.path.join(idir, "dataset", "slurp", subset + ".jsonl")) as meta, open(
-        os.path.join(odir, f"{subset}.source"), "w", encoding="utf-8"
-    ) as source, open(
-        os.path.join(odir, f"{subset}.target"), "w", encoding="utf-8"
-    ) as target:
+def parse_file(path):
+    examples = []
+    with open(path) as meta:
         for line in meta:
             prompt = json.loads(line.strip())
             transcript = prompt["sentence"]
@@ -42,5 +32,11 @@ for subset in ["train", "devel", "test"]:
                 predict_sent += " SEP " + k["type"] + " FILL " + k["filler"].lower()
             predict_sent += " SEP " + transcript
             words = "{}".format(predict_sent)
-            source.write(f"{transcript}\n")
-            target.write(f"{words}\n")
+            examples.append((transcript, words))
+    return examples
+
+
+def get_subsets(idir):
+    return {
+        subset: [os.path.join(idir, "dataset", "slurp", subset + ".jsonl")] for subset in ["train", "devel", "test"]
+    }
@@ -0,0 +1,52 @@
+import time
+
+import pytest
+import torch
+
+from checkpoint_io import AsyncCheckpointWriter, load_trainable, save_trainable
+from conftest import MBART_TINY
+from transformers import AutoModelForSeq2SeqLM
+from utils import freeze_params
+
+
+def test_load_trainable_rebuilds_the_saved_state_dict(tmp_path):
+    pytest.importorskip("safetensors")
+    model = AutoModelForSeq2SeqLM.from_pretrained(MBART_TINY)
+    freeze_params(model.get_encoder())  # with the shared embeddings and the lm_head tied to them
+    torch.manual_seed(0)
+    for p in model.parameters():
+        if p.requires_grad:
+            p.data.add_(torch.randn_like(p))  # as if trained
+
+    writer = AsyncCheckpointWriter()
+    save_trainable(model, tmp_path, MBART_TINY, writer)
+    writer.close()
+
+    expected = model.state_dict()
+    state_dict = load_trainable(tmp_path, verify=True).state_dict()
+    assert state_dict.keys() == expected.keys()
+    for name, tensor in expected.items():
+        assert torch.equal(state_dict[name], tensor), name
+
+    base = AutoModelForSeq2SeqLM.from_pretrained(MBART_TINY)
+    base.get_encoder().layers[0].fc1.weight.data.zero_()
+    with pytest.raises(ValueError, match="frozen weights"):
+        load_trainable(tmp_path, model=base, verify=True)
+
+
+def test_flush_waits_for_the_queued_writes(tmp_path):
+    def slow_write(path, text):
+        time.sleep(0.2)
+        path.write_text(text)
+
+    writer = AsyncCheckpointWriter(max_pending=2)
+    paths = [tmp_path / f"{i}.txt" for i in range(3)]
+    for i, path in enumerate(paths):
+        writer.submit(slow_write, path, str(i))
+    writer.flush()
+    assert [path.read_text() for path in paths] == ["0", "1", "2"]
+
+    writer.submit(slow_write, tmp_path / "missing" / "x.txt", "x")
+    with pytest.raises(RuntimeError, match="writing a checkpoint failed"):
+        writer.flush()
+    writer.close()
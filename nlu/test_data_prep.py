@@ -0,0 +1,51 @@
+import sys
+
+from data_prep import load_corpus_script, prepare_data
+
+
+def parse_file(path):
+    with open(path, encoding="utf-8") as f:
+        return [(line.strip(), line.strip().upper()) for line in f if line.strip()]
+
+
+def test_prepare_data_reparses_only_changed_inputs(tmp_path, capsys):
+    inputs = {name: tmp_path / f"{name}.txt" for name in ["a", "b", "c"]}
+    for name, path in inputs.items():
+        path.write_text(f"{name}1\n{name}2\n")
+    subsets = {"train": [str(inputs["a"]), str(inputs["b"])], "test": [str(inputs["c"])]}
+    odir = tmp_path / "data"
+
+    prepare_data(subsets, parse_file, odir, num_workers=2)
+    assert "parsed 3 of 3" in capsys.readouterr().out
+    assert (odir / "train.source").read_text() == "a1\na2\nb1\nb2\n"
+    assert (odir / "train.target").read_text() == "A1\nA2\nB1\nB2\n"
+    assert (odir / "test.source").read_text() == "c1\nc2\n"
+
+    inputs["b"].write_text("b3\n")
+    prepare_data(subsets, parse_file, odir, num_workers=2)
+    assert "parsed 1 of 3" in capsys.readouterr().out
+    assert (odir / "train.source").read_text() == "a1\na2\nb3\n"
+    assert len(list((odir / ".cache").glob("*.json"))) == 3  # the examples of the old b are gone
+
+
+CORPUS_SCRIPT = """
+def parse_file(path):
+    with open(path, encoding="utf-8") as f:
+        return [(line.strip(), "{name}") for line in f if line.strip()]
+
+
+def get_subsets(idir):
+    return {{"train": [idir + "/{name}.txt"]}}
+"""
+
+
+def test_corpora_sharing_a_cache_dir_keep_each_others_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(sys, "path", list(sys.path))
+    cache_dir = tmp_path / "cache"
+    for name in ["corpus_a", "corpus_b"]:
+        tmp_path.joinpath(f"{name}.py").write_text(CORPUS_SCRIPT.format(name=name))
+        tmp_path.joinpath(f"{name}.txt").write_text("x\n")
+        corpus = load_corpus_script(tmp_path / f"{name}.py")
+        prepare_data(corpus.get_subsets(str(tmp_path)), corpus.parse_file, tmp_path / name, cache_dir=cache_dir)
+        assert (tmp_path / name / "train.target").read_text() == f"{name}\n"
+    assert len(list(cache_dir.glob("*.json"))) == 2
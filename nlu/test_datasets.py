@@ -0,0 +1,285 @@
+import os
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from conftest import MBART_TINY, SOURCES, TARGETS, make_data_dir
+from transformers import AutoModelForSeq2SeqLM
+from utils import (
+    BinarizedSeq2SeqDataset,
+    EncoderOutputCache,
+    EncoderOutputCollator,
+    IndexedTextFile,
+    MixtureSeq2SeqDataset,
+    Seq2SeqDataset,
+    StreamingSeq2SeqDataset,
+    TemperatureSampler,
+    TokenBudgetBatchSampler,
+    binarize_seq2seq_split,
+    build_len_file,
+    load_len_file,
+    pickle_save,
+    shared_array,
+    sortish_sampler_indices,
+    state_dict_sha1,
+)
+
+
+pytestmark = pytest.mark.usefixtures("shared_array_dir")
+
+
+def test_binarized_dataset_batches_match_seq2seq_dataset(tmp_path, tokenizer):
+    data_dir = make_data_dir(tmp_path)
+    lang_kwargs = dict(src_lang="en_XX", tgt_lang="en_XX")
+    n_obs = binarize_seq2seq_split(tokenizer, data_dir, "train", 8, 6, **lang_kwargs)
+    assert n_obs == 3 * len(SOURCES)
+
+    text_dataset = Seq2SeqDataset(tokenizer, data_dir, 8, 6, **lang_kwargs)
+    binarized_dataset = BinarizedSeq2SeqDataset(tokenizer, data_dir, 8, 6, **lang_kwargs)
+    assert len(binarized_dataset) == len(text_dataset)
+    ids = [0, 2, 5, 7]
+    expected = text_dataset.collate_fn([text_dataset[i] for i in ids])
+    batch = binarized_dataset.collate_fn([binarized_dataset[i] for i in ids])
+    for k in ["input_ids", "attention_mask", "labels", "ids"]:
+        assert torch.equal(batch[k], expected[k]), k
+
+
+def test_binarized_dataset_rejects_other_lengths(tmp_path, tokenizer):
+    data_dir = make_data_dir(tmp_path)
+    binarize_seq2seq_split(tokenizer, data_dir, "train", 8, 6)
+    with pytest.raises(AssertionError, match="max_source_length"):
+        BinarizedSeq2SeqDataset(tokenizer, data_dir, 16, 6)
+
+
+def test_indexed_text_file(tmp_path):
+    path = tmp_path / "val.source"
+    path.write_bytes(b"abc\r\nd\n\nlast")
+    lines = IndexedTextFile(path)
+    assert len(lines) == 4
+    assert [lines[i] for i in range(len(lines))] == ["abc", "d", "", "last"]
+
+
+def test_indexed_text_file_rebuilds_index_after_same_size_rewrite(tmp_path):
+    path = tmp_path / "val.source"
+    path.write_text("abc\nd\nef\n")
+    assert [IndexedTextFile(path)[i] for i in range(3)] == ["abc", "d", "ef"]
+    stat = path.stat()
+    path.write_text("abcd\n\nef\n")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))  # in case the clock is coarse
+    lines = IndexedTextFile(path)
+    assert [lines[i] for i in range(len(lines))] == ["abcd", "", "ef"]
+
+
+def test_build_len_file_counts_tokens_and_caches_them(tmp_path, tokenizer):
+    data_dir = make_data_dir(tmp_path)
+    lens = build_len_file(tokenizer, data_dir, "train", num_workers=2, chunk_size=5)
+    assert lens.tolist()[0] == [len(ids) for ids in tokenizer(SOURCES * 3)["input_ids"]]
+    with tokenizer.as_target_tokenizer():
+        assert lens.tolist()[1] == [len(ids) for ids in tokenizer(TARGETS * 3)["input_ids"]]
+    assert np.array_equal(load_len_file(data_dir / "train.len"), lens)
+
+    mtime = (data_dir / "train.len").stat().st_mtime_ns
+    assert np.array_equal(build_len_file(tokenizer, data_dir, "train"), lens)
+    assert (data_dir / "train.len").stat().st_mtime_ns == mtime  # unchanged inputs, cached lengths
+
+    (data_dir / "train.source").write_text("".join(x + "\n" for x in reversed(SOURCES * 3)))
+    assert build_len_file(tokenizer, data_dir, "train").tolist()[0] == lens.tolist()[0][::-1]
+
+
+def test_token_budget_batches_fit_the_budget():
+    rng = np.random.default_rng(0)
+    src_lens, tgt_lens = rng.integers(1, 64, size=1000), rng.integers(1, 32, size=1000)
+    sampler = TokenBudgetBatchSampler(src_lens, tgt_lens, max_tokens=512, required_batch_size_multiple=4)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(1000))
+    for batch in batches:
+        assert (src_lens[batch].max() + tgt_lens[batch].max()) * len(batch) <= 512 or len(batch) == 1
+    assert sum(len(batch) % 4 != 0 for batch in batches) <= 1  # only the smallest batch may be cut short
+    assert src_lens[batches[0]].max() == src_lens.max()  # the longest sources go first
+
+    sampler.set_epoch(1)
+    assert list(sampler) != batches
+    sampler.set_epoch(0)
+    assert list(sampler) == batches
+
+
+def test_token_budget_ranks_run_the_same_number_of_steps():
+    rng = np.random.default_rng(0)
+    src_lens, tgt_lens = rng.integers(1, 64, size=999), rng.integers(1, 32, size=999)
+    ranks = [TokenBudgetBatchSampler(src_lens, tgt_lens, 256, num_replicas=3, rank=rank) for rank in range(3)]
+    batches = [list(sampler) for sampler in ranks]
+    assert len(batches[0]) == len(batches[1]) == len(batches[2]) == len(ranks[0])
+    assert {i for rank_batches in batches for batch in rank_batches for i in batch} == set(range(999))
+
+
+def test_dynamic_sampler_needs_target_token_lengths(tmp_path, tokenizer):
+    data_dir = make_data_dir(tmp_path)
+    src_lens = [len(ids) for ids in tokenizer(SOURCES * 3)["input_ids"]]
+    pickle_save(src_lens, data_dir / "train.len")  # the old format, source lengths only
+    dataset = Seq2SeqDataset(tokenizer, data_dir, 32, 32)
+    assert dataset.src_lens.tolist() == src_lens and dataset.tgt_token_lens is None
+    with pytest.raises(AssertionError, match="rerun make_len_file.py"):
+        dataset.make_dynamic_sampler(64)
+
+    build_len_file(tokenizer, data_dir, "train")
+    sampler = Seq2SeqDataset(tokenizer, data_dir, 32, 32).make_dynamic_sampler(64)
+    assert sorted(i for batch in sampler for i in batch) == list(range(3 * len(SOURCES)))
+
+
+def test_sortish_sampler_indices():
+    lens = np.random.default_rng(0).integers(1, 300, size=10_000)
+    bs = 8
+    indices = sortish_sampler_indices(lens, bs, rng=np.random.default_rng([1, 0, 0]))
+    assert sorted(indices.tolist()) == list(range(len(lens)))
+    assert lens[indices[:bs]].max() == lens.max()  # the longest batch goes first
+    # every batch comes from one pool of 50 batches sorted by decreasing length
+    assert all(np.all(np.diff(lens[indices[i : i + bs]]) <= 0) for i in range(0, len(indices), bs))
+    again = sortish_sampler_indices(lens, bs, rng=np.random.default_rng([1, 0, 0]))
+    assert np.array_equal(indices, again)
+    other_epoch = sortish_sampler_indices(lens, bs, rng=np.random.default_rng([1, 1, 0]))
+    assert not np.array_equal(indices, other_epoch)
+
+
+def test_eval_sampler_sorts_by_length_and_reads_every_example_once(tmp_path, tokenizer):
+    data_dir = make_data_dir(tmp_path, n_copies=5)
+    dataset = Seq2SeqDataset(tokenizer, data_dir, 32, 32, type_path="val")
+    seen = []
+    for rank in range(3):
+        sampler = dataset.make_sortish_sampler(
+            4, distributed=True, shuffle=False, add_extra_examples=False, num_replicas=3, rank=rank
+        )
+        indices = list(sampler)
+        assert len(indices) == len(sampler)
+        assert np.all(np.diff(np.asarray(dataset.src_lens)[indices]) <= 0)
+        seen += indices
+    assert sorted(seen) == list(range(len(dataset)))  # no padding examples, so no duplicate generations
+    # the ids in each batch put the generations back in the order of the data files
+    batch = dataset.collate_fn([dataset[i] for i in seen[:4]])
+    assert batch["ids"].tolist() == seen[:4]
+
+
+def test_encoder_output_cache_returns_the_encoder_states(tmp_path, tokenizer):
+    data_dir = make_data_dir(tmp_path)
+    dataset = Seq2SeqDataset(tokenizer, data_dir, 32, 32)
+    dataloader = DataLoader(dataset, batch_size=5, collate_fn=dataset.collate_fn, shuffle=False)
+    encoder = AutoModelForSeq2SeqLM.from_pretrained(MBART_TINY).get_encoder().eval()
+    cache = EncoderOutputCache(tmp_path / "cache", "train", encoder.config.d_model)
+    cache.build(encoder, dataloader, key="tiny-mbart")
+    mtime = cache.hidden_file.stat().st_mtime_ns
+    cache.build(encoder, dataloader, key="tiny-mbart")
+    assert cache.hidden_file.stat().st_mtime_ns == mtime  # built for this key already
+
+    collate_fn = EncoderOutputCollator(dataset.collate_fn, cache)
+    batch = collate_fn([dataset[i] for i in [6, 1, 3]])
+    with torch.no_grad():
+        expected = encoder(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"])[0]
+    mask = batch["attention_mask"].bool()
+    cached = batch["encoder_hidden_states"]
+    assert cached.dtype == torch.float16 and cached.shape == expected.shape
+    assert torch.allclose(cached[mask].float(), expected[mask], atol=1e-2, rtol=1e-2)
+    assert not cached[~mask].any()  # padding stays zero
+
+
+def test_state_dict_sha1_changes_with_the_weights():
+    layer = torch.nn.Linear(3, 2)
+    sha = state_dict_sha1(layer)
+    assert state_dict_sha1(layer) == sha
+    with torch.no_grad():
+        layer.bias[0] += 1
+    assert state_dict_sha1(layer) != sha
+
+
+def write_shards(data_dir: Path, shard_sizes, type_path="train"):
+    n = 0
+    for i, size in enumerate(shard_sizes):
+        lines = [f"example {n + j}" for j in range(size)]
+        data_dir.joinpath(f"{type_path}.{i}.source").write_text("".join(x + "\n" for x in lines))
+        data_dir.joinpath(f"{type_path}.{i}.target").write_text("".join(x.upper() + "\n" for x in lines))
+        n += size
+    return n
+
+
+def test_streaming_ranks_yield_the_same_number_of_batches(tmp_path):
+    num_examples = write_shards(tmp_path, [70, 10, 50, 20])  # rank 0 gets 120 examples, rank 1 30
+    batch_counts = []
+    for rank in range(2):
+        dataset = StreamingSeq2SeqDataset(
+            None, tmp_path, 128, 128, batch_size=4, num_replicas=2, rank=rank, num_examples=num_examples
+        )
+        batches = list(dataset)
+        assert all(len(batch) == 4 for batch in batches)
+        assert all(x["tgt_texts"] == x["src_texts"].upper() for batch in batches for x in batch)
+        batch_counts.append(len(batches))
+    assert batch_counts == [num_examples // (4 * 2)] * 2
+
+
+def test_streaming_reads_every_example_once(tmp_path):
+    num_examples = write_shards(tmp_path, [7, 5, 3])
+    seen = []
+    for rank in range(2):
+        dataset = StreamingSeq2SeqDataset(None, tmp_path, 128, 128, batch_size=2, num_replicas=2, rank=rank)
+        seen.extend(x["src_texts"] for batch in dataset for x in batch)
+    assert sorted(seen) == sorted(f"example {i}" for i in range(num_examples))
+
+
+def test_mixture_dataset_keeps_the_language_pair_of_each_corpus(tmp_path, tokenizer):
+    en_dir = make_data_dir(tmp_path / "en")
+    fr_dir = tmp_path / "fr"
+    fr_dir.mkdir()
+    fr_dir.joinpath("train.source").write_text("allume la lumière\nréveille-moi à sept heures\n")
+    fr_dir.joinpath("train.target").write_text("iot_hue_lighton\nalarm_set SEP time FILL sept heures\n")
+    corpora = [
+        {"data_dir": str(en_dir), "src_lang": "en_XX", "tgt_lang": "en_XX"},
+        {"data_dir": str(fr_dir), "src_lang": "fr_XX", "tgt_lang": "fr_XX"},
+    ]
+    dataset = MixtureSeq2SeqDataset(tokenizer, corpora, 32, 32)
+    assert len(dataset) == 3 * len(SOURCES) + 2
+    assert dataset[len(dataset) - 1]["src_texts"] == "réveille-moi à sept heures"
+
+    ids = [0, len(dataset) - 2, 5]
+    batch = dataset.collate_fn([dataset[i] for i in ids])
+    assert batch["ids"].tolist() == ids
+    lang_ids = [tokenizer.lang_code_to_id[lang] for lang in ["en_XX", "fr_XX", "en_XX"]]
+    assert batch["tgt_lang_ids"].tolist() == lang_ids
+    for input_ids, labels, lang_id in zip(batch["input_ids"], batch["labels"], lang_ids):
+        assert lang_id in input_ids.tolist() and lang_id in labels.tolist()
+    assert torch.equal(batch["attention_mask"], batch["input_ids"].ne(tokenizer.pad_token_id).long())
+
+
+def test_temperature_sampler_upsamples_small_corpora():
+    sizes = [9000, 1000]
+    for temperature, small_share in [(1.0, 0.1), (2.0, 0.25), (100.0, 0.5)]:
+        sampler = TemperatureSampler(sizes, temperature=temperature, num_samples=20000)
+        indices = np.array(list(sampler))
+        assert len(indices) == len(sampler) == 20000
+        assert indices.min() >= 0 and indices.max() < sum(sizes)
+        assert abs(np.mean(indices >= sizes[0]) - small_share) < 0.02
+
+    ranks = [list(TemperatureSampler(sizes, num_replicas=2, rank=rank)) for rank in range(2)]
+    assert len(ranks[0]) == len(ranks[1]) == 5000 and ranks[0] != ranks[1]
+
+
+def test_shared_array_is_built_once_and_replaced_when_the_source_changes(tmp_path, shared_array_dir):
+    source = tmp_path / "train.source"
+    source.write_text("a\nbb\n")
+    calls = []
+
+    def build():
+        calls.append(1)
+        return [len(x) for x in source.read_text().splitlines()]
+
+    assert shared_array("src_lens", [source], build).tolist() == [1, 2]
+    assert shared_array("src_lens", [source], build).tolist() == [1, 2]
+    assert len(calls) == 1
+    assert isinstance(shared_array("src_lens", [source], build), np.memmap)
+
+    stat = source.stat()
+    source.write_text("ccc\n")
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert shared_array("src_lens", [source], build).tolist() == [3]
+    assert len(calls) == 2
+    assert len(list(shared_array_dir.glob("src_lens.*.npy"))) == 1  # the copy of the old contents is gone
@@ -0,0 +1,62 @@
+import argparse
+
+import pytest
+import pytorch_lightning as pl
+import torch
+
+from conftest import MBART_TINY, make_data_dir
+from distillation import TranslationDistiller
+from make_student import create_student_by_copying_alternating_layers
+from transformers import AutoConfig, AutoModelForSeq2SeqLM
+
+
+pytestmark = pytest.mark.usefixtures("shared_array_dir")
+
+
+def test_student_gets_the_picked_teacher_layers(tmp_path, tokenizer):
+    config = AutoConfig.from_pretrained(MBART_TINY, encoder_layers=12, decoder_layers=12)
+    teacher = AutoModelForSeq2SeqLM.from_config(config).eval()
+    teacher.save_pretrained(tmp_path / "teacher")
+    tokenizer.save_pretrained(tmp_path / "teacher")
+
+    student, e_layers, d_layers = create_student_by_copying_alternating_layers(
+        str(tmp_path / "teacher"), tmp_path / "student", e=4, d=3
+    )
+    assert (e_layers, d_layers) == ([0, 3, 7, 11], [0, 5, 11])
+    assert (student.config.encoder_layers, student.config.decoder_layers) == (4, 3)
+    for student_layers, teacher_layers, picked in [
+        (student.model.encoder.layers, teacher.model.encoder.layers, e_layers),
+        (student.model.decoder.layers, teacher.model.decoder.layers, d_layers),
+    ]:
+        for student_layer, i in zip(student_layers, picked):
+            expected = teacher_layers[i].state_dict()
+            for name, tensor in student_layer.state_dict().items():
+                assert torch.equal(tensor, expected[name]), (i, name)
+    torch.testing.assert_close(student.model.shared.weight, teacher.model.shared.weight)
+    assert AutoModelForSeq2SeqLM.from_pretrained(tmp_path / "student").config.decoder_layers == 3
+
+
+def test_distiller_step_blends_the_losses(tmp_path):
+    parser = pl.Trainer.add_argparse_args(argparse.ArgumentParser())
+    parser = TranslationDistiller.add_model_specific_args(parser, str(tmp_path))
+    data_dir = make_data_dir(tmp_path / "data")
+    args = ["--model_name_or_path", MBART_TINY, "--teacher", MBART_TINY, "--student_decoder_layers", "1"]
+    args += ["--data_dir", str(data_dir), "--output_dir", str(tmp_path / "output")]
+    args += ["--gpus", "0", "--num_workers", "0", "--task", "translation"]
+    args += ["--src_lang", "en_XX", "--tgt_lang", "en_XX"]
+    module = TranslationDistiller(parser.parse_args(args))
+    assert module.model.config.decoder_layers == 1
+    assert module.d_layer_ids == module.d_matches == [0]
+    assert not module.different_encoder
+
+    batch = next(iter(module.get_dataloader("train", batch_size=4)))
+    losses = dict(zip(module.loss_names, module._step(batch)))
+    assert all(torch.isfinite(loss) for loss in losses.values())
+    assert losses["hid_loss_enc"] == 0  # the student has the teacher's encoder
+    assert losses["hid_loss_dec"] > 0
+    expected = module.alpha_ce * losses["ce_loss"] + module.alpha_mlm * losses["mlm_loss"]
+    torch.testing.assert_close(losses["loss"], expected + module.alpha_hid * losses["hid_loss_dec"])
+
+    losses["loss"].backward()
+    assert module.model.model.decoder.layers[0].fc1.weight.grad is not None
+    assert all(p.grad is None for p in module.teacher.parameters())
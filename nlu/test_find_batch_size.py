@@ -0,0 +1,20 @@
+import numpy as np
+
+from find_batch_size import length_quantiles
+from utils import load_len_file
+
+
+def test_length_quantiles(tmp_path):
+    src_lens = np.arange(1, 101, dtype=np.int32)
+    tgt_lens = 2 * src_lens
+    len_file = tmp_path / "train.len"
+    with len_file.open("wb") as f:
+        np.save(f, np.stack([src_lens, tgt_lens]))
+    lens = load_len_file(len_file)
+
+    pairs = length_quantiles(lens, [0.0, 0.5, 0.9, 1.0], (1000, 1000))
+    assert pairs == [(1, 2), (51, 101), (91, 181), (100, 200)]
+    # two quantiles must still give (src, tgt) pairs, not all the sources and all the targets
+    assert length_quantiles(lens, [0.0, 1.0], (1000, 1000)) == [(1, 2), (100, 200)]
+    # clipped to the maximum lengths, duplicates removed
+    assert length_quantiles(lens, [0.0, 0.9, 1.0], (50, 150)) == [(1, 2), (50, 150)]
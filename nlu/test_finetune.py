@@ -0,0 +1,88 @@
+import argparse
+import json
+
+import pytest
+import pytorch_lightning as pl
+import torch
+
+from callbacks import Seq2SeqEarlyStopping, Seq2SeqLoggingCallback, Seq2SeqModelCheckpoint, SkipStaleValMetric
+from conftest import MBART_TINY, make_data_dir
+from finetune import SummarizationModule, TranslationModule
+
+
+pytestmark = pytest.mark.usefixtures("shared_array_dir")
+
+
+def make_args(tmp_path, *extra_args) -> argparse.Namespace:
+    parser = pl.Trainer.add_argparse_args(argparse.ArgumentParser())
+    parser = SummarizationModule.add_model_specific_args(parser, str(tmp_path))
+    data_dir = make_data_dir(tmp_path / "data", type_paths=("train", "val", "test"))
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    args = ["--model_name_or_path", MBART_TINY, "--data_dir", str(data_dir), "--output_dir", str(output_dir)]
+    args += ["--gpus", "0", "--num_workers", "0", "--task", "translation"]
+    args += ["--src_lang", "en_XX", "--tgt_lang", "en_XX"]
+    args += ["--eval_batch_size", "5", "--eval_beams", "1", "--eval_max_gen_length", "8"]
+    return parser.parse_args(args + list(extra_args))
+
+
+def run_validation(module: SummarizationModule) -> dict:
+    module.on_validation_epoch_start()
+    with torch.no_grad():
+        outputs = [module.validation_step(batch, i) for i, batch in enumerate(module.val_dataloader())]
+    return module.validation_epoch_end(outputs)
+
+
+class RecordingCallback:
+    def __init__(self):
+        self.calls = 0
+
+    def on_validation_end(self, trainer, pl_module):
+        self.calls += 1
+
+
+class SkippingCallback(SkipStaleValMetric, RecordingCallback):
+    pass
+
+
+def test_checks_without_generation_keep_the_metrics_and_skip_the_callbacks(tmp_path):
+    module = TranslationModule(make_args(tmp_path, "--val_generate_every", "2"))
+    callback = SkippingCallback()
+    results, updated = [], []
+    for _ in range(3):
+        results.append(run_validation(module))
+        updated.append(module.val_metric_updated)
+        callback.on_validation_end(None, module)
+        Seq2SeqLoggingCallback().on_validation_end(None, module)
+
+    n_val = len(module.get_dataset("val"))
+    assert [len(result["preds"]) for result in results] == [n_val, 0, n_val]
+    assert updated == [True, False, True]
+    assert ["val_bleu" in result for result in results] == [True, False, True]
+    assert callback.calls == 2  # the check that only computed the loss did not count
+
+    metrics = [json.loads(line) for line in module.metrics_save_path.with_suffix(".jsonl").open()]
+    assert metrics[0].keys() == metrics[1].keys() == metrics[2].keys()
+    assert metrics[1]["val_avg_bleu"] == metrics[0]["val_avg_bleu"]  # repeated from the last check that generated
+    assert [m["val_avg_generated_step_count"] for m in metrics] == [1, 1, 3]
+    assert metrics[1]["val_avg_loss"] == pytest.approx(metrics[0]["val_avg_loss"])
+
+    # the gate comes first in the MRO of the callbacks main() installs
+    for callback_class in [Seq2SeqModelCheckpoint, Seq2SeqEarlyStopping]:
+        assert callback_class.on_validation_end is SkipStaleValMetric.on_validation_end
+        assert callback_class.on_train_epoch_end is SkipStaleValMetric.on_train_epoch_end
+
+
+def test_val_generate_subsample_generates_for_the_sample_only(tmp_path):
+    module = TranslationModule(make_args(tmp_path, "--val_generate_subsample", "3"))
+    result = run_validation(module)
+    assert len(module.val_generate_ids) == 3
+    assert len(result["preds"]) == 3
+    assert module.val_metric_updated and "val_bleu" in result
+
+
+@pytest.mark.parametrize("batching", [["--sortish_sampler"], ["--max_tokens_per_batch", "256"]])
+def test_mixture_rejects_length_batching(tmp_path, batching):
+    args = make_args(tmp_path, "--mixture", f"{tmp_path / 'data'}:en_XX", *batching)
+    with pytest.raises(ValueError, match="--mixture samples corpora by temperature"):
+        TranslationModule(args)
@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from conftest import MBART_TINY, SOURCES, TARGETS
+from lora import DEFAULT_TARGET_MODULES, LoRALinear, inject_lora, load_lora, merge_lora, save_lora
+from transformers import AutoModelForSeq2SeqLM
+
+
+LORA_CONFIG = {"r": 4, "alpha": 8, "target_modules": DEFAULT_TARGET_MODULES, "base_model_name_or_path": MBART_TINY}
+
+
+@pytest.fixture(scope="module")
+def batch(tokenizer):
+    batch = tokenizer(SOURCES, padding=True, return_tensors="pt")
+    batch["decoder_input_ids"] = tokenizer(TARGETS, padding=True, return_tensors="pt")["input_ids"]
+    return batch
+
+
+def logits(model, batch) -> torch.Tensor:
+    with torch.no_grad():
+        return model(**batch).logits
+
+
+def test_inject_lora_trains_only_the_adapters_and_starts_from_the_base_model(batch):
+    model = AutoModelForSeq2SeqLM.from_pretrained(MBART_TINY).eval()
+    expected = logits(model, batch)
+
+    n = inject_lora(model, LORA_CONFIG["r"], LORA_CONFIG["alpha"])
+    trainable = [name for name, p in model.named_parameters() if p.requires_grad]
+    assert len(trainable) == 2 * n
+    assert all(name.rsplit(".", 1)[-1] in ["lora_A", "lora_B"] for name in trainable)
+    assert all(".decoder." in name for name in trainable)
+    torch.testing.assert_close(logits(model, batch), expected)  # B starts at zero
+
+
+def test_saved_adapters_load_and_merge_into_the_adapted_model(tmp_path, batch):
+    model = AutoModelForSeq2SeqLM.from_pretrained(MBART_TINY).eval()
+    inject_lora(model, LORA_CONFIG["r"], LORA_CONFIG["alpha"])
+    torch.manual_seed(0)
+    for module in model.modules():
+        if isinstance(module, LoRALinear):
+            module.lora_B.data.normal_(std=0.1)
+    adapted = logits(model, batch)
+    save_lora(model, tmp_path, LORA_CONFIG)
+
+    loaded = AutoModelForSeq2SeqLM.from_pretrained(MBART_TINY).eval()
+    load_lora(loaded, tmp_path)
+    torch.testing.assert_close(logits(loaded, batch), adapted)
+
+    merge_lora(loaded)
+    assert not any(isinstance(module, LoRALinear) for module in loaded.modules())
+    torch.testing.assert_close(logits(loaded, batch), adapted, rtol=1e-4, atol=1e-4)
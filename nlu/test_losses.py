@@ -0,0 +1,91 @@
+import pytest
+import torch
+from torch import nn
+
+from conftest import MBART_TINY, SOURCES, TARGETS
+from packing import PackedSeq2SeqCollator, packed_forward
+from precision import autocast, check_amp_dtype, loss_parity
+from transformers import AutoModelForSeq2SeqLM
+from transformers.models.bart.modeling_bart import shift_tokens_right
+from utils import chunked_label_smoothed_nll_loss, label_smoothed_nll_loss
+
+
+@pytest.fixture(scope="module")
+def model():
+    return AutoModelForSeq2SeqLM.from_pretrained(MBART_TINY).eval()
+
+
+def summed_nll(logits, labels, pad_token_id) -> torch.Tensor:
+    return nn.functional.cross_entropy(
+        logits.flatten(0, 1).float(), labels.flatten(), ignore_index=pad_token_id, reduction="sum"
+    )
+
+
+def test_packed_forward_gives_the_unpacked_loss(tokenizer, model):
+    examples = [{"src_texts": src, "tgt_texts": tgt} for src, tgt in zip(SOURCES, TARGETS)]
+
+    def collate_fn(batch):
+        return tokenizer.prepare_seq2seq_batch(
+            [x["src_texts"] for x in batch], tgt_texts=[x["tgt_texts"] for x in batch], return_tensors="pt"
+        ).data
+
+    pad, decoder_start_token_id = tokenizer.pad_token_id, model.config.decoder_start_token_id
+    batch = collate_fn(examples)
+    decoder_input_ids = shift_tokens_right(batch["labels"], pad, decoder_start_token_id)
+    packed = PackedSeq2SeqCollator(collate_fn, pad, decoder_start_token_id, 64, 64)(examples)
+    assert len(packed["input_ids"]) < len(examples)
+    assert packed["labels"].ne(pad).sum() == batch["labels"].ne(pad).sum()
+
+    with torch.no_grad():
+        logits = model(
+            batch["input_ids"], attention_mask=batch["attention_mask"], decoder_input_ids=decoder_input_ids
+        ).logits
+        packed_logits = packed_forward(model, packed).logits
+    expected = summed_nll(logits, batch["labels"], pad)
+    assert torch.allclose(summed_nll(packed_logits, packed["labels"], pad), expected, rtol=1e-4)
+
+
+def test_cpu_bf16_autocast_loss_is_close_to_fp32(tokenizer, model):
+    batch = tokenizer.prepare_seq2seq_batch(SOURCES, tgt_texts=TARGETS, return_tensors="pt").data
+    cpu = torch.device("cpu")
+
+    def loss_fn():
+        return model(**batch).loss
+
+    fp32_loss, bf16_loss = loss_parity(loss_fn, "bf16", cpu)
+    assert fp32_loss != bf16_loss  # autocast did run in bf16
+    assert abs(bf16_loss - fp32_loss) / fp32_loss < 5e-2
+    with autocast("fp32", cpu), torch.no_grad():
+        assert loss_fn().item() == fp32_loss
+
+
+def test_check_amp_dtype():
+    check_amp_dtype("bf16", on_gpu=False)
+    with pytest.raises(ValueError, match="fp16 autocast needs a GPU"):
+        check_amp_dtype("fp16", on_gpu=False)
+    with pytest.raises(ValueError, match="--amp_dtype must be one of"):
+        check_amp_dtype("int8", on_gpu=False)
+
+
+def test_chunked_label_smoothed_nll_loss_matches_full_logits():
+    torch.manual_seed(0)
+    pad, vocab_size, d_model = 1, 50, 16
+    hidden = torch.randn(3, 7, d_model, dtype=torch.float64, requires_grad=True)
+    weight = torch.randn(vocab_size, d_model, dtype=torch.float64, requires_grad=True)
+    bias = torch.randn(1, vocab_size, dtype=torch.float64)
+    target = torch.randint(2, vocab_size, (3, 7))
+    target[0, 4:] = target[2, 6:] = pad
+
+    lprobs = nn.functional.log_softmax(hidden @ weight.T + bias, dim=-1)
+    loss, nll_loss = label_smoothed_nll_loss(lprobs, target, 0.1, ignore_index=pad)
+    hidden_grad, weight_grad = torch.autograd.grad(loss, [hidden, weight])
+
+    # 17 non-pad positions in chunks of 5, the last one partial
+    chunked_loss, chunked_nll_loss = chunked_label_smoothed_nll_loss(
+        hidden, weight, bias, target, 0.1, ignore_index=pad, chunk_size=5
+    )
+    assert torch.allclose(chunked_loss, loss)
+    assert torch.allclose(chunked_nll_loss, nll_loss)
+    chunked_grads = torch.autograd.grad(chunked_loss, [hidden, weight])
+    assert torch.allclose(chunked_grads[0], hidden_grad)
+    assert torch.allclose(chunked_grads[1], weight_grad)
@@ -0,0 +1,62 @@
+import argparse
+
+import pytest
+import torch
+
+from conftest import MBART_TINY, SOURCES, TARGETS, make_data_dir
+from prune_vocab import PrunedVocabTokenizer, load_tokenizer, main
+from transformers import AutoModelForSeq2SeqLM
+
+
+@pytest.fixture(scope="module")
+def pruned_dir(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp("pruned")
+    data_dir = make_data_dir(tmp_path / "data", type_paths=("train",))
+    output_dir = tmp_path / "pruned"
+    args = argparse.Namespace(
+        model_name_or_path=MBART_TINY,
+        tokenizer_name=None,
+        data_dir=[str(data_dir)],
+        splits=["train"],
+        output_dir=str(output_dir),
+    )
+    main(args)
+    return output_dir
+
+
+def test_pruned_tokenizer_round_trips_through_the_unpruned_ids(pruned_dir, tokenizer):
+    pruned = load_tokenizer(pruned_dir)
+    assert isinstance(pruned, PrunedVocabTokenizer)
+    assert len(pruned) < len(tokenizer)
+
+    for texts in [SOURCES, TARGETS]:
+        input_ids = tokenizer(texts)["input_ids"]
+        pruned_ids = pruned(texts)["input_ids"]
+        assert pruned.from_pruned(pruned_ids) == input_ids
+        assert pruned.batch_decode(pruned_ids, skip_special_tokens=True) == tokenizer.batch_decode(
+            input_ids, skip_special_tokens=True
+        )
+    for code, i in tokenizer.lang_code_to_id.items():
+        assert pruned.from_pruned(pruned.lang_code_to_id[code]) == i
+    assert pruned.pad_token_id == pruned.to_pruned(tokenizer.pad_token_id)
+    assert pruned.convert_tokens_to_ids("<unk>") == pruned.unk_token_id
+
+
+def test_pruned_model_gives_the_logits_of_the_kept_tokens(pruned_dir, tokenizer):
+    pruned = load_tokenizer(pruned_dir)
+    model = AutoModelForSeq2SeqLM.from_pretrained(MBART_TINY).eval()
+    pruned_model = AutoModelForSeq2SeqLM.from_pretrained(pruned_dir).eval()
+    assert pruned_model.config.vocab_size == len(pruned)
+    assert pruned_model.config.pad_token_id == pruned.pad_token_id
+
+    batch = tokenizer(SOURCES, padding=True, return_tensors="pt")
+    decoder_input_ids = tokenizer(TARGETS, padding=True, return_tensors="pt")["input_ids"]
+    with torch.no_grad():
+        logits = model(**batch, decoder_input_ids=decoder_input_ids).logits
+        pruned_logits = pruned_model(
+            input_ids=pruned.to_pruned(batch["input_ids"]),
+            attention_mask=batch["attention_mask"],
+            decoder_input_ids=pruned.to_pruned(decoder_input_ids),
+        ).logits
+    kept = torch.from_numpy(pruned.vocab_map)
+    torch.testing.assert_close(pruned_logits, logits[..., kept])
@@ -0,0 +1,57 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+from conftest import MBART_TINY
+from fast_load import load_seq2seq_model, safetensors_path, write_safetensors
+from transformers import AutoModelForSeq2SeqLM
+
+
+RUN_EVAL = str(Path(__file__).parent / "run_eval.py")
+STARTUP_BUDGET_S = 10  # as in the README
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory, tokenizer):
+    model_dir = tmp_path_factory.mktemp("tiny_mbart")
+    AutoModelForSeq2SeqLM.from_pretrained(MBART_TINY).save_pretrained(model_dir)
+    tokenizer.save_pretrained(model_dir)
+    return model_dir
+
+
+def benchmark_startup(model_dir, startup_budget):
+    command = [sys.executable, RUN_EVAL, str(model_dir), "--benchmark_startup", "--repeats", "1", "--device", "cpu"]
+    command += ["--startup_budget", str(startup_budget)]
+    return subprocess.run(command, capture_output=True, text=True)
+
+
+def test_fast_load_gives_the_saved_weights(model_dir):
+    pytest.importorskip("safetensors")
+    write_safetensors(model_dir)
+    if safetensors_path(model_dir) is None:
+        pytest.skip("loading on the meta device needs torch >= 2.1")
+
+    expected = AutoModelForSeq2SeqLM.from_pretrained(model_dir).state_dict()
+    state_dict = load_seq2seq_model(model_dir).state_dict()
+    assert state_dict.keys() == expected.keys()
+    for name, tensor in expected.items():
+        assert torch.equal(state_dict[name], tensor), name
+
+
+@pytest.mark.slow
+def test_startup_within_budget(model_dir):
+    result = benchmark_startup(model_dir, STARTUP_BUDGET_S)
+    assert result.returncode == 0, result.stderr
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    assert timings["startup_s"] < STARTUP_BUDGET_S
+    assert timings["import_s"] + timings["tokenizer_s"] + timings["model_s"] < timings["startup_s"]
+
+
+def test_startup_over_budget_fails(model_dir):
+    result = benchmark_startup(model_dir, 0)
+    assert result.returncode != 0
+    assert "exceeds the budget" in result.stderr
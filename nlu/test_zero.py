@@ -0,0 +1,20 @@
+import argparse
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+
+from zero import _check_rank
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.skipif(not dist.is_available() or not dist.is_gloo_available(), reason="needs gloo")
+def test_zero1_matches_adamw_on_gloo():
+    args = argparse.Namespace(world_size=2, steps=2, d_model=32, port=free_port())
+    torch.multiprocessing.spawn(_check_rank, args=(args,), nprocs=args.world_size)
@@ -1,39 +1,35 @@
 # Adopted from https://raw.githubusercontent.com/huggingface/transformers/88e84186e5a0d5dd78b62b1a8e97b2c269426442/examples/research_projects/seq2seq-distillation/utils.py
 
+import hashlib
 import itertools
 import json
-import linecache
 import math
+import mmap
+import multiprocessing
 import os
 import pickle
 import socket
+import tempfile
+from functools import lru_cache
 from logging import getLogger
 from pathlib import Path
-from typing import Callable, Dict, Iterable, List, Tuple, Union
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
 
-import git
 import numpy as np
 import torch
 import torch.distributed as dist
-from rouge_score import rouge_scorer, scoring
-from sacrebleu import corpus_bleu
+import torch.utils.checkpoint
 from torch import nn
-from torch.utils.data import Dataset, Sampler
+from filelock import FileLock
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
 
-from sentence_splitter import add_newline_to_end_of_each_sentence
+# git, rouge_score, sacrebleu and sentence_splitter (nltk) are imported where they are used: they are slow to import
+# and evaluation-only runs need none of them
 from transformers import BartTokenizer, EvalPrediction, PreTrainedTokenizer, T5Tokenizer
 from transformers.file_utils import cached_property
 from transformers.models.bart.modeling_bart import shift_tokens_right
 
 
-try:
-    from fairseq.data.data_utils import batch_by_size
-
-    FAIRSEQ_AVAILABLE = True
-except (ImportError, ModuleNotFoundError):
-    FAIRSEQ_AVAILABLE = False
-
-
 def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=-100):
     """From fairseq"""
     if target.dim() == lprobs.dim() - 1:
@@ -55,6 +51,42 @@ def label_smoothed_nll_loss(lprobs, target, epsilon, ignore_index=-100):
     return loss, nll_loss
 
 
+def chunked_label_smoothed_nll_loss(
+    hidden_states, lm_head_weight, final_logits_bias, target, epsilon, ignore_index=-100, chunk_size=1024
+):
+    """label_smoothed_nll_loss of `hidden_states @ lm_head_weight.T + final_logits_bias` without the full logits.
+
+    Pad positions are dropped before the projection to the vocabulary, the rest is projected `chunk_size` positions
+    at a time and each chunk's logits are recomputed in backward instead of being kept, so at most one chunk of
+    (chunk_size, vocab_size) logits exists. Loss and gradients are those of label_smoothed_nll_loss.
+    """
+    hidden_states = hidden_states.reshape(-1, hidden_states.shape[-1])
+    target = target.reshape(-1)
+    if ignore_index is not None:
+        keep = target.ne(ignore_index)
+        hidden_states, target = hidden_states[keep], target[keep]
+
+    def chunk_losses(hidden, tgt, weight, bias):
+        lprobs = nn.functional.log_softmax(nn.functional.linear(hidden, weight) + bias, dim=-1)
+        return -lprobs.gather(dim=-1, index=tgt.unsqueeze(-1)).sum(), -lprobs.sum()
+
+    nll_loss = smooth_loss = hidden_states.new_zeros((), dtype=torch.float)
+    bias = final_logits_bias.reshape(-1)
+    for start in range(0, len(target), chunk_size):
+        hidden, tgt = hidden_states[start : start + chunk_size], target[start : start + chunk_size]
+        if hidden.requires_grad:
+            chunk = torch.utils.checkpoint.checkpoint(
+                chunk_losses, hidden, tgt, lm_head_weight, bias, use_reentrant=False
+            )
+        else:
+            chunk = chunk_losses(hidden, tgt, lm_head_weight, bias)
+        nll_loss = nll_loss + chunk[0]
+        smooth_loss = smooth_loss + chunk[1]
+    eps_i = epsilon / lm_head_weight.shape[0]
+    loss = (1.0 - epsilon) * nll_loss + eps_i * smooth_loss
+    return loss, nll_loss
+
+
 def lmap(f: Callable, x: Iterable) -> List:
     """list(map(f, x))"""
     return list(map(f, x))
@@ -62,6 +94,8 @@ def lmap(f: Callable, x: Iterable) -> List:
 
 def calculate_bleu(output_lns, refs_lns, **kwargs) -> dict:
     """Uses sacrebleu's corpus_bleu implementation."""
+    from sacrebleu import corpus_bleu
+
     return {"bleu": round(corpus_bleu(output_lns, [refs_lns], **kwargs).score, 4)}
 
 
@@ -123,15 +157,10 @@ class AbstractSeq2SeqDataset(Dataset):
         self.src_file = Path(data_dir).joinpath(type_path + ".source")
         self.tgt_file = Path(data_dir).joinpath(type_path + ".target")
         self.len_file = Path(data_dir).joinpath(type_path + ".len")
-        if os.path.exists(self.len_file):
-            self.src_lens = pickle_load(self.len_file)
-            self.used_char_len = False
-        else:
-            self.src_lens = self.get_char_lens(self.src_file)
-            self.used_char_len = True
+        self.src_lens, self.used_char_len = self.get_src_lens()  # shared by all processes, see shared_array
         self.max_source_length = max_source_length
         self.max_target_length = max_target_length
-        assert min(self.src_lens) > 0, f"found empty line in {self.src_file}"
+        assert np.min(self.src_lens) > 0, f"found empty line in {self.src_file}"
         self.tokenizer = tokenizer
         self.prefix = prefix if prefix is not None else ""
 
@@ -144,45 +173,66 @@ class AbstractSeq2SeqDataset(Dataset):
     def __len__(self):
         return len(self.src_lens)
 
+    def __getstate__(self):
+        return shared_array_state(self.__dict__)
+
+    def __setstate__(self, state):
+        self.__dict__.update(open_shared_array_state(state))
+
+    def get_src_lens(self):
+        """Source lengths used for sorting and batching, and whether they are only character counts."""
+        if os.path.exists(self.len_file):
+            return shared_array("src_lens", [self.len_file], lambda: load_len_file(self.len_file)[0]), False
+        return self.get_char_lens(self.src_file), True
+
     @staticmethod
-    def get_char_lens(data_file):
-        return [len(x) for x in Path(data_file).open().readlines()]
+    def get_char_lens(data_file) -> np.ndarray:
+        def char_lens():
+            with Path(data_file).open() as f:
+                return [len(x) for x in f]
+
+        return shared_array("char_lens", [data_file], char_lens)
+
+    @cached_property
+    def tgt_token_lens(self) -> Optional[np.ndarray]:
+        """Length in tokens of target documents, None unless make_len_file.py wrote them"""
+        if self.used_char_len:
+            return None
+        # empty for len files of the old format, which only have source lengths
+        lens = shared_array("tgt_lens", [self.len_file], lambda: load_len_file(self.len_file)[1:].ravel())
+        return lens if len(lens) else None
 
     @cached_property
     def tgt_lens(self):
-        """Length in characters of target documents"""
+        """Length in tokens of target documents if make_len_file.py was run, in characters otherwise"""
+        if self.tgt_token_lens is not None:
+            return self.tgt_token_lens
         return self.get_char_lens(self.tgt_file)
 
+    @cached_property
+    def src_lines(self):
+        return IndexedTextFile(self.src_file)
+
+    @cached_property
+    def tgt_lines(self):
+        return IndexedTextFile(self.tgt_file)
+
     def make_sortish_sampler(self, batch_size, distributed=False, shuffle=True, **kwargs):
         if distributed:
             return DistributedSortishSampler(self, batch_size, shuffle=shuffle, **kwargs)
         else:
-            return SortishSampler(self.src_lens, batch_size, shuffle=shuffle)
+            return SortishSampler(self.src_lens, batch_size, shuffle=shuffle, **kwargs)
 
-    def make_dynamic_sampler(self, max_tokens_per_batch=1024, **kwargs):
-        assert FAIRSEQ_AVAILABLE, "Dynamic batch size requires `pip install fairseq`"
+    def make_dynamic_sampler(self, max_tokens_per_batch=1024, distributed=False, **kwargs):
         assert not self.used_char_len, "You must call  python make_len_file.py before calling make_dynamic_sampler"
-        sorted_indices = list(self.make_sortish_sampler(1024, shuffle=False))
-
-        def num_tokens_in_example(i):
-            return min(self.src_lens[i], self.max_target_length)
-
-        # call fairseq cython function
-        batch_sampler: List[List[int]] = batch_by_size(
-            sorted_indices,
-            num_tokens_fn=num_tokens_in_example,
-            max_tokens=max_tokens_per_batch,
-            required_batch_size_multiple=64,
-        )
-        shuffled_batches = [batch_sampler[i] for i in np.random.permutation(range(len(batch_sampler)))]
-        # move the largest batch to the front to OOM quickly (uses an approximation for padding)
-        approximate_toks_per_batch = [max(self.src_lens[i] for i in batch) * len(batch) for batch in shuffled_batches]
-        largest_batch_idx = np.argmax(approximate_toks_per_batch)
-        shuffled_batches[0], shuffled_batches[largest_batch_idx] = (
-            shuffled_batches[largest_batch_idx],
-            shuffled_batches[0],
-        )
-        return shuffled_batches
+        # source and target lengths must both be in tokens, character counts would blow the budget
+        assert self.tgt_token_lens is not None, f"{self.len_file} has only source lengths, rerun make_len_file.py"
+        src_lens = np.minimum(self.src_lens, self.max_source_length)
+        tgt_lens = np.minimum(np.asarray(self.tgt_token_lens)[: len(self)], self.max_target_length)
+        if distributed:
+            kwargs.setdefault("num_replicas", dist.get_world_size())
+            kwargs.setdefault("rank", dist.get_rank())
+        return TokenBudgetBatchSampler(src_lens, tgt_lens, max_tokens_per_batch, **kwargs)
 
     def __getitem__(self, item):
         raise NotImplementedError("You must implement this")
@@ -194,9 +244,8 @@ class AbstractSeq2SeqDataset(Dataset):
 class LegacySeq2SeqDataset(AbstractSeq2SeqDataset):
     def __getitem__(self, index) -> Dict[str, torch.Tensor]:
         """Call tokenizer on src and tgt_lines"""
-        index = index + 1  # linecache starts at 1
-        source_line = self.prefix + linecache.getline(str(self.src_file), index).rstrip("\n")
-        tgt_line = linecache.getline(str(self.tgt_file), index).rstrip("\n")
+        source_line = self.prefix + self.src_lines[index]
+        tgt_line = self.tgt_lines[index]
         assert source_line, f"empty source line for index {index}"
         assert tgt_line, f"empty tgt line for index {index}"
         source_inputs = self.encode_line(self.tokenizer, source_line, self.max_source_length)
@@ -209,6 +258,7 @@ class LegacySeq2SeqDataset(AbstractSeq2SeqDataset):
             "input_ids": source_ids,
             "attention_mask": src_mask,
             "labels": target_ids,
+            "id": index,
         }
 
     def encode_line(self, tokenizer, line, max_length, pad_to_max_length=True, return_tensors="pt"):
@@ -233,6 +283,7 @@ class LegacySeq2SeqDataset(AbstractSeq2SeqDataset):
             "input_ids": source_ids,
             "attention_mask": source_mask,
             "labels": y,
+            "ids": torch.tensor([x["id"] for x in batch]),
         }
         return batch
 
@@ -241,12 +292,11 @@ class Seq2SeqDataset(AbstractSeq2SeqDataset):
     """A dataset that calls prepare_seq2seq_batch."""
 
     def __getitem__(self, index) -> Dict[str, str]:
-        index = index + 1  # linecache starts at 1
-        source_line = self.prefix + linecache.getline(str(self.src_file), index).rstrip("\n")
-        tgt_line = linecache.getline(str(self.tgt_file), index).rstrip("\n")
+        source_line = self.prefix + self.src_lines[index]
+        tgt_line = self.tgt_lines[index]
         assert source_line, f"empty source line for index {index}"
         assert tgt_line, f"empty tgt line for index {index}"
-        return {"tgt_texts": tgt_line, "src_texts": source_line, "id": index - 1}
+        return {"tgt_texts": tgt_line, "src_texts": source_line, "id": index}
 
     def collate_fn(self, batch) -> Dict[str, torch.Tensor]:
         """Call prepare_seq2seq_batch."""
@@ -262,6 +312,708 @@ class Seq2SeqDataset(AbstractSeq2SeqDataset):
         return batch_encoding
 
 
+class MixtureSeq2SeqDataset(Dataset):
+    """Several corpora, each with its own language pair, behind one index space.
+
+    `corpora` is a list of dicts with data_dir, src_lang and tgt_lang. The corpora are opened on first use. Items keep
+    their language pair and collate_fn tokenizes each pair separately before padding them into one batch, which also
+    gets the target language code of each example as tgt_lang_ids.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        corpora: List[Dict[str, str]],
+        max_source_length,
+        max_target_length,
+        type_path="train",
+        n_obs=None,
+        prefix="",
+        **dataset_kwargs
+    ):
+        super().__init__()
+        self.tokenizer = tokenizer
+        self.corpora = corpora
+        self.max_source_length = max_source_length
+        self.max_target_length = max_target_length
+        self.type_path = type_path
+        self.n_obs = n_obs
+        self.prefix = prefix
+        self.pad_token_id = self.tokenizer.pad_token_id
+        self.dataset_kwargs = dataset_kwargs
+
+    @cached_property
+    def datasets(self) -> List[Seq2SeqDataset]:
+        return [
+            Seq2SeqDataset(
+                self.tokenizer,
+                corpus["data_dir"],
+                self.max_source_length,
+                self.max_target_length,
+                type_path=self.type_path,
+                n_obs=self.n_obs,
+                prefix=self.prefix,
+                **self.dataset_kwargs,
+            )
+            for corpus in self.corpora
+        ]
+
+    @cached_property
+    def sizes(self) -> np.ndarray:
+        return np.array(lmap(len, self.datasets))
+
+    @cached_property
+    def offsets(self) -> np.ndarray:
+        return np.concatenate(([0], np.cumsum(self.sizes)))
+
+    @cached_property
+    def src_lens(self) -> np.ndarray:
+        return np.concatenate([np.asarray(dataset.src_lens) for dataset in self.datasets])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index) -> Dict[str, Union[str, int]]:
+        corpus = int(np.searchsorted(self.offsets, index, side="right")) - 1
+        example = self.datasets[corpus][index - self.offsets[corpus]]
+        example.update(id=index, corpus=corpus)
+        return example
+
+    def make_sortish_sampler(self, batch_size, distributed=False, shuffle=True, **kwargs):
+        if distributed:
+            return DistributedSortishSampler(self, batch_size, shuffle=shuffle, **kwargs)
+        else:
+            return SortishSampler(self.src_lens, batch_size, shuffle=shuffle, **kwargs)
+
+    def make_temperature_sampler(self, temperature=1.0, distributed=False, **kwargs):
+        if distributed:
+            kwargs.setdefault("num_replicas", dist.get_world_size())
+            kwargs.setdefault("rank", dist.get_rank())
+        return TemperatureSampler(self.sizes, temperature=temperature, **kwargs)
+
+    def collate_fn(self, batch) -> Dict[str, torch.Tensor]:
+        input_ids, labels = [None] * len(batch), [None] * len(batch)
+        for corpus in sorted(set(x["corpus"] for x in batch)):
+            positions = [i for i, x in enumerate(batch) if x["corpus"] == corpus]
+            lang_kwargs = {k: self.corpora[corpus][k] for k in ["src_lang", "tgt_lang"]}
+            lang_kwargs = {**self.dataset_kwargs, **lang_kwargs}
+            batch_encoding = self.tokenizer.prepare_seq2seq_batch(
+                [batch[i]["src_texts"] for i in positions],
+                tgt_texts=[batch[i]["tgt_texts"] for i in positions],
+                max_length=self.max_source_length,
+                max_target_length=self.max_target_length,
+                padding=False,
+                **lang_kwargs,
+            )
+            for i, src_ids, tgt_ids in zip(positions, batch_encoding["input_ids"], batch_encoding["labels"]):
+                input_ids[i], labels[i] = src_ids, tgt_ids
+        input_ids = pad_token_ids(input_ids, self.pad_token_id)
+        tgt_langs = [self.corpora[x["corpus"]]["tgt_lang"] for x in batch]
+        return {
+            "input_ids": input_ids,
+            "attention_mask": input_ids.ne(self.pad_token_id).long(),
+            "labels": pad_token_ids(labels, self.pad_token_id),
+            "ids": torch.tensor([x["id"] for x in batch]),
+            "tgt_lang_ids": torch.tensor(self.tokenizer.convert_tokens_to_ids(tgt_langs)),
+        }
+
+
+class TemperatureSampler(Sampler):
+    """Picks a corpus with probability proportional to size ** (1 / temperature), then one of its examples.
+
+    temperature=1 samples all examples equally often, higher temperatures upsample the smaller corpora. Each of the
+    num_replicas ranks draws its own num_samples / num_replicas indices, seeded by (seed, epoch, rank).
+    """
+
+    def __init__(self, sizes, temperature=1.0, num_samples=None, num_replicas=1, rank=0, seed=0):
+        self.sizes = np.asarray(sizes)
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes)))
+        weights = self.sizes ** (1.0 / temperature)
+        self.probs = weights / weights.sum()
+        num_samples = self.sizes.sum() if num_samples is None else num_samples
+        self.num_samples = int(math.ceil(num_samples / num_replicas))
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank])
+        corpora = rng.choice(len(self.sizes), size=self.num_samples, p=self.probs)
+        indices = self.offsets[corpora] + (rng.random(self.num_samples) * self.sizes[corpora]).astype(np.int64)
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+class StreamingSeq2SeqDataset(IterableDataset):
+    """Streams {type_path}.source/.target, or the shards {type_path}.*.source/.target, in constant memory.
+
+    Shards are split across DDP ranks and DataLoader workers, or their lines are if there are fewer shards than
+    readers, so every example is read exactly once per epoch. Examples go through a bounded shuffle buffer and are cut
+    into batches of similar length from pools of 50 batches. Yields whole batches: use DataLoader(batch_size=None).
+
+    With `num_examples`, every rank yields exactly num_examples // (batch_size * num_replicas) batches, as DDP needs:
+    a reader whose shards run out before that starts over on them, one whose shards last longer stops early.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        data_dir,
+        max_source_length,
+        max_target_length,
+        batch_size,
+        type_path="train",
+        prefix="",
+        shuffle_buffer_size=100000,
+        num_replicas=1,
+        rank=0,
+        seed=0,
+        num_examples=None,
+        **dataset_kwargs
+    ):
+        super().__init__()
+        src_files = sorted(Path(data_dir).glob(type_path + ".*.source")) or [Path(data_dir) / (type_path + ".source")]
+        self.shards = [(src_file, src_file.with_suffix(".target")) for src_file in src_files]
+        self.tokenizer = tokenizer
+        self.max_source_length = max_source_length
+        self.max_target_length = max_target_length
+        self.batch_size = batch_size
+        self.prefix = prefix if prefix is not None else ""
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_examples = num_examples
+        self.dataset_kwargs = dataset_kwargs
+        dataset_kwargs.update({"add_prefix_space": True} if isinstance(self.tokenizer, BartTokenizer) else {})
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        num_workers, worker_id = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id)
+        num_readers = self.num_replicas * num_workers
+        reader = self.rank * num_workers + worker_id
+        rng = np.random.default_rng([self.seed, self.epoch, reader])
+        cycle = self.num_examples is not None
+        examples = self.read_examples(reader, num_readers, rng, cycle)
+        examples = self.shuffle_buffer(examples, self.shuffle_buffer_size, rng)
+        batches = self.length_batches(examples, self.batch_size, rng)
+        if cycle:
+            # every rank yields the same number of batches, or the first one to finish stalls the others in all-reduce
+            num_batches = self.num_examples // (self.batch_size * self.num_replicas)
+            batches = itertools.islice(batches, num_batches // num_workers + (worker_id < num_batches % num_workers))
+        return batches
+
+    def read_examples(self, reader, num_readers, rng, cycle=False) -> Iterable[Dict[str, str]]:
+        """The examples of this reader's shards in random shard order, over and over again if `cycle`."""
+        if len(self.shards) >= num_readers:
+            shards, stride, offset = self.shards[reader::num_readers], 1, 0
+        else:
+            shards, stride, offset = self.shards, num_readers, reader
+        while True:
+            num_read = 0
+            for shard in rng.permutation(len(shards)):
+                src_file, tgt_file = shards[shard]
+                with src_file.open(encoding="utf-8") as src_f, tgt_file.open(encoding="utf-8") as tgt_f:
+                    for src_line, tgt_line in itertools.islice(zip(src_f, tgt_f), offset, None, stride):
+                        num_read += 1
+                        yield {"tgt_texts": tgt_line.rstrip("\n"), "src_texts": self.prefix + src_line.rstrip("\n")}
+            if not cycle:
+                return
+            if num_read == 0:
+                raise ValueError(f"reader {reader} of {num_readers} has no examples in {[s for s, _ in shards]}")
+
+    @staticmethod
+    def shuffle_buffer(examples: Iterable, buffer_size: int, rng) -> Iterable:
+        buffer = []
+        for example in examples:
+            if len(buffer) < buffer_size:
+                buffer.append(example)
+                continue
+            i = rng.integers(buffer_size)
+            yield buffer[i]
+            buffer[i] = example
+        rng.shuffle(buffer)
+        yield from buffer
+
+    @staticmethod
+    def length_batches(examples: Iterable[Dict[str, str]], batch_size: int, rng) -> Iterable[List[Dict[str, str]]]:
+        """Sort pools of 50 batches by source length in characters and yield their batches in random order."""
+        examples = iter(examples)
+        for pool in iter(lambda: list(itertools.islice(examples, batch_size * 50)), []):
+            pool.sort(key=lambda x: len(x["src_texts"]), reverse=True)
+            batches = list(chunks(pool, batch_size))
+            for i in rng.permutation(len(batches)):
+                yield batches[i]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def collate_fn(self, batch) -> Dict[str, torch.Tensor]:
+        """Call prepare_seq2seq_batch."""
+        batch_encoding: Dict[str, torch.Tensor] = self.tokenizer.prepare_seq2seq_batch(
+            [x["src_texts"] for x in batch],
+            tgt_texts=[x["tgt_texts"] for x in batch],
+            max_length=self.max_source_length,
+            max_target_length=self.max_target_length,
+            return_tensors="pt",
+            **self.dataset_kwargs,
+        ).data
+        return batch_encoding
+
+
+class BinarizedSeq2SeqDataset(AbstractSeq2SeqDataset):
+    """A dataset that reads token ids written by binarize_data.py, so collate_fn only pads and stacks."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        meta = load_json(self.meta_file)
+        for k in ["max_source_length", "max_target_length", "prefix"]:
+            assert meta[k] == getattr(self, k), (
+                f"{self.meta_file} was written with {k}={meta[k]}, rerun binarize_data.py"
+            )
+        for k in ["src_lang", "tgt_lang"]:
+            if self.dataset_kwargs.get(k):
+                assert meta[k] == self.dataset_kwargs[k], f"{self.meta_file} was written with {k}={meta[k]}"
+
+    def get_src_lens(self):
+        self.meta_file = self.src_file.with_suffix(".tok.json")
+        assert self.meta_file.exists(), f"{self.meta_file} not found, run python binarize_data.py first"
+        self.src_tokens = BinarizedTokenFile(self.src_file)
+        self.tgt_tokens = BinarizedTokenFile(self.tgt_file)
+        return shared_array("tok_lens", [self.src_tokens.offsets_file], self.src_tokens.lens), False
+
+    @cached_property
+    def tgt_token_lens(self):
+        """Length in tokens of target documents"""
+        return shared_array("tok_lens", [self.tgt_tokens.offsets_file], self.tgt_tokens.lens)
+
+    def __getitem__(self, index) -> Dict[str, np.ndarray]:
+        return {"input_ids": self.src_tokens[index], "labels": self.tgt_tokens[index], "id": index}
+
+    def collate_fn(self, batch) -> Dict[str, torch.Tensor]:
+        input_ids = pad_token_ids([x["input_ids"] for x in batch], self.pad_token_id)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": input_ids.ne(self.pad_token_id).long(),
+            "labels": pad_token_ids([x["labels"] for x in batch], self.pad_token_id),
+            "ids": torch.tensor([x["id"] for x in batch]),
+        }
+
+
+class IndexedTextFile:
+    """Random access to the lines of a text file through mmap and a byte-offset index stored next to it.
+
+    The index ({path}.idx, int64 offsets of the line starts followed by the file size) is built once and rebuilt only
+    if the size, mtime or inode of the file, recorded in {path}.idx.json, changed. Each process keeps only the index
+    and the mapping. Lines lose their "\n" and, as with linecache, a "\r" before it.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.index_file = Path(f"{path}.idx")
+        self._offsets = None
+        self._mmap = None
+        if not self.index_file.exists() or line_index_key(self.index_file) != file_stat_key(self.path):
+            build_line_index(self.path, self.index_file)
+
+    @property
+    def offsets(self) -> np.ndarray:
+        if self._offsets is None:
+            self._offsets = np.memmap(self.index_file, dtype=np.int64, mode="r")
+        return self._offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index) -> str:
+        if self._mmap is None:
+            with self.path.open("rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        line = self._mmap[self.offsets[index] : self.offsets[index + 1]].decode("utf-8")
+        line = line[:-1] if line.endswith("\n") else line
+        return line[:-1] if line.endswith("\r") else line
+
+    def __getstate__(self):
+        return {**self.__dict__, "_offsets": None, "_mmap": None}
+
+
+def file_stat_key(path) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "inode": stat.st_ino}
+
+
+def line_index_key(index_file) -> Optional[dict]:
+    """The file_stat_key of the file `index_file` was built for, None if unknown."""
+    try:
+        return load_json(f"{index_file}.json")
+    except (OSError, ValueError):
+        return None
+
+
+def build_line_index(path, index_file, chunk_size=2 ** 24) -> np.ndarray:
+    """Write the byte offsets of the line starts of `path`, followed by its size, to `index_file`, and the
+    file_stat_key of `path` to `{index_file}.json`."""
+    key = file_stat_key(path)
+    offsets = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+            offsets.append(newlines.astype(np.int64) + position + 1)
+            position += len(chunk)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != position:  # last line without a trailing newline
+        offsets = np.append(offsets, position)
+    # several ranks may build the same index at once
+    replace_atomic(offsets.tofile, index_file)
+    replace_atomic(lambda tmp_file: save_json(key, tmp_file), f"{index_file}.json")
+    return offsets
+
+
+class BinarizedTokenFile:
+    """Flat int32 token ids of a text file plus int64 offsets of its lines, read through np.memmap."""
+
+    def __init__(self, text_file):
+        self.ids_file = Path(f"{text_file}.tok")
+        self.offsets_file = Path(f"{text_file}.tok.idx")
+        self._ids = None
+        self._offsets = None
+
+    @property
+    def ids(self) -> np.ndarray:
+        if self._ids is None:
+            self._ids = np.memmap(self.ids_file, dtype=np.int32, mode="r")
+        return self._ids
+
+    @property
+    def offsets(self) -> np.ndarray:
+        if self._offsets is None:
+            self._offsets = np.memmap(self.offsets_file, dtype=np.int64, mode="r")
+        return self._offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index) -> np.ndarray:
+        return self.ids[self.offsets[index] : self.offsets[index + 1]]
+
+    def lens(self) -> np.ndarray:
+        return np.diff(self.offsets).astype(np.int32)
+
+    def __getstate__(self):
+        # memmaps are reopened lazily in each DataLoader worker instead of being pickled as copies
+        return {**self.__dict__, "_ids": None, "_offsets": None}
+
+
+def binarize_seq2seq_split(
+    tokenizer,
+    data_dir,
+    type_path,
+    max_source_length,
+    max_target_length,
+    prefix="",
+    chunk_size=1024,
+    **tokenizer_kwargs
+) -> int:
+    """Tokenize {type_path}.source and .target once, the same way Seq2SeqDataset.collate_fn does.
+
+    Writes {type_path}.source.tok and {type_path}.target.tok (flat int32 token ids), the matching .tok.idx files
+    (int64 line offsets into the ids) and {type_path}.tok.json. Returns the number of examples.
+    """
+    src_file = Path(data_dir).joinpath(type_path + ".source")
+    tgt_file = Path(data_dir).joinpath(type_path + ".target")
+    src_tokens, tgt_tokens = BinarizedTokenFile(src_file), BinarizedTokenFile(tgt_file)
+    offsets = {"input_ids": [0], "labels": [0]}
+    with src_file.open(encoding="utf-8") as src_f, tgt_file.open(encoding="utf-8") as tgt_f, src_tokens.ids_file.open(
+        "wb"
+    ) as src_ids_f, tgt_tokens.ids_file.open("wb") as tgt_ids_f:
+        ids_files = {"input_ids": src_ids_f, "labels": tgt_ids_f}
+        while True:
+            src_lines = [prefix + x.rstrip("\n") for x in itertools.islice(src_f, chunk_size)]
+            tgt_lines = [x.rstrip("\n") for x in itertools.islice(tgt_f, chunk_size)]
+            assert len(src_lines) == len(tgt_lines), f"{src_file} and {tgt_file} have different numbers of lines"
+            if not src_lines:
+                break
+            batch_encoding = tokenizer.prepare_seq2seq_batch(
+                src_lines,
+                tgt_texts=tgt_lines,
+                max_length=max_source_length,
+                max_target_length=max_target_length,
+                padding=False,
+                **tokenizer_kwargs,
+            )
+            for k, f in ids_files.items():
+                np.fromiter(itertools.chain.from_iterable(batch_encoding[k]), dtype=np.int32).tofile(f)
+                offsets[k].extend((offsets[k][-1] + np.cumsum(lmap(len, batch_encoding[k]))).tolist())
+    np.array(offsets["input_ids"], dtype=np.int64).tofile(src_tokens.offsets_file)
+    np.array(offsets["labels"], dtype=np.int64).tofile(tgt_tokens.offsets_file)
+    meta = {
+        "tokenizer": tokenizer.name_or_path,
+        "max_source_length": max_source_length,
+        "max_target_length": max_target_length,
+        "prefix": prefix,
+        "src_lang": tokenizer_kwargs.get("src_lang"),
+        "tgt_lang": tokenizer_kwargs.get("tgt_lang"),
+        "n_obs": len(offsets["input_ids"]) - 1,
+    }
+    save_json(meta, src_file.with_suffix(".tok.json"))
+    return meta["n_obs"]
+
+
+def load_len_file(path) -> np.ndarray:
+    """Token lengths of shape (2, n) written by make_len_file.py, or (1, n) for a pickled list of source lengths."""
+    with open(path, "rb") as f:
+        if f.read(6) == b"\x93NUMPY":
+            f.seek(0)
+            return np.load(f)
+    return np.array(pickle_load(path))[None]
+
+
+SHARED_ARRAY_DIR = Path("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()) / "seq2seq_arrays"
+
+
+def shared_array(name: str, source_files: Sequence, build: Callable[[], Sequence]) -> np.ndarray:
+    """`np.asarray(build())`, computed once per machine rather than once per DDP rank and DataLoader worker.
+
+    The first process to get here saves it under SHARED_ARRAY_DIR (shared memory where there is /dev/shm), keyed by
+    `name` and the path, size and mtime of `source_files`; every process, this one included, memory-maps that copy
+    read-only. Editing a source file changes the key, and the copies for the old contents are deleted when the new one
+    is written (processes that still map them keep their data). Empty arrays, which cannot be memory-mapped, are
+    returned as they are.
+    """
+    sources = hashlib.sha1(name.encode())
+    contents = hashlib.sha1()
+    for source_file in source_files:
+        stat = os.stat(source_file)
+        sources.update(f"{Path(source_file).resolve()}".encode())
+        contents.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    SHARED_ARRAY_DIR.mkdir(parents=True, exist_ok=True)
+    prefix = f"{name}.{sources.hexdigest()}"
+    path = SHARED_ARRAY_DIR / f"{prefix}.{contents.hexdigest()}.npy"
+    if not path.exists():
+        with FileLock(f"{path}.lock"):
+            if not path.exists():
+                array = np.asarray(build())
+                if array.size == 0:
+                    return array
+
+                def save(tmp_path):
+                    with open(tmp_path, "wb") as f:  # np.save would append .npy to a path
+                        np.save(f, array)
+
+                replace_atomic(save, path)
+                for stale in SHARED_ARRAY_DIR.glob(f"{prefix}.*"):
+                    if stale.name.endswith((".npy", ".npy.lock")) and not stale.name.startswith(path.name):
+                        try:
+                            stale.unlink()
+                        except FileNotFoundError:  # removed by another process
+                            pass
+    return np.load(path, mmap_mode="r")
+
+
+class _SharedArrayRef(NamedTuple):
+    path: str
+    length: int
+
+
+def shared_array_state(state: dict) -> dict:
+    """`state` for pickling, with the arrays of shared_array (or prefixes of them, like src_lens[:n_obs]) replaced by
+    their path, so DataLoader workers started with spawn map the shared copy instead of receiving one."""
+    return {
+        k: _SharedArrayRef(v.filename, len(v))
+        if isinstance(v, np.memmap) and v.filename and Path(v.filename).parent == SHARED_ARRAY_DIR
+        else v
+        for k, v in state.items()
+    }
+
+
+def open_shared_array_state(state: dict) -> dict:
+    return {
+        k: np.load(v.path, mmap_mode="r")[: v.length] if isinstance(v, _SharedArrayRef) else v
+        for k, v in state.items()
+    }
+
+
+def file_sha1(path, chunk_size=2 ** 24) -> str:
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def replace_atomic(write: Callable[[str], None], path) -> None:
+    """`write(tmp_path)` to a temporary file next to `path` and rename it to `path`, so `path` is never half written,
+    even when several processes (DDP ranks, Pool workers) write it at once."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def tokenizer_sha1(tokenizer) -> str:
+    """Hash of everything about a tokenizer that can change token counts: its class, vocabulary and special tokens."""
+    sha = hashlib.sha1(type(tokenizer).__name__.encode())
+    sha.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode())
+    sha.update(json.dumps(tokenizer.all_special_tokens, ensure_ascii=False).encode())
+    return sha.hexdigest()
+
+
+def state_dict_sha1(module: nn.Module) -> str:
+    """Hash of the names, dtypes and values of the weights and buffers of `module`."""
+    sha = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        sha.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        tensor = tensor.detach().cpu()
+        sha.update((tensor.float() if tensor.dtype == torch.bfloat16 else tensor).numpy().tobytes())
+    return sha.hexdigest()
+
+
+_len_tokenizer = None
+
+
+def _init_len_worker(tokenizer):
+    global _len_tokenizer
+    _len_tokenizer = tokenizer
+
+
+def _count_tokens(args) -> List[int]:
+    lines, is_target = args
+    if is_target and hasattr(_len_tokenizer, "as_target_tokenizer"):
+        with _len_tokenizer.as_target_tokenizer():
+            input_ids = _len_tokenizer(lines)["input_ids"]
+    else:
+        input_ids = _len_tokenizer(lines)["input_ids"]
+    return lmap(len, input_ids)
+
+
+def build_len_file(tokenizer, data_dir, type_path, num_workers=None, chunk_size=10000, force=False) -> np.ndarray:
+    """Write the token lengths of {type_path}.source and .target to {type_path}.len, see load_len_file.
+
+    The lengths are cached under a hash of the tokenizer and both files in {type_path}.len.json and only recomputed,
+    across a pool of `num_workers` processes, if one of them changed.
+    """
+    src_file = Path(data_dir).joinpath(type_path + ".source")
+    tgt_file = Path(data_dir).joinpath(type_path + ".target")
+    len_file = Path(data_dir).joinpath(type_path + ".len")
+    key_file = len_file.with_suffix(".len.json")
+    key = hashlib.sha1("".join([tokenizer_sha1(tokenizer), file_sha1(src_file), file_sha1(tgt_file)]).encode())
+    key = key.hexdigest()
+    if not force and len_file.exists() and key_file.exists() and load_json(key_file)["key"] == key:
+        return load_len_file(len_file)
+
+    lens = []
+    with multiprocessing.Pool(num_workers, initializer=_init_len_worker, initargs=(tokenizer,)) as pool:
+        for data_file, is_target in [(src_file, False), (tgt_file, True)]:
+            with data_file.open(encoding="utf-8") as f:
+                line_chunks = iter(lambda: [x.rstrip("\n") for x in itertools.islice(f, chunk_size)], [])
+                chunk_lens = pool.imap(_count_tokens, ((lines, is_target) for lines in line_chunks))
+                lens.append(np.fromiter(itertools.chain.from_iterable(chunk_lens), dtype=np.int32))
+    assert len(lens[0]) == len(lens[1]), f"{src_file} and {tgt_file} have different numbers of lines"
+    lens = np.stack(lens)
+    with len_file.open("wb") as f:
+        np.save(f, lens)
+    save_json({"key": key, "tokenizer": tokenizer.name_or_path}, key_file)
+    return lens
+
+
+class EncoderOutputCache:
+    """fp16 encoder hidden states of a dataset, written once by `build` and read through np.memmap.
+
+    The states of all examples are stored back to back in {type_path}.enc (shape (total tokens, d_model)), with int64
+    offsets per example id in {type_path}.enc.idx and the key they were built for in {type_path}.enc.json.
+    """
+
+    def __init__(self, cache_dir, type_path, d_model):
+        self.hidden_file = Path(cache_dir).joinpath(type_path + ".enc")
+        self.offsets_file = Path(cache_dir).joinpath(type_path + ".enc.idx")
+        self.key_file = Path(cache_dir).joinpath(type_path + ".enc.json")
+        self.d_model = d_model
+        self._hidden = None
+        self._offsets = None
+
+    @property
+    def hidden(self) -> np.ndarray:
+        if self._hidden is None:
+            self._hidden = np.memmap(self.hidden_file, dtype=np.float16, mode="r").reshape(-1, self.d_model)
+        return self._hidden
+
+    @property
+    def offsets(self) -> np.ndarray:
+        if self._offsets is None:
+            self._offsets = np.memmap(self.offsets_file, dtype=np.int64, mode="r")
+        return self._offsets
+
+    def __getitem__(self, index) -> np.ndarray:
+        return self.hidden[self.offsets[index] : self.offsets[index + 1]]
+
+    def __getstate__(self):
+        return {**self.__dict__, "_hidden": None, "_offsets": None}
+
+    def gather(self, ids: List[int], max_len: int) -> torch.Tensor:
+        """Right-padded hidden states of `ids`, shape (len(ids), max_len, d_model)."""
+        hidden = np.zeros((len(ids), max_len, self.d_model), dtype=np.float16)
+        for i, index in enumerate(ids):
+            states = self[index]
+            hidden[i, : len(states)] = states
+        return torch.from_numpy(hidden)
+
+    @torch.no_grad()
+    def build(self, encoder, dataloader, key: str, device=None) -> None:
+        """Run `encoder` over an unshuffled `dataloader` whose batches have ids, unless the cache was built for `key`.
+
+        Processes sharing the cache directory build it one after another, so only the first one does any work.
+        """
+        self.hidden_file.parent.mkdir(parents=True, exist_ok=True)
+        with FileLock(f"{self.hidden_file}.lock"):
+            if self.key_file.exists() and load_json(self.key_file)["key"] == key:
+                return
+            lens = np.zeros(len(dataloader.dataset), dtype=np.int64)
+            next_id = 0
+            with open(self.hidden_file, "wb") as f:
+                for batch in dataloader:
+                    ids = batch["ids"].tolist()
+                    assert ids == list(range(next_id, next_id + len(ids))), "the dataloader must not shuffle"
+                    next_id += len(ids)
+                    hidden = encoder(
+                        input_ids=batch["input_ids"].to(device), attention_mask=batch["attention_mask"].to(device)
+                    )[0]
+                    hidden = hidden.half().cpu().numpy()
+                    for i, length in enumerate(batch["attention_mask"].sum(1).tolist()):
+                        f.write(hidden[i, :length].tobytes())
+                        lens[ids[i]] = length
+            np.concatenate(([0], np.cumsum(lens))).astype(np.int64).tofile(self.offsets_file)
+            save_json({"key": key}, self.key_file)
+        self._hidden = None
+        self._offsets = None
+
+
+class EncoderOutputCollator:
+    """Wraps a dataset's collate_fn and adds the cached encoder hidden states of each batch."""
+
+    def __init__(self, collate_fn, cache: EncoderOutputCache):
+        self.collate_fn = collate_fn
+        self.cache = cache
+
+    def __call__(self, batch) -> Dict[str, torch.Tensor]:
+        batch = self.collate_fn(batch)
+        batch["encoder_hidden_states"] = self.cache.gather(batch["ids"].tolist(), batch["input_ids"].shape[1])
+        return batch
+
+
+def pad_token_ids(sequences: List[np.ndarray], pad_token_id: int) -> torch.Tensor:
+    """Right-pad 1-d arrays of token ids into a LongTensor of shape (len(sequences), longest sequence)."""
+    padded = np.full((len(sequences), max(lmap(len, sequences))), pad_token_id, dtype=np.int64)
+    for i, seq in enumerate(sequences):
+        padded[i, : len(seq)] = seq
+    return torch.from_numpy(padded)
+
+
 class Seq2SeqDataCollator:
     def __init__(self, tokenizer, data_args, tpu_num_cores=None):
         self.tokenizer = tokenizer
@@ -329,41 +1081,73 @@ class Seq2SeqDataCollator:
 class SortishSampler(Sampler):
     "Go through the text data by order of src length with a bit of randomness. From fastai repo."
 
-    def __init__(self, data, batch_size, shuffle=True):
+    def __init__(self, data, batch_size, shuffle=True, seed=0):
         self.data, self.bs, self.shuffle = data, batch_size, shuffle
+        self.seed = seed
+        self.epoch = 0
 
     def __len__(self) -> int:
         return len(self.data)
 
     def __iter__(self):
-        return iter(sortish_sampler_indices(self.data, self.bs, shuffle=self.shuffle))
+        rng = np.random.default_rng([self.seed, self.epoch])
+        return iter(sortish_sampler_indices(self.data, self.bs, shuffle=self.shuffle, rng=rng))
 
+    def set_epoch(self, epoch):
+        self.epoch = epoch
 
-def sortish_sampler_indices(data: List, bs: int, shuffle=True) -> np.array:
-    "Go through the text data by order of src length with a bit of randomness. From fastai repo."
-    if not shuffle:
-        return np.argsort(np.array(data) * -1)
 
-    def key_fn(i):
-        return data[i]
+def sortish_sampler_indices(data: List, bs: int, shuffle=True, rng: np.random.Generator = None) -> np.array:
+    """Go through the text data by order of src length with a bit of randomness. From fastai repo.
 
-    idxs = np.random.permutation(len(data))
+    Shuffles, sorts blocks of 50 batches by decreasing length and shuffles the batches, keeping the batch with the
+    longest example first. `rng` defaults to a generator seeded from numpy's global random state.
+    """
+    data = np.asarray(data)
+    if not shuffle:
+        return np.argsort(data * -1)
+    if len(data) == 0:
+        return np.array([], dtype=np.int64)
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2 ** 31))
+
+    # decreasing lengths as increasing keys; numpy sorts keys of 16 bits with a stable radix sort, in linear time
+    keys = -data
+    if np.issubdtype(data.dtype, np.integer):
+        keys = data.max() - data
+        keys = keys.astype(np.uint16 if keys.max() < 2 ** 16 else np.int64)
+    idxs = rng.permutation(len(data))
     sz = bs * 50
-    ck_idx = [idxs[i : i + sz] for i in range(0, len(idxs), sz)]
-    sort_idx = np.concatenate([sorted(s, key=key_fn, reverse=True) for s in ck_idx])
-    sz = bs
-    ck_idx = [sort_idx[i : i + sz] for i in range(0, len(sort_idx), sz)]
-    max_ck = np.argmax([key_fn(ck[0]) for ck in ck_idx])  # find the chunk with the largest key,
-    ck_idx[0], ck_idx[max_ck] = ck_idx[max_ck], ck_idx[0]  # then make sure it goes first.
-    sort_idx = np.concatenate(np.random.permutation(ck_idx[1:])) if len(ck_idx) > 1 else np.array([], dtype=np.int)
-    sort_idx = np.concatenate((ck_idx[0], sort_idx))
-    return sort_idx
+    n_full = len(idxs) // sz * sz
+    blocks, tail = idxs[:n_full].reshape(-1, sz), idxs[n_full:]
+    blocks = np.take_along_axis(blocks, np.argsort(keys[blocks], axis=1, kind="stable"), axis=1)
+    sort_idx = np.concatenate((blocks.ravel(), tail[np.argsort(keys[tail], kind="stable")]))
+
+    n_chunks = math.ceil(len(sort_idx) / bs)
+    chunk_order = np.arange(n_chunks)
+    max_ck = np.argmax(data[sort_idx[::bs]])  # find the chunk with the largest key,
+    chunk_order[[0, max_ck]] = chunk_order[[max_ck, 0]]  # then make sure it goes first.
+    chunk_order[1:] = rng.permutation(chunk_order[1:])
+    chunks = np.full(n_chunks * bs, -1, dtype=np.int64)
+    chunks[: len(sort_idx)] = sort_idx
+    sort_idx = chunks.reshape(n_chunks, bs)[chunk_order].ravel()
+    return sort_idx[sort_idx >= 0]
+
+
+def stratified_subsample(lengths, k: int, seed: int = 0) -> List[int]:
+    """`k` indices, one from each of `k` equally sized bins of the indices sorted by `lengths`, so the sample has the
+    length distribution of the whole set. Always the same sample for the same seed."""
+    order = np.argsort(lengths, kind="stable")
+    rng = np.random.default_rng(seed)
+    return sorted(int(rng.choice(stratum)) for stratum in np.array_split(order, min(k, len(order))))
 
 
 class DistributedSortishSampler(Sampler):
     """Copied from torch DistributedSampler"""
 
-    def __init__(self, dataset, batch_size, num_replicas=None, rank=None, add_extra_examples=True, shuffle=True):
+    def __init__(
+        self, dataset, batch_size, num_replicas=None, rank=None, add_extra_examples=True, shuffle=True, seed=0
+    ):
         if num_replicas is None:
             if not dist.is_available():
                 raise RuntimeError("Requires distributed package to be available")
@@ -385,23 +1169,21 @@ class DistributedSortishSampler(Sampler):
         self.batch_size = batch_size
         self.add_extra_examples = add_extra_examples
         self.shuffle = shuffle
+        self.seed = seed
 
     def __iter__(self) -> Iterable:
-        g = torch.Generator()
-        g.manual_seed(self.epoch)
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank])
 
-        sortish_data = [self.dataset.src_lens[i] for i in self.available_indices]
-        sortish_indices = sortish_sampler_indices(sortish_data, self.batch_size, shuffle=self.shuffle)
-        indices = [self.available_indices[i] for i in sortish_indices]
+        sortish_data = np.asarray(self.dataset.src_lens)[self.available_indices]
+        sortish_indices = sortish_sampler_indices(sortish_data, self.batch_size, shuffle=self.shuffle, rng=rng)
+        indices = self.available_indices[sortish_indices].tolist()
         assert len(indices) == self.num_samples
         return iter(indices)
 
     @cached_property
     def available_indices(self) -> np.array:
-        indices = list(range(len(self.dataset)))
         # add extra samples to make it evenly divisible
-        indices += indices[: (self.total_size - len(indices))]
-        assert len(indices) == self.total_size
+        indices = np.arange(self.total_size) % len(self.dataset)
         # subsample
         available_indices = indices[self.rank : self.total_size : self.num_replicas]
         return available_indices
@@ -413,6 +1195,84 @@ class DistributedSortishSampler(Sampler):
         self.epoch = epoch
 
 
+class TokenBudgetBatchSampler(Sampler):
+    """Batches of similar lengths whose padded cost, (longest source + longest target) * batch size, fits max_tokens.
+
+    Consecutive batches are grouped by num_replicas and each rank takes its own batch of every group, so all ranks run
+    the same number of steps on batches of similar cost. Groups are reshuffled and examples of equal lengths are
+    exchanged between batches every epoch, seeded by (seed, epoch).
+    """
+
+    def __init__(
+        self,
+        src_lens,
+        tgt_lens,
+        max_tokens,
+        num_replicas=1,
+        rank=0,
+        seed=0,
+        shuffle=True,
+        required_batch_size_multiple=1,
+    ):
+        self.src_lens = np.asarray(src_lens)
+        self.tgt_lens = np.asarray(tgt_lens)
+        assert len(self.src_lens) == len(self.tgt_lens), "src_lens and tgt_lens have different lengths"
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.shuffle = shuffle
+        self.epoch = 0
+        # the sorted (src_len, tgt_len) sequence does not depend on how ties are broken, so neither do the boundaries
+        indices = self.sorted_indices()
+        self.batch_starts = self.get_batch_starts(
+            self.src_lens[indices], self.tgt_lens[indices], max_tokens, required_batch_size_multiple
+        )
+        self.num_groups = math.ceil(len(self.batch_starts) / num_replicas)
+
+    def sorted_indices(self, rng=None) -> np.ndarray:
+        """Indices sorted by decreasing source and then target length, ties broken by `rng` if given."""
+        keys = (self.tgt_lens, self.src_lens)
+        if rng is not None:
+            keys = (rng.random(len(self.src_lens)),) + keys
+        return np.lexsort(keys)[::-1]
+
+    @staticmethod
+    def get_batch_starts(src_lens, tgt_lens, max_tokens, required_batch_size_multiple=1) -> List[int]:
+        """Greedily cut lengths sorted by decreasing source length into batches, returns the start of each batch."""
+        src_lens, tgt_lens = src_lens.tolist(), tgt_lens.tolist()
+        starts, start, max_tgt_len = [0], 0, 0
+        for i, tgt_len in enumerate(tgt_lens):
+            max_tgt_len = max(max_tgt_len, tgt_len)
+            if (src_lens[start] + max_tgt_len) * (i + 1 - start) > max_tokens and i > start:
+                size = i - start
+                if size > required_batch_size_multiple:
+                    size -= size % required_batch_size_multiple
+                start += size
+                starts.append(start)
+                max_tgt_len = max(tgt_lens[start : i + 1])
+        return starts
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        indices = self.sorted_indices(rng if self.shuffle else None)
+        batches = np.split(indices, self.batch_starts[1:])
+        # fill up the last group with the smallest batches
+        n_missing = self.num_groups * self.num_replicas - len(batches)
+        batches += [batches[-1 - i % len(batches)] for i in range(n_missing)]
+        groups = np.arange(self.num_groups)
+        if self.shuffle:
+            # the group with the longest sources stays first to OOM quickly
+            groups[1:] = 1 + rng.permutation(self.num_groups - 1)
+        for group in groups:
+            yield batches[group * self.num_replicas + self.rank].tolist()
+
+    def __len__(self):
+        return self.num_groups
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
 logger = getLogger(__name__)
 
 
@@ -458,7 +1318,11 @@ def load_json(path):
         return json.load(f)
 
 
+@lru_cache(maxsize=None)
 def get_git_info():
+    """Computed once per process, GitPython runs git subprocesses."""
+    import git
+
     try:
         repo = git.Repo(search_parent_directories=True)
         repo_infos = {
@@ -515,6 +1379,10 @@ def calculate_rouge(
          Dict[score: value] if aggregate else defaultdict(list) keyed by rouge_keys
 
     """
+    from rouge_score import rouge_scorer, scoring
+
+    from sentence_splitter import add_newline_to_end_of_each_sentence
+
     scorer = rouge_scorer.RougeScorer(rouge_keys, use_stemmer=use_stemmer)
     aggregator = scoring.BootstrapAggregator()
     for pred, tgt in zip(tgt_lns, pred_lns):